@@ -35,36 +35,20 @@ def read_unique_entries_from_file(
     database_dir: str = "database",
     directory: str = "metadata",
     squeue: str = "Q",
+    engine: str = "columnar",
+    workers: int = None,
 ) -> Tuple[str, str]:
-    import zipfile
-    import json as js
+    import os
     import pandas as pd
-    from storage import DataStorage
+    from storage import DataStorage, StoreType
     from tools.dag import decode_meta_name
+    from tools.ingest import read_day, save_manifest
     from os.path import isdir, isfile
     from os import mkdir
     import time
 
     start = time.time()
 
-    def decode_entries_in_file(file_name, f, null_DATA):
-        data = dict()
-        data["DATA"] = null_DATA
-        try:
-            data = js.load(f)
-        except ValueError:
-            # includes simplejson.decoder.JSONDecodeError
-            # invalid JSON numbers are encountered
-            pass
-        return data["DATA"]
-
-    null_DATA = [[]]
-    unique_entries = set()
-    error_metatadata = dict()
-    error_metatadata["MOTIF"] = list()
-    error_metatadata["FILENAME"] = list()
-    error_metatadata["EXTRAINFO"] = list()
-
     memory = DataStorage("bus")
 
     if not isdir(directory):
@@ -79,68 +63,34 @@ def read_unique_entries_from_file(
     #     if isfile(f"{database_dir}/{tag}.parquet"):
     #         df = pd.read_parquet(f"{database_dir}/{tag}.parquet")
 
-    try:
-        with zipfile.ZipFile(zip_file_name) as file_handler:
-            for file_name in file_handler.namelist():
-                meta_hour = decode_meta_name(file_name)
-                h_tag = f"{meta_day}:{meta_hour}"
-                try:
-                    with file_handler.open(file_name, "r") as f:
-                        entries_in_minute_file = decode_entries_in_file(
-                            file_name, f, null_DATA
-                        )
-                        if (
-                            len(entries_in_minute_file) == 0
-                            or entries_in_minute_file == null_DATA
-                        ):
-                            error_metatadata["MOTIF"].append("DECODE FAIL")
-                            error_metatadata["FILENAME"].append(str(file_name))
-                            error_metatadata["EXTRAINFO"].append(str(h_tag))
-                            continue
-                        for each_entry in entries_in_minute_file:
-                            unique_entries.add(
-                                (
-                                    str(
-                                        each_entry[0]
-                                    ),  # convert the GPS time into a string
-                                    str(
-                                        each_entry[1]
-                                    ),  # convert the bus index into a string
-                                    str(
-                                        each_entry[2]
-                                    ),  # convert the busline or service to str
-                                    float(
-                                        each_entry[3]
-                                    ),  # convert the latitude into a float
-                                    float(
-                                        each_entry[4]
-                                    ),  # convert the longitude into a float
-                                    float(
-                                        each_entry[5]
-                                    ),  # convert the velocity into a float
-                                )
-                            )
-                except:  # zipfile.BadZipFile
-                    error_metatadata["MOTIF"].append("FIELDERROR")
-                    error_metatadata["FILENAME"].append(str(file_name))
-                    error_metatadata["EXTRAINFO"].append(str(h_tag))
-
-                    continue
-    except:  # BadZipFile
-        error_metatadata["MOTIF"].append("BADZIPFILE")
-        error_metatadata["FILENAME"].append(str(zip_file_name))
-        error_metatadata["EXTRAINFO"].append(str(tag))
+    # Decode the minute files over several processes, e.g. when only a few days are
+    # left and most of the Parsl workers are idle
+    if workers is None:
+        workers = int(os.environ.get("INGEST_WORKERS", "1"))
+
+    # The members of the zip as read now, for a later incremental run
+    save_manifest(zip_file_name, f"{directory}/{tag}-MANIFEST.parquet")
+
+    # The columnar engine hands out a DataFrame, the python one a set of tuples
+    unique_entries, error_metatadata, ingest_stat = read_day(
+        zip_file_name, engine, workers
+    )
 
     df = pd.DataFrame(error_metatadata)
     df.to_parquet(f"{directory}/{tag}-ERROR-PH1.parquet")
 
-    memory.set(tag, unique_entries)
+    if engine == "columnar":
+        memory.set(tag, unique_entries, StoreType.ARROW)
+    else:
+        memory.set(tag, unique_entries)
 
     end = time.time()
     meta_stat = dict()
     meta_stat["DATASET"] = tag
     meta_stat["FUNC"] = "read_unique_entries_from_file"
     meta_stat["TIME"] = end - start
+    meta_stat.update(ingest_stat)
+    meta_stat["IOSTAT"] = memory.collect_metrics()
     memory.enqueue(f"{squeue}-METASTAT", meta_stat)
 
     return (meta_group, meta_day)
@@ -150,7 +100,8 @@ def read_unique_entries_from_file(
 def filter_entries_pipeline(data_future: Any, squeue: str) -> Tuple[str, str]:
     import pandas as pd
     import geopandas as gpd
-    from storage import DataStorage
+    from storage import DataStorage, StoreType
+    from tools.daystream import join_regions
     import time
 
     start = time.time()
@@ -170,44 +121,16 @@ def filter_entries_pipeline(data_future: Any, squeue: str) -> Tuple[str, str]:
         columns=["DATE", "BUSID", "LINE", "LAT", "LONG", "VELOCITY"],
     )
 
-    df["latitude"] = df["LAT"].astype(str)
-    df["longitude"] = df["LONG"].astype(str)
-
-    df = df.assign(
-        geometry=(
-            "POINT Z (" + df["longitude"] + " " + df["latitude"] + " " + "0.00000)"
-        )
-    )
-
-    cp_union = gpd.GeoDataFrame(
-        df.loc[:, [c for c in df.columns if c != "geometry"]],
-        geometry=gpd.GeoSeries.from_wkt(df["geometry"]),
-        crs="epsg:4326",
-    )
-
-    dfjoin = gpd.sjoin(cp_union, area_gpd, how="left")
-
-    dfjoin.drop(
-        columns=[
-            "latitude",
-            "longitude",
-            "geometry",
-            "Área",
-            "AREA_PLANE",
-            "LINK",
-            "SHAPESTArea",
-            "SHAPESTLength",
-        ],
-        inplace=True,
-    )
+    dfjoin = join_regions(df, area_gpd)
 
-    memory.set(f"{tag}", pd.DataFrame(dfjoin))
+    memory.set(f"{tag}", dfjoin, StoreType.ARROW)
 
     end = time.time()
     meta_stat = dict()
     meta_stat["DATASET"] = tag
     meta_stat["FUNC"] = "filter_entries_pipeline"
     meta_stat["TIME"] = end - start
+    meta_stat["IOSTAT"] = memory.collect_metrics()
     memory.enqueue(f"{squeue}-METASTAT", meta_stat)
 
     return (meta_group, meta_day)
@@ -249,6 +172,7 @@ def dump_entries_into_database(
     meta_stat["DATASET"] = tag
     meta_stat["FUNC"] = "dump_entries_into_database"
     meta_stat["TIME"] = end - start
+    meta_stat["IOSTAT"] = memory.collect_metrics()
     memory.enqueue(f"{squeue}-METASTAT", meta_stat)
 
     return (meta_group, meta_day)
@@ -264,6 +188,8 @@ def release_shared_memory(data_future: Any, squeue: str) -> Tuple[str, str]:
     meta_group, meta_day = data_future
     tag = f"{meta_group}-{meta_day}"
 
+    # delete also unlinks the values kept in shared memory (DATASTORAGE_BACKEND=shm)
+    # or spilled to disk (DATASTORAGE_SPILL_DIR)
     memory = DataStorage("bus")
     memory.delete(tag)
     memory.delete(f"STATUS-{tag}")
@@ -273,6 +199,7 @@ def release_shared_memory(data_future: Any, squeue: str) -> Tuple[str, str]:
     meta_stat["DATASET"] = tag
     meta_stat["FUNC"] = "release_shared_memory"
     meta_stat["TIME"] = end - start
+    meta_stat["IOSTAT"] = memory.collect_metrics()
     memory.enqueue(f"{squeue}-METASTAT", meta_stat)
 
     return (meta_group, meta_day)
@@ -284,8 +211,8 @@ def calculate_dayly_statistics(
 ) -> Tuple[str, str]:
     import logging
     from storage import DataStorage
-    import numpy as np
     import pandas as pd
+    from tools.daystream import day_statistics
     from os.path import isdir
     from os import mkdir
     import time
@@ -298,58 +225,6 @@ def calculate_dayly_statistics(
     if not isdir(directory):
         mkdir(directory)
 
-    def init_statistics_dict(ndf, nbus) -> Dict:
-        statistics_dict = dict()
-        statistics_dict["DAY"] = tag
-        statistics_dict["N_OBS"] = ndf
-        statistics_dict["N_BUS"] = nbus
-        statistics_dict["FILT_OBS"] = 0
-        statistics_dict["DIST_AVG"] = np.nan
-        statistics_dict["DIST_STD"] = np.nan
-        statistics_dict["DIST_MAX"] = np.nan
-        statistics_dict["DIST_MAX_BUS"] = "NONE"
-        statistics_dict["INTERVAL_AVG"] = np.nan
-        statistics_dict["INTERVAL_STD"] = np.nan
-        statistics_dict["INTERVAL_MIN"] = np.nan
-        statistics_dict["INTERVAL_MAX"] = np.nan
-        statistics_dict["INTERVAL_MIN_BUS"] = "NONE"
-        statistics_dict["INTERVAL_MAX_BUS"] = "NONE"
-        statistics_dict["AVGSPEED_AVG"] = np.nan
-        statistics_dict["AVGSPEED_STD"] = np.nan
-        statistics_dict["AVGSPEED_MIN"] = np.nan
-        statistics_dict["AVGSPEED_MAX"] = np.nan
-        statistics_dict["AVGSPEED_MIN_BUS"] = "NONE"
-        statistics_dict["AVGSPEED_MAX_BUS"] = "NONE"
-        statistics_dict["VELOCITY_AVG"] = np.nan
-        statistics_dict["VELOCITY_STD"] = np.nan
-        statistics_dict["VELOCITY_MIN"] = np.nan
-        statistics_dict["VELOCITY_MAX"] = np.nan
-        statistics_dict["VELOCITY_MIN_BUS"] = "NONE"
-        statistics_dict["VELOCITY_MAX_BUS"] = "NONE"
-        return statistics_dict
-
-    def haversine(lat1, lon1, lat2, lon2, to_radians=True, earth_radius=6371):
-        """
-        slightly modified version: of http://stackoverflow.com/a/29546836/2901002
-
-        Calculate the great circle distance between two points
-        on the earth (specified in decimal degrees or in radians)
-
-        All (lat, lon) coordinates must have numeric dtypes and be of equal length.
-
-        """
-        if to_radians:
-            lat1, lon1, lat2, lon2 = np.radians([lat1, lon1, lat2, lon2])
-
-        a = (
-            np.sin((lat2 - lat1) / 2.0) ** 2
-            + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2.0) ** 2
-        )
-
-        return earth_radius * 2 * np.arcsin(np.sqrt(a))
-
-    meta_group, meta_day = data_future
-    tag = f"{meta_group}-{meta_day}"
     memory = DataStorage("bus")
 
     data_frame = memory.get(tag)
@@ -360,131 +235,241 @@ def calculate_dayly_statistics(
         )
         return (meta_group, meta_day)
 
-    data_frame["NEWDATE"] = pd.to_datetime(
-        data_frame["DATE"], format="%m-%d-%Y %H:%M:%S", errors="coerce"
-    )
+    data_frame_result, statistics_dict = day_statistics(data_frame, tag)
 
-    data_frame["NDATE"] = data_frame["NEWDATE"]
+    if data_frame_result is not None:
+        data_frame_result.to_parquet(f"{directory}/{tag}.parquet")
 
-    data_frame.index = data_frame["NEWDATE"]
+    # The statistics of the day, taken back by an incremental run of an unchanged day
+    pd.DataFrame([statistics_dict]).to_parquet(f"{directory}/{tag}-STATS.parquet")
+    memory.enqueue(f"{squeue}-STATS", statistics_dict)
 
-    data_frame.sort_index(inplace=True)
+    end = time.time()
+    meta_stat = dict()
+    meta_stat["DATASET"] = tag
+    meta_stat["FUNC"] = "calculate_dayly_statistics"
+    meta_stat["TIME"] = end - start
+    meta_stat["IOSTAT"] = memory.collect_metrics()
+    memory.enqueue(f"{squeue}-METASTAT", meta_stat)
 
-    busid_list = list(data_frame["BUSID"].unique())
+    return (meta_group, meta_day)
 
-    new_columns = list(data_frame.columns)
-    new_columns.append("DIST")
-    new_columns.append("INTERVAL")
-    new_columns.append("AVGSPEED")
 
-    statistics_dict = init_statistics_dict(len(data_frame), len(busid_list))
+@python_app
+def stream_day_pipeline(
+    zip_file_name: str,
+    next_pipe: Any = None,
+    database_dir: str = "database",
+    directory: str = "metadata",
+    statistics_dir: str = "statdata",
+    squeue: str = "Q",
+    batch_files: int = 60,
+) -> Tuple[str, str]:
+    """The per-day pipeline (read, filter, dump and statistics) a batch of minute
+    files at a time: the batches go through the spatial join into the Parquet
+    outputs, only the state of the statistics is kept across them (see
+    tools.daystream), so the day is never held whole."""
+    import geopandas as gpd
+    import pandas as pd
+    from storage import DataStorage
+    from tools.dag import decode_meta_name
+    from tools.daystream import DayStatistics, ParquetStream, join_regions
+    from tools.ingest import new_errors, save_manifest, stream_day
+    from os.path import isdir
+    from os import mkdir
+    import time
 
-    data_frame_result = pd.DataFrame(columns=new_columns)
-    data_frame_list = list()
+    start = time.time()
 
-    if len(busid_list) > 0:
+    memory = DataStorage("bus")
 
-        for bus in busid_list:
-            slice = data_frame[data_frame["BUSID"] == bus]
-            bus_df = pd.DataFrame(slice[slice["REGIAO_ADM"].notna()])
-            bus_df["DIST"] = haversine(
-                bus_df["LAT"],
-                bus_df["LONG"],
-                bus_df["LAT"].shift(),
-                bus_df["LONG"].shift(),
-            )
-            bus_df["INTERVAL"] = bus_df["NDATE"].diff()
-            bus_df["AVGSPEED"] = bus_df["DIST"] / (
-                bus_df["INTERVAL"] / np.timedelta64(1, "h")
-            )
+    for each_directory in (database_dir, directory, statistics_dir):
+        if not isdir(each_directory):
+            mkdir(each_directory)
 
-            bus_df.index = np.arange(len(bus_df))
+    tag = decode_meta_name(zip_file_name)
+    meta_group, meta_day = tag[:2], tag[3:]  # format: G1-2017-07-12
 
-            data_frame_list.append(bus_df)
+    memory.set(f"STATUS-{tag}", "stream_day_pipeline")
 
-        data_frame_result = pd.concat(data_frame_list, ignore_index=True)
+    save_manifest(zip_file_name, f"{directory}/{tag}-MANIFEST.parquet")
 
-        data_frame_result.drop(
-            columns=[
-                "NEWDATE",
-                "NDATE",
-                "index_right",
-            ],
-            inplace=True,
-        )
+    area_gpd = gpd.read_file("regions/Limite_de_Bairros.geojson")
 
-        statistics_dict["FILT_OBS"] = len(data_frame_result)
-        statistics_dict["DIST_AVG"] = data_frame_result["DIST"].mean()
-        statistics_dict["DIST_STD"] = data_frame_result["DIST"].std()
-        try:
-            statistics_dict["DIST_MAX"] = data_frame_result["DIST"].max()
-            statistics_dict["DIST_MAX_BUS"] = data_frame_result.iloc[
-                data_frame_result["DIST"].idxmax()
-            ]["BUSID"]
-        except:
-            statistics_dict["DIST_MAX"] = np.nan
-            statistics_dict["DIST_MAX_BUS"] = "NONE"
-
-        statistics_dict["INTERVAL_AVG"] = data_frame_result["INTERVAL"].mean()
-        statistics_dict["INTERVAL_STD"] = data_frame_result["INTERVAL"].std()
-        try:
-            statistics_dict["INTERVAL_MIN"] = data_frame_result["INTERVAL"].min()
-            statistics_dict["INTERVAL_MAX"] = data_frame_result["INTERVAL"].max()
-            statistics_dict["INTERVAL_MIN_BUS"] = data_frame_result.iloc[
-                data_frame_result["INTERVAL"].idxmin()
-            ]["BUSID"]
-            statistics_dict["INTERVAL_MAX_BUS"] = data_frame_result.iloc[
-                data_frame_result["INTERVAL"].idxmax()
-            ]["BUSID"]
-        except:
-            statistics_dict["INTERVAL_MIN"] = np.nan
-            statistics_dict["INTERVAL_MAX"] = np.nan
-            statistics_dict["INTERVAL_MIN_BUS"] = "NONE"
-            statistics_dict["INTERVAL_MAX_BUS"] = "NONE"
-
-        statistics_dict["AVGSPEED_AVG"] = data_frame_result["AVGSPEED"].mean()
-        statistics_dict["AVGSPEED_STD"] = data_frame_result["AVGSPEED"].std()
-        try:
-            statistics_dict["AVGSPEED_MIN"] = data_frame_result["AVGSPEED"].min()
-            statistics_dict["AVGSPEED_MAX"] = data_frame_result["AVGSPEED"].max()
-            statistics_dict["AVGSPEED_MIN_BUS"] = data_frame_result.iloc[
-                data_frame_result["AVGSPEED"].idxmin()
-            ]["BUSID"]
-            statistics_dict["AVGSPEED_MAX_BUS"] = data_frame_result.iloc[
-                data_frame_result["AVGSPEED"].idxmax()
-            ]["BUSID"]
-        except:
-            statistics_dict["AVGSPEED_MIN"] = np.nan
-            statistics_dict["AVGSPEED_MAX"] = np.nan
-            statistics_dict["AVGSPEED_MIN_BUS"] = "NONE"
-            statistics_dict["AVGSPEED_MAX_BUS"] = "NONE"
-
-        statistics_dict["VELOCITY_AVG"] = data_frame_result["VELOCITY"].mean()
-        statistics_dict["VELOCITY_STD"] = data_frame_result["VELOCITY"].std()
-        try:
-            statistics_dict["VELOCITY_MIN"] = data_frame_result["VELOCITY"].min()
-            statistics_dict["VELOCITY_MAX"] = data_frame_result["VELOCITY"].max()
-            statistics_dict["VELOCITY_MIN_BUS"] = data_frame_result.iloc[
-                data_frame_result["VELOCITY"].idxmin()
-            ]["BUSID"]
-            statistics_dict["VELOCITY_MAX_BUS"] = data_frame_result.iloc[
-                data_frame_result["VELOCITY"].idxmax()
-            ]["BUSID"]
-        except:
-            statistics_dict["VELOCITY_MIN"] = np.nan
-            statistics_dict["VELOCITY_MAX"] = np.nan
-            statistics_dict["VELOCITY_MIN_BUS"] = "NONE"
-            statistics_dict["VELOCITY_MAX_BUS"] = "NONE"
+    rows, unique_rows = 0, 0
+    error_metatadata = new_errors()
+    day_statistics = DayStatistics(tag)
+    with ParquetStream(f"{database_dir}/{tag}.parquet") as database, ParquetStream(
+        f"{statistics_dir}/{tag}.parquet"
+    ) as statdata:
+        for entries, batch_rows, errors in stream_day(zip_file_name, batch_files):
+            rows += batch_rows
+            unique_rows += len(entries)
+            for field, values in errors.items():
+                error_metatadata[field].extend(values)
+            if len(entries) == 0:
+                continue
+            dfjoin = join_regions(entries, area_gpd)
+            database.write(dfjoin)
+            statdata.write(day_statistics.add(dfjoin))
 
-        data_frame_result.to_parquet(f"{directory}/{tag}.parquet")
+    df = pd.DataFrame(error_metatadata)
+    df.to_parquet(f"{directory}/{tag}-ERROR-PH1.parquet")
 
+    statistics_dict = day_statistics.statistics()
+    pd.DataFrame([statistics_dict]).to_parquet(f"{statistics_dir}/{tag}-STATS.parquet")
     memory.enqueue(f"{squeue}-STATS", statistics_dict)
+    memory.delete(f"STATUS-{tag}")
 
     end = time.time()
     meta_stat = dict()
     meta_stat["DATASET"] = tag
-    meta_stat["FUNC"] = "calculate_dayly_statistics"
+    meta_stat["FUNC"] = "stream_day_pipeline"
     meta_stat["TIME"] = end - start
+    meta_stat["ROWS"] = rows
+    meta_stat["UNIQUE_ROWS"] = unique_rows
+    meta_stat["IOSTAT"] = memory.collect_metrics()
+    memory.enqueue(f"{squeue}-METASTAT", meta_stat)
+
+    return (meta_group, meta_day)
+
+
+@python_app
+def incremental_day_pipeline(
+    zip_file_name: str,
+    next_pipe: Any = None,
+    database_dir: str = "database",
+    directory: str = "metadata",
+    statistics_dir: str = "statdata",
+    squeue: str = "Q",
+) -> Tuple[str, str]:
+    """The per-day pipeline for a day zip that may have been processed before: only
+    the members that are new since (see the manifest of the day) are decoded and
+    joined, and their new rows merged into the database, the statistics are
+    computed again from it (see day_statistics, as calculate_dayly_statistics). A
+    day without a manifest, whose STATS are older than it (an unfinished run), or
+    with a member changed or removed since, is processed whole."""
+    import geopandas as gpd
+    import pandas as pd
+    from storage import DataStorage
+    from tools.dag import decode_meta_name
+    from tools.daystream import day_statistics, join_regions, merge_new_rows
+    from tools.ingest import incremental_members, read_day, zip_manifest
+    from os.path import getmtime, isdir, isfile
+    from os import mkdir, remove, replace
+    import time
+
+    start = time.time()
+
+    memory = DataStorage("bus")
+
+    for each_directory in (database_dir, directory, statistics_dir):
+        if not isdir(each_directory):
+            mkdir(each_directory)
+
+    tag = decode_meta_name(zip_file_name)
+    meta_group, meta_day = tag[:2], tag[3:]  # format: G1-2017-07-12
+
+    memory.set(f"STATUS-{tag}", "incremental_day_pipeline")
+
+    manifest_file = f"{directory}/{tag}-MANIFEST.parquet"
+    error_file = f"{directory}/{tag}-ERROR-PH1.parquet"
+    database_file = f"{database_dir}/{tag}.parquet"
+    statdata_file = f"{statistics_dir}/{tag}.parquet"
+    stats_file = f"{statistics_dir}/{tag}-STATS.parquet"
+
+    # Every mode writes the manifest of a day first and its STATS last, the points
+    # (statdata) only when a bus was in a region
+    previous = None
+    if (
+        isfile(manifest_file)
+        and isfile(error_file)
+        and isfile(database_file)
+        and isfile(stats_file)
+        and getmtime(stats_file) >= getmtime(manifest_file)
+    ):
+        previous = pd.read_parquet(manifest_file)
+
+    try:
+        manifest = zip_manifest(zip_file_name)
+    except Exception:  # BadZipFile, reported by read_day
+        manifest = None
+    if previous is None:
+        members = None  # the whole day
+    elif manifest is None:
+        members = list()  # a bad zip (reported by read_day), the outputs are kept
+    else:
+        members = incremental_members(manifest, previous)
+        if members is None:
+            # a member changed or was removed, its old rows cannot be taken out
+            previous = None
+
+    meta_stat = dict()
+    meta_stat["DATASET"] = tag
+    meta_stat["FUNC"] = "incremental_day_pipeline"
+    meta_stat["MEMBERS"] = len(manifest) if manifest is not None else 0
+    meta_stat["READ_MEMBERS"] = (
+        meta_stat["MEMBERS"] if members is None else len(members)
+    )
+
+    if previous is not None and manifest is not None and not members:
+        # Nothing changed, the outputs are up to date
+        statistics_dict = pd.read_parquet(stats_file).to_dict(orient="records")[0]
+        memory.enqueue(f"{squeue}-STATS", statistics_dict)
+        memory.delete(f"STATUS-{tag}")
+
+        meta_stat["TIME"] = time.time() - start
+        meta_stat["IOSTAT"] = memory.collect_metrics()
+        memory.enqueue(f"{squeue}-METASTAT", meta_stat)
+        return (meta_group, meta_day)
+
+    def write_parquet(df: pd.DataFrame, path: str) -> None:
+        # a failed run leaves the previous outputs whole
+        df.to_parquet(f"{path}.tmp")
+        replace(f"{path}.tmp", path)
+        return
+
+    if manifest is not None:
+        manifest.to_parquet(manifest_file)
+
+    entries, error_metatadata, ingest_stat = read_day(zip_file_name, members=members)
+    meta_stat.update(ingest_stat)
+
+    errors = pd.DataFrame(error_metatadata)
+    database = None
+    if previous is not None:
+        # The errors of the members read again are replaced
+        previous_errors = pd.read_parquet(error_file)
+        previous_errors = previous_errors[
+            ~previous_errors["FILENAME"].isin(members)
+            & (previous_errors["MOTIF"] != "BADZIPFILE")
+        ]
+        errors = pd.concat([previous_errors, errors], ignore_index=True)
+        database = pd.read_parquet(database_file)
+
+    if len(entries) > 0:
+        area_gpd = gpd.read_file("regions/Limite_de_Bairros.geojson")
+        dfjoin = join_regions(entries, area_gpd)
+        database = dfjoin if database is None else merge_new_rows(database, dfjoin)
+    elif database is None:
+        database = entries
+    del entries
+
+    statdata, statistics_dict = day_statistics(database, tag)
+
+    write_parquet(errors, error_file)
+    write_parquet(database, database_file)
+    if statdata is not None:
+        write_parquet(statdata, statdata_file)
+    elif isfile(statdata_file):
+        remove(statdata_file)
+    write_parquet(pd.DataFrame([statistics_dict]), stats_file)
+
+    memory.enqueue(f"{squeue}-STATS", statistics_dict)
+    memory.delete(f"STATUS-{tag}")
+
+    meta_stat["TIME"] = time.time() - start
+    meta_stat["IOSTAT"] = memory.collect_metrics()
     memory.enqueue(f"{squeue}-METASTAT", meta_stat)
 
     return (meta_group, meta_day)
@@ -495,6 +480,7 @@ def dump_statistics(
     squeue: str, directory: str = "statdata", inputs: List = []
 ) -> Tuple[str, str]:
     from storage import DataStorage
+    from storage.instrumentation import merge, summary_rows
     from collections import defaultdict
     import pandas as pd
     import time
@@ -503,32 +489,41 @@ def dump_statistics(
 
     memory = DataStorage("bus")
     statistics_dict = defaultdict(list)
-    meta_statistics_dict = defaultdict(list)
-
-    memory.enqueue(f"{squeue}-STATS", "END_SENTINEL")
-    memory.enqueue(f"{squeue}-METASTAT", "END_SENTINEL")
+    meta_statistics = list()
+    io_statistics = list()
 
-    item = memory.dequeue(f"{squeue}-STATS")
-    while item != "END_SENTINEL":
+    for item in memory.drain(f"{squeue}-STATS"):
         for k, v in item.items():
             statistics_dict[k].append(v)
-        item = memory.dequeue(f"{squeue}-STATS")
 
     df = pd.DataFrame(statistics_dict)
     df.to_parquet(f"{directory}/{squeue}-STATS.parquet")
 
-    item = memory.dequeue(f"{squeue}-METASTAT")
-    while item != "END_SENTINEL":
-        for k, v in item.items():
-            meta_statistics_dict[k].append(v)
-        item = memory.dequeue(f"{squeue}-METASTAT")
+    for item in memory.drain(f"{squeue}-METASTAT"):
+        iostat = item.pop("IOSTAT", None)
+        if iostat:
+            io_statistics.append(iostat)
+        meta_statistics.append(item)
+
+    # The DataStorage metrics of every task (when instrumented), one row per operation
+    io_statistics.append(memory.collect_metrics() or dict())
+    for row in summary_rows(merge(io_statistics)):
+        operation = row.pop("OPERATION")
+        meta_statistics.append(
+            dict(
+                DATASET="ALL_DATASETS",
+                FUNC=f"DataStorage.{operation}",
+                TIME=row["LATENCY_MEAN_US"] * row["COUNT"] / 1e6,
+                **row,
+            )
+        )
 
-    meta_statistics_dict["DATASET"].append("ALL_DATASETS")
-    meta_statistics_dict["FUNC"].append("dump_statistics")
     end = time.time()
-    meta_statistics_dict["TIME"].append(end - start)
+    meta_statistics.append(
+        dict(DATASET="ALL_DATASETS", FUNC="dump_statistics", TIME=end - start)
+    )
 
-    df = pd.DataFrame(meta_statistics_dict)
+    df = pd.DataFrame(meta_statistics)
     df.to_parquet(f"{directory}/{squeue}-METASTAT.parquet")
 
     memory.delete_queue(f"{squeue}-STATS")
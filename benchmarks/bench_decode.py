@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+
+""" bench_decode.py. Minute file decoding micro-benchmark (@) 2022
+This program measures the time to decode a synthetic minute file into a typed
+record batch, with every JSON decoder available (see tools.ingest.json_decoder)
+followed by rows_to_batch, and with the CSV path of decode_columns.
+This program is free software: you can redistribute it and/or modify it under
+the terms of the GNU General Public License as published by the Free Software
+Foundation, either version 3 of the License, or (at your option) any later
+version.
+This program is distributed in the hope that it will be useful, but WITHOUT
+ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+You should have received a copy of the GNU General Public License along with
+this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+
+# COPYRIGHT SECTION
+__author__ = "Diego Carvalho"
+__copyright__ = "Copyright 2022"
+__credits__ = ["Diego Carvalho"]
+__license__ = "GPL"
+__version__ = "1.0.1"
+__maintainer__ = "Diego Carvalho"
+__email__ = "d.carvalho@ieee.org"
+__status__ = "Research"
+
+import json
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from tools.ingest import (  # noqa: E402
+    DECODERS,
+    decode_columns,
+    decode_entries,
+    rows_to_batch,
+)
+
+
+def synthetic_minute(buses: int) -> bytes:
+    """A minute file as delivered by the GPS feed, two reports per bus"""
+    rng = random.Random(2017)
+    data = list()
+    for bus in range(buses):
+        for _ in range(2):
+            data.append(
+                [
+                    f"07-12-2017 10:{rng.randint(0, 59):02d}:{rng.randint(0, 59):02d}",
+                    f"B{31000 + bus}",
+                    float(rng.randint(100, 999)),
+                    round(-22.9 + rng.random() / 10, 5),
+                    round(-43.3 + rng.random() / 10, 5),
+                    round(rng.random() * 60, 1),
+                ]
+            )
+    document = {
+        "COLUMNS": ["DATAHORA", "ORDEM", "LINHA", "LATITUDE", "LONGITUDE"],
+        "DATA": data,
+    }
+    return json.dumps(document, separators=(",", ":")).encode()
+
+
+def measure(decode, data: bytes, repeat: int) -> float:
+    """Seconds per decode, the best of 3 runs"""
+    best = float("inf")
+    for _ in range(3):
+        start = time.perf_counter()
+        for _ in range(repeat):
+            decode(data)
+        best = min(best, (time.perf_counter() - start) / repeat)
+    return best
+
+
+def main(buses: int = 2000, repeat: int = 50) -> None:
+    data = synthetic_minute(buses)
+    rows = 2 * buses
+    expected = rows_to_batch(decode_entries(data))
+
+    decoders = {
+        name: (lambda data, loads=loads: rows_to_batch(decode_entries(data, loads)))
+        for name, loads in DECODERS.items()
+    }
+    decoders["columns"] = decode_columns
+
+    print(f"# {rows} rows, {len(data) / 1024:.0f} KiB")
+    print("DECODER,US_PER_FILE,ROWS_PER_S,SAME")
+    for name, decode in decoders.items():
+        seconds = measure(decode, data, repeat)
+        same = decode(data).equals(expected)
+        print(f"{name},{seconds * 1e6:.0f},{rows / seconds:.0f},{same}")
+    return
+
+
+if __name__ == "__main__":
+    # python bench_decode.py [buses] [repeat]
+    main(*[int(arg) for arg in sys.argv[1:3]])
@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+
+""" bench_ingest.py. Day zip ingest benchmark (@) 2022
+This program measures the rows per second and the peak resident memory of the
+ingest engines (see tools.ingest.read_day, and stream_day an hour at a time)
+over a synthetic day zip, every engine in a fresh process so the peaks do not
+mix.
+This program is free software: you can redistribute it and/or modify it under
+the terms of the GNU General Public License as published by the Free Software
+Foundation, either version 3 of the License, or (at your option) any later
+version.
+This program is distributed in the hope that it will be useful, but WITHOUT
+ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+You should have received a copy of the GNU General Public License along with
+this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+
+# COPYRIGHT SECTION
+__author__ = "Diego Carvalho"
+__copyright__ = "Copyright 2022"
+__credits__ = ["Diego Carvalho"]
+__license__ = "GPL"
+__version__ = "1.0.1"
+__maintainer__ = "Diego Carvalho"
+__email__ = "d.carvalho@ieee.org"
+__status__ = "Research"
+
+import json
+import multiprocessing
+import os
+import random
+import sys
+import tempfile
+import time
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from tools.ingest import (  # noqa: E402
+    ENGINES,
+    peak_rss,
+    read_day,
+    reset_peak_rss,
+    stream_day,
+)
+
+
+def write_synthetic_day(zip_file_name: str, minutes: int, buses: int) -> None:
+    """A day zip as delivered by the GPS feed: every minute file holds the last
+    two reports of every bus, so about half of the rows of a day are repeated
+    """
+    rng = random.Random(2017)
+    lines = [float(rng.randint(100, 999)) for _ in range(buses // 10 + 1)]
+    fleet = [
+        (f"B{31000 + bus}", rng.choice(lines), -22.9 + rng.random() / 10, -43.3)
+        for bus in range(buses)
+    ]
+    reports = [list() for _ in range(buses)]
+    with zipfile.ZipFile(zip_file_name, "w", zipfile.ZIP_DEFLATED) as day:
+        for minute in range(minutes):
+            data = list()
+            for bus, (busid, line, lat, lon) in enumerate(fleet):
+                second = rng.randint(0, 59)
+                # only the last two reports, the peak RSS of this process is
+                # inherited by the ones of the runs
+                reports[bus] = reports[bus][-1:] + [
+                    [
+                        f"07-12-2017 {minute // 60:02d}:{minute % 60:02d}:{second:02d}",
+                        busid,
+                        line,
+                        round(lat + minute * 1e-4, 5),
+                        round(lon + rng.random() / 100, 5),
+                        round(rng.random() * 60, 1),
+                    ]
+                ]
+                data.extend(reports[bus])
+            document = {
+                "COLUMNS": ["DATAHORA", "ORDEM", "LINHA", "LATITUDE", "LONGITUDE"],
+                "DATA": data,
+            }
+            day.writestr(
+                f"{minute // 60:02d}-{minute % 60:02d}.json", json.dumps(document)
+            )
+    return
+
+
+def run_stream(zip_file_name: str) -> dict:
+    """stream_day, an hour of minute files at a time"""
+    statistics = {"ROWS": 0, "UNIQUE_ROWS": 0, "ERRORS": 0}
+    for entries, rows, errors in stream_day(zip_file_name):
+        statistics["ROWS"] += rows
+        statistics["UNIQUE_ROWS"] += len(entries)
+        statistics["ERRORS"] += len(errors["MOTIF"])
+    return statistics
+
+
+def run_engine(zip_file_name: str, engine: str, workers: int = 1) -> dict:
+    start = time.time()
+    if engine == "stream":
+        reset_peak_rss()
+        statistics = run_stream(zip_file_name)
+        statistics["TIME"] = time.time() - start
+        statistics["ROWS_PER_S"] = statistics["ROWS"] / statistics["TIME"]
+        statistics["PEAK_RSS"] = peak_rss()
+        return statistics
+    _, errors, statistics = read_day(zip_file_name, engine, workers)
+    statistics["TIME"] = time.time() - start
+    statistics["ERRORS"] = len(errors["MOTIF"])
+    return statistics
+
+
+def main(minutes: int = 1440, buses: int = 500, workers: int = 4) -> None:
+    with tempfile.TemporaryDirectory() as directory:
+        zip_file_name = os.path.join(directory, "G1-2017-07-12.zip")
+        write_synthetic_day(zip_file_name, minutes, buses)
+
+        print("ENGINE,WORKERS,ROWS,UNIQUE_ROWS,ERRORS,TIME,ROWS_PER_S,PEAK_RSS(MiB)")
+        runs = [(engine, 1) for engine in ENGINES] + [("columnar", workers)]
+        runs += [("stream", 1)]
+        for engine, engine_workers in runs:
+            # A fresh process per run, the peak RSS of the others stays out (the
+            # peak of the decoding processes of a parallel run is not counted)
+            with ProcessPoolExecutor(
+                max_workers=1, mp_context=multiprocessing.get_context("spawn")
+            ) as process:
+                s = process.submit(
+                    run_engine, zip_file_name, engine, engine_workers
+                ).result()
+            print(
+                f"{engine},{engine_workers},{s['ROWS']},{s['UNIQUE_ROWS']},"
+                f"{s['ERRORS']},{s['TIME']:.3f},{s['ROWS_PER_S']:.0f},{s['PEAK_RSS'] / 2**20:.1f}"
+            )
+    return
+
+
+if __name__ == "__main__":
+    # python bench_ingest.py [minutes] [buses] [workers]
+    main(*[int(arg) for arg in sys.argv[1:4]])
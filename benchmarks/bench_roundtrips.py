@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+
+""" bench_roundtrips.py. DataStorage round trip benchmark (@) 2022
+This program measures how many Redis round trips (and how much time) a single
+DataStorage set/get costs as the payload grows in number of chunks.
+This program is free software: you can redistribute it and/or modify it under
+the terms of the GNU General Public License as published by the Free Software
+Foundation, either version 3 of the License, or (at your option) any later
+version.
+This program is distributed in the hope that it will be useful, but WITHOUT
+ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+You should have received a copy of the GNU General Public License along with
+this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+
+# COPYRIGHT SECTION
+__author__ = "Diego Carvalho"
+__copyright__ = "Copyright 2022"
+__credits__ = ["Diego Carvalho"]
+__license__ = "GPL"
+__version__ = "1.0.1"
+__maintainer__ = "Diego Carvalho"
+__email__ = "d.carvalho@ieee.org"
+__status__ = "Research"
+
+import os
+import sys
+import time
+
+import redis
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from storage import DataStorage, StoreType  # noqa: E402
+from storage.memory import RedisServer  # noqa: E402
+
+
+class RoundTripCounter(object):
+    """Count the packed commands sent to the server (one per round trip)"""
+
+    def __init__(self) -> None:
+        self.count = 0
+        self._send = redis.connection.Connection.send_packed_command
+        return
+
+    def __enter__(self):
+        counter = self
+
+        def send_packed_command(conn, command, check_health=True):
+            counter.count += 1
+            return counter._send(conn, command, check_health)
+
+        redis.connection.Connection.send_packed_command = send_packed_command
+        return self
+
+    def __exit__(self, *args) -> None:
+        redis.connection.Connection.send_packed_command = self._send
+        return
+
+
+def main(port: int = 7777, unix_socket: str = None) -> None:
+    server = RedisServer(port=port, unix_socket=unix_socket)
+    server.start_redis_server()
+    memory = DataStorage("bench", endpoints=server.endpoints)
+
+    print("SIZE(MiB),CHUNKS,SET_RTT,SET_TIME,GET_RTT,GET_TIME")
+    try:
+        for size_mib in (1, 4, 16, 64):
+            payload = os.urandom(size_mib * 1024 * 1024)
+            n_chunks = len(payload) // memory.chunk_size
+
+            with RoundTripCounter() as set_counter:
+                start = time.time()
+                memory.set("payload", payload, StoreType.NONE)
+                set_time = time.time() - start
+
+            # Drop the local metadata so the get pays for the directory lookup
+            memory.keyname_map.clear()
+
+            with RoundTripCounter() as get_counter:
+                start = time.time()
+                value = memory.get("payload")
+                get_time = time.time() - start
+
+            assert value == payload, "round trip corrupted the payload"
+            print(
+                f"{size_mib},{n_chunks},{set_counter.count},{set_time:.4f},"
+                f"{get_counter.count},{get_time:.4f}"
+            )
+    finally:
+        memory.reset_datastore()
+        server.stop_redis_server()
+    return
+
+
+if __name__ == "__main__":
+    # python bench_roundtrips.py [--unix]: TCP loopback or a unix domain socket
+    main(unix_socket="/tmp/redis-bench-{port}.sock" if "--unix" in sys.argv else None)
@@ -25,6 +25,7 @@ __email__ = "d.carvalho@ieee.org"
 __status__ = "Research"
 
 from .datastorage import DataStorage, StoreType
+from .asyncdatastorage import AsyncDataStorage
 from .sql import SqlStorage
 
-__all__ = [DataStorage, StoreType, SqlStorage]
+__all__ = [DataStorage, AsyncDataStorage, StoreType, SqlStorage]
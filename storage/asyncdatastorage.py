@@ -0,0 +1,416 @@
+# -*- coding: utf-8 -*-
+
+""" asyncdatastorage.py. Asynchronous External Data Storage (@) 2022
+This module provides an asyncio flavour of the DataStorage, on redis.asyncio. It
+shares the key layout, the scripts and the serializers with DataStorage, so both
+can work on the same (single server) store, and it moves the chunks of large
+values concurrently over several connections.
+This program is free software: you can redistribute it and/or modify it under
+the terms of the GNU General Public License as published by the Free Software
+Foundation, either version 3 of the License, or (at your option) any later
+version.
+This program is distributed in the hope that it will be useful, but WITHOUT
+ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+You should have received a copy of the GNU General Public License along with
+this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+
+# COPYRIGHT SECTION
+__author__ = "Diego Carvalho"
+__copyright__ = "Copyright 2022"
+__credits__ = ["Diego Carvalho"]
+__license__ = "GPL"
+__version__ = "1.0.1"
+__maintainer__ = "Diego Carvalho"
+__email__ = "d.carvalho@ieee.org"
+__status__ = "Research"
+
+import asyncio
+import fnmatch
+from typing import Any, Dict, List
+
+import redis.asyncio
+
+from .cache import LRUCache
+from .scripts import register_scripts
+from .shm import SharedMemoryBackend
+from .tiers import FileTiers
+from .datastorage import (
+    DataStorage,
+    StoreType,
+    build_serializer_table,
+    build_chunk_keys,
+    build_chunk_layout,
+    build_metadata,
+    decode_metadata,
+)
+
+
+class AsyncDataStorage(object):
+    """DataStorage for asyncio applications.
+
+    Values are written to Redis in the hash layout (a stripe per connection) and
+    published by the same scripts as DataStorage. Values written by a DataStorage
+    are read in every layout: chunked, content-addressed ("cas"), in shared memory
+    ("shm") or spilled to disk ("disk") on this host. Objects of an in-process
+    store ("ref") never reach Redis.
+    """
+
+    # Constructor
+    def __init__(
+        self,
+        store_name: str,
+        host: str = "localhost",
+        port: int = 6379,
+        ex: int = 3600,
+        connections: int = 4,
+        metadata_cache_size: int = 4096,
+        compression: Dict = None,
+    ) -> None:
+        """AsyncDataStorage Constructor
+
+        Args:
+            store_name (str): Name of the dictionary used to track the encoding
+            host (str, optional): Host where the RedisServer is running. Defaults to "localhost".
+            port (int, optional): Port number to be used contating the RedisServer. Defaults to 6379.
+            ex (int, optional): expiration in seconds. Defaults to 3600.
+            connections (int, optional): Connections used to stream the chunks of a value. Defaults to 4.
+            metadata_cache_size (int, optional): Keys kept in the local metadata cache. Defaults to 4096.
+            compression (Dict, optional): Options of the COMPRESSED coding, see DataStorage. Defaults to None.
+        """
+        self.pool = redis.asyncio.ConnectionPool(
+            host=host,
+            port=port,
+            db=0,
+            max_connections=connections + 2,
+            health_check_interval=30,
+            socket_timeout=10,
+            socket_keepalive=True,
+            socket_connect_timeout=10,
+            retry_on_timeout=True,
+        )
+        self.con = redis.asyncio.Redis(connection_pool=self.pool)
+        self.scripts = register_scripts(self.con)
+        self.store_name = store_name
+        self.host = host
+        self.port = port
+        self.expire = ex
+        self.connections = connections
+        self.root_diretory = f"/{self.store_name}/keys"
+        self.index_diretory = f"/{self.store_name}/index"
+        self.queue_diretory = f"/{self.store_name}/queue"
+        self.unique_id_tag = f"/{self.store_name}/id"
+        self.version_tag = f"/{self.store_name}/version"
+        self.chunk_diretory = f"/{self.store_name}/chunk"
+        self.keyname_map = LRUCache(metadata_cache_size)
+        self.chunk_size = 256 * 1024
+        # The file tiers are read from the paths in the metadata
+        self.files = FileTiers(store_name)
+
+        # Build the Serializer Virtual Table
+        self.serializer = build_serializer_table(compression)
+        return
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args) -> None:
+        await self.close()
+        return
+
+    # Private methods
+    def __str__(self) -> str:
+        t = type(self)
+        return f"{t.__name__}({self.store_name},{self.host},{self.port})"
+
+    async def _find_mapped_key(self, key: str):
+        """Find the internal key representation, see DataStorage.__find_mapped_key"""
+        skey = key if type(key) is str else str(key, "utf-8")
+        m = await self._find_metadata(skey)
+        if m is None:
+            return None, None, None, None
+        return m["data"], m["dtsize"], m["coding"], m["chunks"]
+
+    async def _find_metadata(self, skey: str) -> Dict:
+        """Find the metadata of a key, see DataStorage._find_metadata"""
+        metadata = self.keyname_map.get(skey)
+        if metadata is None:
+            k = f"{self.root_diretory}/{skey}"
+            metadata = decode_metadata(
+                await self.con.hmget(k, DataStorage.metadata_fields)
+            )
+            if metadata is not None:
+                self.keyname_map[skey] = metadata
+        return metadata
+
+    def _file_tier(self, metadata: Dict) -> SharedMemoryBackend:
+        """The tier holding a datum in a file, see FileTiers.tier"""
+        if metadata["backend"] == "ref":
+            raise ValueError(
+                f"{metadata['data']} is an object of an in-process store, "
+                "AsyncDataStorage only reaches Redis"
+            )
+        return self.files.tier(metadata)
+
+    def _stripes(self, n_chunks: int) -> List[range]:
+        """Split the chunk indexes into (at most) one contiguous stripe per connection"""
+        n_stripes = max(1, min(self.connections, n_chunks))
+        step = -(-n_chunks // n_stripes)
+        return [range(i, min(i + step, n_chunks)) for i in range(0, n_chunks, step)]
+
+    async def _put_stripe(self, chunks, view, stripe: int, ex: int) -> None:
+        """Upload the chunks of a stripe of the hash layout, with its TTL"""
+        async with self.con.pipeline(transaction=False) as pipe:
+            for this_chunk in range(stripe, len(chunks), len(chunks.keys)):
+                offset = this_chunk * self.chunk_size
+                chunks.queue_store(
+                    pipe, this_chunk, view[offset : offset + self.chunk_size]
+                )
+            pipe.expire(chunks.keys[stripe], ex)
+            await pipe.execute()
+        return
+
+    async def _run_script(self, name: str, keys: List, args: List) -> None:
+        """Run a replace or delete script, then unlink the files of the values it
+        dropped (see FileTiers.collect), in the same round trip"""
+        async with self.con.pipeline() as pipe:
+            await self.scripts[name](keys=keys, args=args, client=pipe)
+            pipe.lrange(self.files.files_tag, 0, -1)
+            pipe.delete(self.files.files_tag)
+            paths = (await pipe.execute())[1]
+        for path in paths:
+            self.files.shm.unlink(path.decode())
+        return
+
+    async def _publish(self, skey: str, metadata: Dict, ex: int) -> None:
+        """Swap the metadata of a key (dropping the value it replaces), see
+        DataStorage._queue_key_metadata"""
+        self.keyname_map[skey] = metadata
+        k = f"{self.root_diretory}/{skey}"
+        fields = [
+            item for f in DataStorage.metadata_fields for item in (f, metadata[f])
+        ]
+        await self._run_script(
+            "replace",
+            [k, self.root_diretory, self.index_diretory],
+            [skey, ex, self.chunk_size, metadata["data"]] + fields,
+        )
+        return
+
+    async def _get_stripe(self, chunks, stripe) -> List:
+        async with self.con.pipeline(transaction=False) as pipe:
+            chunks.queue_fetch(pipe, stripe.start, stripe.stop)
+            replies = await pipe.execute()
+        return chunks.join(replies, stripe.start, stripe.stop)
+
+    async def _refresh(self, keys: List[str], ex: int) -> None:
+        async with self.con.pipeline(transaction=False) as pipe:
+            for key in keys:
+                pipe.expire(key, ex)
+            await pipe.execute()
+        return
+
+    # Public methods
+    async def set(
+        self,
+        key: str,
+        datum: Any,
+        coding: StoreType = StoreType.COMPRESSED,
+        ex: int = None,
+        compression: Dict = None,
+    ) -> None:
+        """Set the memory key with datum, streaming the stripes concurrently
+
+        Args:
+            key (str): User key
+            datum (Any): the datum
+            coding (StoreType, optional): The encoding type to be used. Defaults to StoreType.COMPRESSED.
+            ex (int): expiration in seconds, default to 3600.
+            compression (Dict, optional): Overrides the store compression options for this value. Defaults to None.
+        """
+        ex = ex if ex else self.expire
+        skey = key if type(key) is str else str(key, "utf-8")
+
+        serializer = self.serializer[coding.value]
+        if compression:
+            serializer = serializer.with_options(**compression)
+
+        # Serialization is CPU bound, keep it off the event loop
+        encoded_data = await asyncio.to_thread(serializer.encode, datum)
+
+        # Every version has its own chunks (and a new version makes the DataStorage
+        # readers drop their local copies), see DataStorage.set
+        version = await self.con.incr(self.version_tag)
+        mapped_key = f"{self.chunk_diretory}/{skey}@{version}"
+        s_datum = len(encoded_data)
+        chunks = int(s_datum / self.chunk_size)
+        metadata = build_metadata(mapped_key, s_datum, coding.value, chunks, version)
+        # A hash per connection, chunk n going to stripe n % stripes
+        n_chunks = len(build_chunk_keys(mapped_key, s_datum, chunks, self.chunk_size))
+        metadata["stripes"] = max(1, min(self.connections, n_chunks))
+        chunks = build_chunk_layout(metadata, self.chunk_size)
+
+        # Upload every stripe over its own connection
+        view = memoryview(encoded_data)
+        await asyncio.gather(
+            *[
+                self._put_stripe(chunks, view, stripe, ex)
+                for stripe in range(len(chunks.keys))
+            ]
+        )
+
+        # Publish the metadata only after every chunk is there, the script drops
+        # the previous value (in any layout) atomically
+        await self._publish(skey, metadata, ex)
+        return
+
+    async def get(self, key: str, ex: int = 3600) -> Any:
+        """get a data stored into a key, fetching the chunks concurrently
+
+        Args:
+            key (str): the key to look for
+            ex (int): expiration in seconds, default to 3600.
+
+        Returns:
+            Any: None if not found, the stored value otherwise
+        """
+        skey = key if type(key) is str else str(key, "utf-8")
+        cached = skey in self.keyname_map
+        metadata = await self._find_metadata(skey)
+        if metadata is None:
+            return None
+
+        datum = await self._get_datum(skey, metadata, ex)
+        if datum is None and cached:
+            # Another process may have replaced the key, the metadata in L1 names
+            # chunks (or a file) that are gone: retry with the metadata in the store
+            self.keyname_map.pop(skey, None)
+            return await self.get(skey, ex)
+        return datum
+
+    async def _get_datum(self, skey: str, metadata: Dict, ex: int) -> Any:
+        """Fetch and decode the datum of a key, None if it expired, see get"""
+        coding = metadata["coding"]
+        tier = self._file_tier(metadata)
+        if tier is not None:
+            # Written by a DataStorage on this host, read it from its file
+            await self.con.expire(f"{self.root_diretory}/{skey}", ex)
+            payload = tier.read(metadata["data"])
+            if payload is None:
+                return None
+            return await asyncio.to_thread(self.serializer[coding].decode, payload)
+
+        # The chunks in any layout, a TTL per key holding them
+        chunks = build_chunk_layout(metadata, self.chunk_size)
+        stripes = await asyncio.gather(
+            *[
+                self._get_stripe(chunks, stripe)
+                for stripe in self._stripes(len(chunks))
+            ],
+            self._refresh(chunks.keys + [f"{self.root_diretory}/{skey}"], ex),
+        )
+
+        buffers = [buffer for stripe in stripes[:-1] for buffer in stripe]
+        # A missing chunk means the datum expired underneath us
+        if any(buffer is None for buffer in buffers):
+            return None
+
+        return await asyncio.to_thread(
+            self.serializer[coding].decode, b"".join(buffers)
+        )
+
+    async def get_keys(self, wkey: str) -> List:
+        """Retrung arbitrary filtered key list from the storage memory
+
+        Args:
+            wkey (str): key wildcard
+
+        Returns:
+            List: List with keys found into the storage (using the wildcard key)
+        """
+        key_set = await self.con.smembers(self.root_diretory)
+        decoded_keys = [i.decode() for i in sorted(list(key_set))]
+        return fnmatch.filter(decoded_keys, wkey)
+
+    async def enqueue(
+        self,
+        key: str,
+        datum: Any,
+        coding: StoreType = StoreType.COMPRESSED,
+        ex: int = 3600,
+    ) -> None:
+        """Enqueue a datum into a queue
+
+        Args:
+            key (str): key is the queue name
+            datum (Any): datum to be enqueued
+            coding (StoreType, optional): The encoding type to be used. Defaults to StoreType.COMPRESSED.
+        """
+        skey = key if type(key) is str else str(key, "utf-8")
+        mapped_key = f"/{self.store_name}/data/{skey}"
+        k = f"{self.root_diretory}/{skey}"
+
+        encoded_data = self.serializer[coding.value].encode(datum)
+
+        async with self.con.pipeline() as pipe:
+            pipe.rpush(mapped_key, encoded_data)
+            pipe.expire(mapped_key, ex)
+            pipe.expire(k, ex)
+            metadata_found = (await pipe.execute())[-1]
+
+        if not metadata_found or skey not in self.keyname_map:
+            # A new queue (or one whose metadata expired), the script keeps the
+            # items just pushed
+            metadata = build_metadata(mapped_key, coding=coding.value)
+            await self._publish(skey, metadata, ex)
+        return
+
+    async def dequeue(
+        self, key: str, coding: StoreType = StoreType.COMPRESSED, timeout: int = 0
+    ) -> Any:
+        """Dequeue an item from the queue
+
+        Args:
+            key (str): key is the queue name
+            timeout (int, optional): Timeout in seconds (if the queue is empty). Defaults to 0 that means: wait for ever.
+
+        Returns:
+            Any: The datum dequeued from the queue, otherwise None
+        """
+        mapped_key, data_size, coding, chunks = await self._find_mapped_key(key)
+
+        if mapped_key is None:
+            return None
+
+        # Only the connection running the BLPOP blocks, the loop keeps going
+        item = await self.con.blpop(mapped_key, timeout)
+        if item:
+            return self.serializer[coding].decode(item[1])
+        return item
+
+    async def delete_queue(self, key: str) -> None:
+        await self.delete(key)
+        return
+
+    async def delete(self, key: str) -> None:
+        skey = key if type(key) is str else str(key, "utf-8")
+        metadata = await self._find_metadata(skey)
+
+        if metadata:
+            # The script drops the value in any layout (releasing the shared
+            # content-addressed chunks), see DataStorage._queue_key_data_delete
+            k = f"{self.root_diretory}/{skey}"
+            await self._run_script(
+                "delete",
+                [k, self.root_diretory, self.index_diretory],
+                [skey, self.chunk_size],
+            )
+            self.keyname_map.pop(skey, None)
+        return
+
+    async def close(self) -> None:
+        """Close the client and drop every pooled connection"""
+        await self.con.aclose()
+        await self.pool.disconnect()
+        return
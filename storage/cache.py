@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+
+""" cache.py. Local caches for the External Data Storage (@) 2022
+This module provides the bounded LRU map used by DataStorage to keep key
+metadata (L1), and the map of decoded values (L2) in the worker process.
+This program is free software: you can redistribute it and/or modify it under
+the terms of the GNU General Public License as published by the Free Software
+Foundation, either version 3 of the License, or (at your option) any later
+version.
+This program is distributed in the hope that it will be useful, but WITHOUT
+ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+You should have received a copy of the GNU General Public License along with
+this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+
+# COPYRIGHT SECTION
+__author__ = "Diego Carvalho"
+__copyright__ = "Copyright 2022"
+__credits__ = ["Diego Carvalho"]
+__license__ = "GPL"
+__version__ = "1.0.1"
+__maintainer__ = "Diego Carvalho"
+__email__ = "d.carvalho@ieee.org"
+__status__ = "Research"
+
+import threading
+import pickle
+from collections import OrderedDict
+from typing import Any, Callable
+
+
+def estimate_size(datum: Any) -> int:
+    """A cheap estimate of the in-memory size of a datum (buffers, arrays and data
+    frames), 0 when it is not known
+    """
+    if isinstance(datum, (bytes, bytearray, memoryview)):
+        return memoryview(datum).nbytes
+    if hasattr(datum, "memory_usage"):
+        # pandas: a Series per column for a DataFrame, an int for a Series
+        usage = datum.memory_usage(index=True)
+        return int(usage.sum() if hasattr(usage, "sum") else usage)
+    return int(getattr(datum, "nbytes", 0))
+
+
+def copy_value(datum: Any) -> Any:
+    """A copy of a datum its holder may mutate: immutable values are shared, arrays
+    and data frames are copied with their copy method, anything else goes through
+    pickle (several times faster than deepcopy on lists and dicts)
+    """
+    if isinstance(datum, (bytes, str, int, float, complex, type(None))):
+        return datum
+    if hasattr(datum, "nbytes") or hasattr(datum, "memory_usage"):
+        return datum.copy()
+    return pickle.loads(pickle.dumps(datum, pickle.HIGHEST_PROTOCOL))
+
+
+class LRUCache(object):
+    """A dict-like map bounded by the total weight of its values.
+
+    Every entry has a weight (1 by default, so capacity counts entries). When the
+    total weight goes over the capacity the least recently used entries are
+    evicted. Entries heavier than the whole capacity are never kept.
+
+    Every operation holds a lock, so the map can be shared by the threads of a
+    worker. The values are not copied: the objects handed out are the cached ones,
+    and must not be mutated by the callers.
+    """
+
+    def __init__(self, capacity: int, weigh: Callable = None) -> None:
+        self.capacity = capacity
+        self.weigh = weigh if weigh else (lambda value: 1)
+        self.weight = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._data = OrderedDict()
+        self._lock = threading.RLock()
+        return
+
+    def __repr__(self) -> str:
+        return f"{self.__class__.__name__}({len(self._data)}, {self.weight}/{self.capacity})"
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def __contains__(self, key: str) -> bool:
+        return key in self._data
+
+    def __getitem__(self, key: str) -> Any:
+        with self._lock:
+            value, weight = self._data[key]
+            self._data.move_to_end(key)
+            return value
+
+    def __setitem__(self, key: str, value: Any) -> None:
+        weight = self.weigh(value)
+        with self._lock:
+            self.pop(key, None)
+            if weight > self.capacity:
+                return
+            self._data[key] = (value, weight)
+            self.weight += weight
+            self._evict()
+        return
+
+    def _evict(self) -> None:
+        while self.weight > self.capacity:
+            _, (_, evicted_weight) = self._data.popitem(last=False)
+            self.weight -= evicted_weight
+            self.evictions += 1
+        return
+
+    def resize(self, capacity: int) -> None:
+        """Change the capacity, evicting entries if it shrinks"""
+        with self._lock:
+            self.capacity = capacity
+            self._evict()
+        return
+
+    def get(self, key: str, default: Any = None) -> Any:
+        """Return the value of key (refreshing its recency) and count the hit or miss"""
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def pop(self, key: str, default: Any = None) -> Any:
+        with self._lock:
+            entry = self._data.pop(key, None)
+            if entry is None:
+                return default
+            self.weight -= entry[1]
+            return entry[0]
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+            self.weight = 0
+        return
+
+    def items(self):
+        with self._lock:
+            return [(k, v) for k, (v, _) in self._data.items()]
+
+
+class ValueCache(LRUCache):
+    """The decoded values of the keys (L2), bounded by their size in bytes.
+
+    An entry is (version, datum, size), tagged with the version the datum was read
+    or written at, so a reader can tell it from the one in the metadata hash. The
+    datum is a copy of the one put, and hits must be handed out as copies too (see
+    copy_value), the callers own what they get and set.
+    """
+
+    def __init__(self, capacity: int) -> None:
+        super().__init__(capacity, weigh=lambda entry: entry[2])
+        return
+
+    def put(self, skey: str, version: int, datum: Any, size: int) -> None:
+        """Keep a datum (nothing when the cache is disabled), weighing its in-memory
+        size (see estimate_size), or its encoded size when that is not known"""
+        if self.capacity > 0:
+            self[skey] = (version, copy_value(datum), estimate_size(datum) or size)
+        return
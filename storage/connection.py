@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+
+""" connection.py. Redis clients of the External Data Storage (@) 2022
+This module picks the client a DataStorage talks to: the in-process store, a
+single Redis server, or several of them sharing the chunks (see sharding). The
+clients are built over the connection pools of the process (see pool), and an
+existing client is kept while it still talks to the same servers.
+This program is free software: you can redistribute it and/or modify it under
+the terms of the GNU General Public License as published by the Free Software
+Foundation, either version 3 of the License, or (at your option) any later
+version.
+This program is distributed in the hope that it will be useful, but WITHOUT
+ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+You should have received a copy of the GNU General Public License along with
+this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+
+# COPYRIGHT SECTION
+__author__ = "Diego Carvalho"
+__copyright__ = "Copyright 2022"
+__credits__ = ["Diego Carvalho"]
+__license__ = "GPL"
+__version__ = "1.0.1"
+__maintainer__ = "Diego Carvalho"
+__email__ = "d.carvalho@ieee.org"
+__status__ = "Research"
+
+import os
+from typing import Any, List, Tuple
+
+import redis
+
+from .inprocess import InProcessRedis
+from .pool import connection_pool
+from .sharding import ShardedRedis, endpoint_name, parse_endpoints
+
+
+def store_endpoints(
+    endpoints: List = None, host: str = "localhost", port: int = 6379
+) -> List[Tuple[str, int]]:
+    """The Redis servers of a store, see parse_endpoints
+
+    Args:
+        endpoints (List, optional): the servers. Defaults to the DATASTORAGE_ENDPOINTS
+            environment variable (comma separated), or [(host, port)].
+        host (str, optional): Host of the only server. Defaults to "localhost".
+        port (int, optional): Port of the only server. Defaults to 6379.
+
+    Returns:
+        List[Tuple[str, int]]: the (host, port) pairs, the first one holds the keys
+            that are not chunks
+    """
+    if endpoints is None:
+        endpoints = os.environ.get("DATASTORAGE_ENDPOINTS", [(host, port)])
+    return parse_endpoints(endpoints)
+
+
+def connect(backend: str, endpoints: List[Tuple[str, int]], con: Any = None) -> Any:
+    """The client of a store
+
+    Args:
+        backend (str): "inprocess" for the store of this process, any other backend
+            talks to Redis
+        endpoints (List[Tuple[str, int]]): the servers, see store_endpoints
+        con (Any, optional): the client in use. Defaults to None.
+
+    Returns:
+        Any: con itself when it already talks to those servers, an InProcessRedis,
+            a redis.Redis (a single server) or a ShardedRedis otherwise
+    """
+    if backend == "inprocess":
+        return InProcessRedis.instance()
+    pools = [connection_pool(host, port) for host, port in endpoints]
+    if isinstance(con, ShardedRedis):
+        connected = con.pools
+    else:
+        connected = [getattr(con, "connection_pool", None)]
+    if connected == pools:
+        return con
+    if len(pools) == 1:
+        return redis.Redis(connection_pool=pools[0])
+    return ShardedRedis(
+        [redis.Redis(connection_pool=pool) for pool in pools],
+        [endpoint_name(endpoint) for endpoint in endpoints],
+    )
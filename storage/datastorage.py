@@ -24,23 +24,41 @@ __maintainer__ = "Diego Carvalho"
 __email__ = "d.carvalho@ieee.org"
 __status__ = "Research"
 
+import io
+import os
+import re
 import sys
 import fnmatch
-from io import BytesIO
 from enum import Enum
-from typing import Any, List
+from typing import Any, Dict, Iterable, Iterator, List, Tuple
 
 from functools import lru_cache
 
-import redis
-
-from aioredis.client import Pipeline
-
+from redis.client import Pipeline
+
+from .cache import LRUCache, ValueCache, copy_value, estimate_size
+from .connection import connect, store_endpoints
+from .dedup import ContentStore
+from .instrumentation import (
+    NULL_MEASUREMENT,
+    Measurement,
+    OperationStats,
+    measure,
+    process_metrics,
+)
+from .parallel import ParallelIO
+from .pool import pool_statistics
+from .scripts import DIGEST_SIZE, register_scripts
+from .sharding import ShardedRedis
+from .tiers import FileTiers
+from .stream import ChunkReader, ChunkWriter, HashChunks, KeyChunks
 from tools.serializer import (
+    ArrowSerializer,
     CloudPicklerSerializer,
     CompactedPicklerSerializer,
     NoneSerializer,
     PicklerSerializer,
+    ViewReader,
 )
 
 
@@ -49,6 +67,105 @@ class StoreType(Enum):
     PLAIN = 1
     COMPRESSED = 2
     CODE = 3
+    ARROW = 4
+
+
+def build_serializer_table(compression: Dict = None) -> Dict:
+    """Build the Serializer Virtual Table, indexed by StoreType value
+
+    Args:
+        compression (Dict, optional): CompactedPicklerSerializer options (cname, clevel,
+            shuffle, typesize, nthreads, ...). Defaults to None (blosclz, byte shuffle).
+    """
+    serializer = dict()
+    serializer[StoreType.NONE.value] = NoneSerializer()
+    serializer[StoreType.PLAIN.value] = PicklerSerializer()
+    serializer[StoreType.COMPRESSED.value] = CompactedPicklerSerializer(
+        **(compression if compression else dict())
+    )
+    serializer[StoreType.CODE.value] = CloudPicklerSerializer()
+    serializer[StoreType.ARROW.value] = ArrowSerializer()
+    return serializer
+
+
+def decode_metadata(ext_data: List) -> Dict:
+    """Decode the raw HMGET answer of a metadata hash (None if the key is not there)"""
+    if ext_data is None or ext_data[0] is None:
+        return None
+    # Map it from the ext_coding info
+    return {
+        "data": ext_data[0].decode(),
+        "dtsize": int(ext_data[1].decode()),
+        "coding": int(ext_data[2].decode()),
+        "chunks": int(ext_data[3].decode()),
+        "version": int(ext_data[4].decode()) if ext_data[4] is not None else 0,
+        "backend": ext_data[5].decode() if ext_data[5] is not None else "redis",
+        "manifest": ext_data[6].decode() if ext_data[6] is not None else "",
+        "stripes": int(ext_data[7].decode()) if ext_data[7] is not None else 0,
+    }
+
+
+def build_metadata(
+    mapped_key: str,
+    dtsize: int = 0,
+    coding: int = StoreType.COMPRESSED.value,
+    chunks: int = 0,
+    version: int = 0,
+    backend: str = "redis",
+    manifest: str = "",
+    stripes: int = 0,
+) -> Dict:
+    """Build the metadata of a key, as stored in its hash in the directory"""
+    return {
+        "data": mapped_key,
+        "dtsize": dtsize,
+        "coding": coding,
+        "chunks": chunks,
+        "version": version,
+        "backend": backend,
+        "manifest": manifest,
+        "stripes": stripes,
+    }
+
+
+def build_chunk_keys(
+    mapped_key: str, dtsize: int, chunks: int, chunk_size: int
+) -> List[str]:
+    """Build the list of chunk keys holding a datum (full chunks plus the tail)"""
+    n_keys = chunks + (1 if int(dtsize % chunk_size) > 0 else 0)
+    return [f"{mapped_key}:{this_chunk}" for this_chunk in range(n_keys)]
+
+
+def build_chunk_layout(metadata: Dict, chunk_size: int):
+    """Where the chunks of a datum live in Redis (see stream.HashChunks and KeyChunks)
+
+    Args:
+        metadata (Dict): the key metadata
+        chunk_size (int): size in bytes of a chunk
+
+    Returns:
+        KeyChunks or HashChunks: the chunks, none when the datum lives in a file
+    """
+    if metadata["backend"] in ("shm", "disk"):
+        return KeyChunks(list())
+    if metadata["backend"] == "ref":
+        # The object itself, in the data key of the in-process backend
+        return KeyChunks([metadata["data"]])
+    if metadata["backend"] == "cas":
+        store, manifest = metadata["data"].split("/")[1], metadata["manifest"]
+        return KeyChunks(
+            [
+                f"/{store}/cas/{manifest[i : i + DIGEST_SIZE]}"
+                for i in range(0, len(manifest), DIGEST_SIZE)
+            ]
+        )
+    chunk_keys = build_chunk_keys(
+        metadata["data"], metadata["dtsize"], metadata["chunks"], chunk_size
+    )
+    if metadata["stripes"] > 0:
+        return HashChunks(metadata["data"], len(chunk_keys), metadata["stripes"])
+    # Written before the hash layout (or by AsyncDataStorage), a key per chunk
+    return KeyChunks(chunk_keys)
 
 
 class Borg:
@@ -60,9 +177,40 @@ class Borg:
 
 class DataStorage(Borg):
 
+    # Fields of the metadata hash kept for every key in the directory
+    metadata_fields = [
+        "data",
+        "dtsize",
+        "coding",
+        "chunks",
+        "version",
+        "backend",
+        "manifest",
+        "stripes",
+    ]
+
     # Constructor
     def __init__(
-        self, store_name: str, host: str = "localhost", port: int = 6379, ex: int = 3600
+        self,
+        store_name: str,
+        host: str = "localhost",
+        port: int = 6379,
+        ex: int = 3600,
+        cache_size: int = 0,
+        metadata_cache_size: int = 4096,
+        backend: str = None,
+        shm_threshold: int = 1024 * 1024,
+        shm_dir: str = "/dev/shm",
+        stream_window: int = 64,
+        compression: Dict = None,
+        instrument: bool = None,
+        dedup: bool = None,
+        endpoints: List = None,
+        spill_dir: str = None,
+        spill_watermark: float = 0.8,
+        spill_threshold: int = 1024 * 1024,
+        parallelism: int = None,
+        parallel_threshold: int = 16 * 1024 * 1024,
     ) -> None:
         """DataStorage Constructor
 
@@ -70,35 +218,113 @@ class DataStorage(Borg):
             store_name (str): Name of the dictionary used to track the encoding
             host (str, optional): Host where the RedisServer is running. Defaults to "localhost".
             port (int, optional): Port number to be used contating the RedisServer. Defaults to 6379.
+            ex (int, optional): expiration in seconds. Defaults to 3600.
+            cache_size (int, optional): Bytes of decoded values kept in the local L2 cache (their in-memory size,
+                see estimate_size); a hit hands out a copy of the cached value (see copy_value). Defaults
+                to 0 (disabled).
+            metadata_cache_size (int, optional): Keys kept in the local L1 metadata cache. Defaults to 4096.
+            backend (str, optional): "redis", "shm" to keep large values in shared memory (single host only), or
+                "inprocess" to keep every value, by reference, in this process (threads only, no redis-server).
+                Defaults to the DATASTORAGE_BACKEND environment variable, or "redis".
+            shm_threshold (int, optional): Encoded size from which values go to shared memory. Defaults to 1 MiB.
+            shm_dir (str, optional): tmpfs directory holding the shared memory values. Defaults to "/dev/shm".
+            stream_window (int, optional): Chunks moved per round trip when streaming a value. Defaults to 64.
+            compression (Dict, optional): Options of the COMPRESSED coding, e.g. {"cname": "zstd", "clevel": 5,
+                "nthreads": 4}, or {"cname": "auto"} to pick the codec on a sample of every value. Defaults to None.
+            instrument (bool, optional): Record the latency, phases and bytes of every operation (see collect_metrics).
+                Defaults to the DATASTORAGE_INSTRUMENT environment variable ("1" turns it on), or False.
+            dedup (bool, optional): Store the chunks by content (hash), shared and reference counted, so identical
+                chunks are uploaded and kept once (see dedup_statistics). Defaults to the DATASTORAGE_DEDUP
+                environment variable ("1" turns it on), or False.
+            endpoints (List, optional): Redis servers, as "host:port" or (host, port), or unix sockets as
+                "unix:///path" (see RedisServer.endpoints), the chunks of the values are spread over them by
+                consistent hashing and every other key stays on the first one. Defaults to the
+                DATASTORAGE_ENDPOINTS environment variable (comma separated), or [(host, port)].
+            spill_dir (str, optional): Local directory of the disk tier: while Redis uses more than spill_watermark
+                of its memory (INFO), large values are written there, compressed, and only their metadata stays in
+                Redis (single host only). Defaults to the DATASTORAGE_SPILL_DIR environment variable, or None (off).
+            spill_watermark (float, optional): Share of maxmemory (or of the host memory when Redis has no limit)
+                from which values are spilled. Defaults to 0.8.
+            spill_threshold (int, optional): Encoded size from which values may be spilled. Defaults to 1 MiB.
+            parallelism (int, optional): Threads (and connections) moving a large value: its frames are compressed
+                in parallel while the chunks already encoded are uploaded, a stripe per connection, and it is read
+                back the same way. Defaults to the DATASTORAGE_PARALLELISM environment variable, or 1 (off).
+            parallel_threshold (int, optional): In-memory size (see estimate_size) from which a value is moved in
+                parallel. Defaults to 16 MiB.
         """
         super().__init__()
-        # Init object's local status
-        self.con = redis.Redis(
-            host=host,
-            port=port,
-            db=0,
-            health_check_interval=30,
-            socket_timeout=10,
-            socket_keepalive=True,
-            socket_connect_timeout=10,
-            retry_on_timeout=True,
+        self.backend = (
+            backend if backend else os.environ.get("DATASTORAGE_BACKEND", "redis")
         )
+        # Init object's local status, the client (and its sockets) is kept while
+        # the shared state still points to the pool of this process
+        if self.backend != "inprocess":
+            endpoints = store_endpoints(endpoints, host, port)
+            host, port = endpoints[0]
+        con = connect(self.backend, endpoints, getattr(self, "con", None))
+        if con is not getattr(self, "con", None):
+            self.con = con
+            self.scripts = register_scripts(con, isinstance(con, ShardedRedis))
+            # Whether the server takes EXPIRE ... GT, asked on first use
+            self.expire_gt = True if self.backend == "inprocess" else None
+        self.sharded = isinstance(self.con, ShardedRedis)
+        # Hashes holding the chunks of a value, one per server
+        self.stripes = len(self.con.clients) if self.sharded else 1
         self.store_name = store_name
         self.host = host
         self.port = port
         self.expire = ex
         self.root_diretory = f"/{self.store_name}/keys"
+        self.index_diretory = f"/{self.store_name}/index"
         self.queue_diretory = f"/{self.store_name}/queue"
+        # The chunks of the values, the only keys a sharded store spreads (with the
+        # content-addressed ones, see sharding)
+        self.chunk_diretory = f"/{self.store_name}/chunk"
         self.unique_id_tag = f"/{self.store_name}/id"
-        self.keyname_map = dict()
-        self.serializer = dict()
+        self.version_tag = f"/{self.store_name}/version"
+        self.garbage_tag = f"/{self.store_name}/garbage"
         self.chunk_size = 256 * 1024
+        self.stream_window = stream_window
+
+        # The tiers keeping large values in files on this host
+        if spill_dir is None:
+            spill_dir = os.environ.get("DATASTORAGE_SPILL_DIR")
+        self.files = FileTiers(
+            store_name,
+            self.backend == "shm",
+            shm_dir,
+            shm_threshold,
+            spill_dir,
+            spill_watermark,
+            spill_threshold,
+            previous=getattr(self, "files", None),
+        )
+        if dedup is None:
+            dedup = os.environ.get("DATASTORAGE_DEDUP", "0") == "1"
+        self.dedup = dedup
+        self.cas = ContentStore(store_name)
+        if parallelism is None:
+            parallelism = int(os.environ.get("DATASTORAGE_PARALLELISM", "1"))
+        self.parallel = ParallelIO(
+            parallelism, parallel_threshold, previous=getattr(self, "parallel", None)
+        )
+
+        # Every app builds its own DataStorage, so the local caches survive a new
+        # construction on the same store and are only resized here
+        if getattr(self, "cache_store_name", None) != store_name:
+            self.keyname_map = LRUCache(metadata_cache_size)
+            self.value_cache = ValueCache(cache_size)
+            self.cache_store_name = store_name
+        self.keyname_map.resize(metadata_cache_size)
+        self.value_cache.resize(cache_size)
+
+        # The metrics of the process also survive a new construction
+        if instrument is None:
+            instrument = os.environ.get("DATASTORAGE_INSTRUMENT", "0") == "1"
+        self.metrics = process_metrics(instrument, getattr(self, "metrics", None))
 
         # Build the Serializer Virtual Table
-        self.serializer[StoreType.NONE.value] = NoneSerializer()
-        self.serializer[StoreType.PLAIN.value] = PicklerSerializer()
-        self.serializer[StoreType.COMPRESSED.value] = CompactedPicklerSerializer()
-        self.serializer[StoreType.CODE.value] = CloudPicklerSerializer()
+        self.serializer = build_serializer_table(compression)
         return
 
     # Private methods
@@ -119,31 +345,113 @@ class DataStorage(Borg):
             str: returns a pair with (mapped_key, coding value) or (None, None) if it fails
         """
 
-        # Check if the key is already on L1 cache
         skey = key if type(key) is str else str(key, "utf-8")
-        if skey not in self.keyname_map:
-            # So, fetch the key from external store
-            k = f"{self.root_diretory}/{skey}"
-            ext_data = self.con.hmget(k, ["data", "dtsize", "coding", "chunks"])
-            if ext_data is None or ext_data[0] is None:
-                # Here, the key is not outthere, so None will be returned
-                return None, None, None, None
-            else:
-                # Happy, since the key is outthere. Map it from the ext_coding info
-                self.keyname_map[skey] = {
-                    "data": ext_data[0].decode(),
-                    "dtsize": int(ext_data[1].decode()),
-                    "coding": int(ext_data[2].decode()),
-                    "chunks": int(ext_data[3].decode()),
-                }  # Update L1 metadata cache
+        metadata = self._find_metadata(skey)
+        if metadata is None:
+            # Here, the key is not outthere, so None will be returned
+            return None, None, None, None
         # The coding is already here, build a mapped key and its coding
-        mapped_key = self.keyname_map[skey]["data"]
-        dtsize = self.keyname_map[skey]["dtsize"]
-        coding = self.keyname_map[skey]["coding"]
-        chunks = self.keyname_map[skey]["chunks"]
+        mapped_key = metadata["data"]
+        dtsize = metadata["dtsize"]
+        coding = metadata["coding"]
+        chunks = metadata["chunks"]
 
         return mapped_key, dtsize, coding, chunks
 
+    def _find_metadata(self, skey: str) -> Dict:
+        """Find the metadata of a key in L1, fetching it from the external store on a miss
+
+        Args:
+            skey (str): the user key representation
+
+        Returns:
+            Dict: the metadata, None if the key is not in the store
+        """
+        # Check if the key is already on L1 cache
+        metadata = self.keyname_map.get(skey)
+        if metadata is not None:
+            return metadata
+        # So, fetch the key from external store
+        k = f"{self.root_diretory}/{skey}"
+        return self._cache_metadata(skey, self.con.hmget(k, self.metadata_fields))
+
+    def _reload_metadata(self, skey: str) -> Dict:
+        """Drop the L1 entry of a key and fetch its metadata from the external store
+
+        The metadata in L1 is stale once another process replaced the key: the
+        chunks (or the file) of the version it names are gone.
+        """
+        self.keyname_map.pop(skey, None)
+        return self._find_metadata(skey)
+
+    def __find_mapped_keys(self, keys: List[str]) -> Dict[str, Dict]:
+        """Find the internal key representation of many keys at once
+
+        Keys missing from L1 are fetched from the external store in a single
+        pipelined round trip.
+
+        Args:
+            keys (List[str]): the user key representations
+
+        Returns:
+            Dict[str, Dict]: maps every str key to its metadata (None if not found)
+        """
+        skeys = [k if type(k) is str else str(k, "utf-8") for k in keys]
+        mapping = {k: self.keyname_map.get(k) for k in skeys}
+        missing = [k for k in skeys if mapping[k] is None]
+        if missing:
+            with self.con.pipeline(transaction=False) as pipe:
+                for skey in missing:
+                    pipe.hmget(f"{self.root_diretory}/{skey}", self.metadata_fields)
+                for skey, ext_data in zip(missing, pipe.execute()):
+                    mapping[skey] = self._cache_metadata(skey, ext_data)
+
+        return mapping
+
+    def _cache_metadata(self, skey: str, ext_data: List) -> Dict:
+        """Decode a metadata hash fetched from the external store into L1
+
+        Args:
+            skey (str): the user key representation
+            ext_data (List): the raw HMGET answer for the metadata fields
+
+        Returns:
+            Dict: the metadata, None if the key is not in the external store
+        """
+        metadata = decode_metadata(ext_data)
+        if metadata is not None:
+            # Happy, since the key is outthere. Update L1 metadata cache
+            self.keyname_map[skey] = metadata
+        return metadata
+
+    def _expire_gt(self) -> bool:
+        """Whether the server takes EXPIRE ... GT (Redis 7.0 or later), see pin"""
+        if self.expire_gt is None:
+            version = self.con.info("server").get("redis_version", "0")
+            self.expire_gt = tuple(map(int, version.split(".")[:2])) >= (7, 0)
+        return self.expire_gt
+
+    def _queue_refresh(self, pipe: Pipeline, keys: List[str], ex: int) -> None:
+        """Queue the TTL refresh of keys read, which never shortens a pinned key"""
+        gt = self._expire_gt()
+        for key in keys:
+            pipe.expire(key, ex, gt=gt)
+        return
+
+    def _parallel(self, datum: Any) -> bool:
+        """Whether a datum is written in parallel (see parallelism), only the Redis
+        layout without dedup is"""
+        return (
+            self.backend == "redis"
+            and not self.dedup
+            and self.parallel.writes(datum)
+            and not self.files.spilling(self.con)
+        )
+
+    def _chunks(self, metadata: Dict):
+        """Where the chunks of a datum live in Redis, see build_chunk_layout"""
+        return build_chunk_layout(metadata, self.chunk_size)
+
     def _key_data_update(
         self,
         key: str,
@@ -151,71 +459,294 @@ class DataStorage(Borg):
         coding: StoreType,
         pipe: Pipeline,
         ex: int,
-        update_func,
-    ):
+        version: int,
+        compression: Dict = None,
+        m: Measurement = NULL_MEASUREMENT,
+    ) -> int:
+        skey = key if type(key) is str else str(key, "utf-8")
+        if self.backend == "inprocess":
+            # Nothing leaves the process, keep the object instead of its encoding
+            mapped_key = f"{self.chunk_diretory}/{skey}@{version}"
+            metadata = build_metadata(mapped_key, 0, coding.value, 0, version, "ref")
+            pipe.set(mapped_key, datum, ex=ex)
+            self._queue_key_metadata(skey, metadata, pipe, ex)
+            return 0
+
         # Creates a internal key representation with User's key and Store Type Encoding
-        encoded_data = self.serializer[coding.value].encode(datum)
+        serializer = self.serializer[coding.value]
+        if compression:
+            serializer = serializer.with_options(**compression)
+        with m.phase("serialize"):
+            encoded_data = serializer.encode(datum)
 
         s_datum = len(encoded_data)
         chunks = int(s_datum / self.chunk_size)
-        tail_size = int(s_datum % self.chunk_size)
 
-        skey = key if type(key) is str else str(key, "utf-8")
-        mapped_key = f"/{self.store_name}/data/{skey}"
+        # Every version has its own chunks, so the previous value stays readable
+        # until the metadata is swapped
+        mapped_key = f"{self.chunk_diretory}/{skey}@{version}"
+
+        # Large values may go to a file tier, only the metadata stays in Redis (the
+        # disk tier compresses them, unless the coding already does)
+        placed = self.files.place(
+            self.con, skey, version, encoded_data, coding != StoreType.COMPRESSED
+        )
+        if placed is not None:
+            path, backend = placed
+            metadata = build_metadata(path, s_datum, coding.value, 0, version, backend)
+        else:
+            metadata = build_metadata(mapped_key, s_datum, coding.value, chunks, version)
+            # A hash per stripe, chunk n going to stripe n % stripes
+            n_chunks = len(self._chunks(metadata))
+            metadata["stripes"] = min(self.stripes, max(1, n_chunks))
+
+        self._measure_value(m, metadata, encoded_data)
+
+        # Queue every chunk (and the TTLs) into the pipeline, slicing the encoded
+        # buffer without copying it
+        view = memoryview(encoded_data)
+        if self.dedup and metadata["backend"] == "redis":
+            with m.phase("network"):
+                metadata = self.cas.queue_chunks(
+                    self.con,
+                    self.scripts["cas_acquire"],
+                    metadata,
+                    view,
+                    self.chunk_size,
+                    pipe,
+                    ex,
+                )
+        elif metadata["backend"] == "redis":
+            chunks = self._chunks(metadata)
+            for this_chunk in range(len(chunks)):
+                offset = this_chunk * self.chunk_size
+                chunks.queue_store(
+                    pipe, this_chunk, view[offset : offset + self.chunk_size]
+                )
+            chunks.queue_expire(pipe, ex)
+
+        # Store the metadata and update the central directory
+        self._queue_key_metadata(skey, metadata, pipe, ex)
+        return s_datum
+
+    def _key_data_stream(
+        self,
+        skey: str,
+        datum: Any,
+        coding: StoreType,
+        ex: int,
+        version: int,
+        compression: Dict = None,
+        m: Measurement = NULL_MEASUREMENT,
+    ) -> int:
+        """Encode a large datum straight into Redis, see parallelism
 
-        self.keyname_map[skey] = {
-            "data": mapped_key,
-            "dtsize": s_datum,
-            "coding": coding.value,
-            "chunks": chunks,
-        }
-
-        # Encode and Store the datum into the set key. Update the key map store
-        for kk, vv in self.keyname_map[skey].items():
-            k = f"{self.root_diretory}/{skey}"
-            pipe.hset(k, kk, vv)
-        pipe.expire(k, ex)
-
-        with BytesIO(encoded_data) as stream:
-            # Read every chunch from the DataStore
-            for this_chunk in range(chunks):
-                self.con.expire(f"{mapped_key}:{this_chunk}", self.expire)
-                buffer = stream.read(self.chunk_size)
-                update_func(f"{mapped_key}:{this_chunk}", buffer)
-            # Read the tail from the DataStore
-            if tail_size > 0:
-                self.con.expire(f"{mapped_key}:{chunks}", self.expire)
-                buffer = stream.read(tail_size)
-                update_func(f"{mapped_key}:{chunks}", buffer)
-
-        # Update the central directory
-        pipe.sadd(self.root_diretory, key)
-        # Execute the communication pipeline
+        The encoded bytes go to a parallel ChunkWriter: the worker threads compress
+        the frames (COMPRESSED coding) and upload the chunks already compressed, so
+        both overlap, and the value is published once every chunk is there.
+
+        Returns:
+            int: the encoded size
+        """
+        serializer = self.serializer[coding.value]
+        options = dict(compression) if compression else dict()
+        if hasattr(serializer, "executor"):
+            options["executor"] = self.parallel.workers()
+        serializer = serializer.with_options(**options)
+
+        writer = self._chunk_writer(skey, coding, ex, version, parallel=True)
+        with m.phase("serialize"):
+            serializer.dump(datum, writer)
+        with m.phase("network"):
+            writer.close()
+        # The in-memory size stands for the raw one, the encoding never sits whole
+        m.add(writer.size, estimate_size(datum), writer.n_chunks)
+        return writer.size
+
+    def _queue_key_metadata(
+        self, skey: str, metadata: Dict, pipe: Pipeline, ex: int
+    ) -> None:
+        """Queue the script publishing a key: its metadata hash and directory entry
+
+        The script swaps the metadata atomically and unlinks the chunks of the value
+        it replaces, so readers see either the previous value or the new one.
+
+        Args:
+            skey (str): the user key
+            metadata (Dict): the key metadata
+            pipe (Pipeline): the pipeline collecting the commands
+            ex (int): expiration in seconds
+        """
+        self.keyname_map[skey] = metadata
+        k = f"{self.root_diretory}/{skey}"
+        fields = [item for f in self.metadata_fields for item in (f, metadata[f])]
+        self.scripts["replace"](
+            keys=[k, self.root_diretory, self.index_diretory],
+            args=[skey, ex, self.chunk_size, metadata["data"]] + fields,
+            client=pipe,
+        )
         return
 
-    def _key_data_get(self, key: str, get_func) -> Any:
-        # Get the internal key representation
-        mapped_key, data_size, coding, chunks = self.__find_mapped_key(key)
+    def _collect_garbage(self, batch: int = 1000) -> None:
+        """Unlink the chunks dropped by the scripts of a sharded store (see
+        ShardedRedis.collect_garbage), and the files dropped from a file tier (see
+        FileTiers.collect)
 
-        # Check if there is a datum named key in the DataStore
-        if mapped_key is None:
+        Args:
+            batch (int, optional): keys or files taken per round trip. Defaults to 1000.
+        """
+        self.files.collect(self.con, batch)
+        if self.sharded:
+            self.con.collect_garbage(self.garbage_tag, batch)
+        return
+
+    def _cache_value(self, skey: str, version: int, datum: Any, size: int) -> None:
+        """Keep a decoded datum in L2, see ValueCache.put (objects kept by reference
+        are never copied, they need no cache)"""
+        if self.backend != "inprocess":
+            self.value_cache.put(skey, version, datum, size)
+        return
+
+    def _cached_value(self, skey: str, ex: int) -> tuple:
+        """Validate the L2 entry of a key against the version in the metadata hash
+
+        The metadata is re-read (and the TTLs refreshed) in a single round trip, so
+        L1 is also up to date when the entry turns out to be stale.
+
+        Args:
+            skey (str): the user key
+            ex (int): expiration in seconds
+
+        Returns:
+            tuple: the (version, datum, size) entry, or None if missing or stale
+        """
+        entry = self.value_cache.get(skey)
+        if entry is None:
+            # Make sure the next lookup reads the current version
+            self.keyname_map.pop(skey, None)
+            return None
+
+        with self.con.pipeline(transaction=False) as pipe:
+            pipe.hmget(f"{self.root_diretory}/{skey}", self.metadata_fields)
+            metadata = self.keyname_map.get(skey)
+            if metadata is not None:
+                self._queue_key_data_get(skey, metadata, pipe, ex, fetch=False)
+            ext_data = pipe.execute()[0]
+
+        self.keyname_map.pop(skey, None)
+        metadata = self._cache_metadata(skey, ext_data)
+        if metadata is None or metadata["version"] != entry[0]:
+            self.value_cache.pop(skey, None)
+            return None
+        return entry
+
+    def _key_data_get(
+        self, skey: str, ex: int, metadata: Dict, cached: bool
+    ) -> Tuple[Dict, Any]:
+        """Fetch the encoded datum of a key, refreshing its TTLs in the same round trip
+
+        Args:
+            skey (str): the user key
+            ex (int): expiration in seconds
+            metadata (Dict): the key metadata
+            cached (bool): the metadata came from L1, when a chunk (or the file) is
+                missing it is fetched again from the store and the datum once more
+
+        Returns:
+            Tuple[Dict, Any]: the metadata and the encoded datum, (metadata, None) if
+                the datum expired, (None, None) if the key is gone
+        """
+        # Fetch every chunk and refresh the TTLs in a single round trip
+        with self.con.pipeline(transaction=False) as pipe:
+            self._queue_key_data_get(skey, metadata, pipe, ex)
+            buffers = pipe.execute()
+
+        payload = self._join_chunks(metadata, buffers)
+        if payload is None and cached:
+            # Another process may have replaced the key, retry with its metadata
+            metadata = self._reload_metadata(skey)
+            if metadata is None:
+                return None, None
+            return self._key_data_get(skey, ex, metadata, False)
+        return metadata, payload
+
+    def _queue_key_data_get(
+        self, skey: str, metadata: Dict, pipe: Pipeline, ex: int, fetch: bool = True
+    ) -> int:
+        """Queue the commands fetching a datum's chunks (and refreshing its TTLs)
+
+        Args:
+            skey (str): the user key
+            metadata (Dict): the key metadata
+            pipe (Pipeline): the pipeline collecting the commands
+            ex (int): expiration in seconds
+            fetch (bool, optional): False only refreshes the TTLs. Defaults to True.
+
+        Returns:
+            int: number of replies the queued commands will produce
+        """
+        # Values in a file tier are read locally, only their metadata is refreshed
+        if self.files.tier(metadata) is not None:
+            self._queue_refresh(pipe, [f"{self.root_diretory}/{skey}"], ex)
+            return 1
+
+        # A TTL per stripe in the hash layout, whatever the number of chunks
+        chunks = self._chunks(metadata)
+        n_replies = chunks.queue_fetch(pipe, 0, len(chunks)) if fetch else 0
+        keys = chunks.keys + [f"{self.root_diretory}/{skey}"]
+        self._queue_refresh(pipe, keys, ex)
+        return n_replies + len(keys)
+
+    def _join_chunks(self, metadata: Dict, replies: List) -> Any:
+        """Rebuild the encoded datum from the replies queued by _queue_key_data_get"""
+        if self.files.tier(metadata) is not None:
+            return self.files.read(metadata)
+        if metadata["backend"] == "ref":
+            return replies[0][0]
+
+        chunks = self._chunks(metadata)
+        buffers = chunks.join(replies, 0, len(chunks))
+        # A missing chunk means the datum expired underneath us
+        if any(buffer is None for buffer in buffers):
             return None
 
-        encoded_data = bytes()
-        with BytesIO() as stream:
-            # Read every chunch from the DataStore
-            for this_chunk in range(chunks):
-                self.con.expire(f"{mapped_key}:{this_chunk}", self.expire)
-                buffer = get_func(f"{mapped_key}:{this_chunk}")
-                stream.write(buffer)
-            # Read the tail from the DataStore
-            if int(data_size % self.chunk_size) > 0:
-                self.con.expire(f"{mapped_key}:{chunks}", self.expire)
-                buffer = get_func(f"{mapped_key}:{chunks}")
-                stream.write(buffer)
-            encoded_data = stream.getvalue()
-
-        return encoded_data
+        return b"".join(buffers)
+
+    def _measure(self, operation: str) -> Measurement:
+        """Start measuring an operation (a no-op when the instrumentation is off)"""
+        return measure(self.metrics, operation)
+
+    def _measure_value(self, m: Measurement, metadata: Dict, payload: Any) -> None:
+        """Count an encoded value moved by a measured operation"""
+        if m and metadata["backend"] != "ref":
+            raw_size = self.serializer[metadata["coding"]].raw_size(payload)
+            m.add(metadata["dtsize"], raw_size, len(self._chunks(metadata)))
+        return
+
+    def _decode(self, metadata: Dict, payload: Any) -> Any:
+        """Decode a payload rebuilt by _join_chunks (objects kept by reference are returned as is)"""
+        if metadata["backend"] == "ref":
+            return payload
+        return self.serializer[metadata["coding"]].decode(payload)
+
+    def _queue_key_data_delete(self, skey: str, metadata: Dict, pipe: Pipeline) -> None:
+        """Queue the script deleting a mapped key (chunks, metadata and directory entry)
+
+        Args:
+            skey (str): the user key
+            metadata (Dict): the key metadata
+            pipe (Pipeline): the pipeline collecting the commands
+        """
+        # Queues and sets live in the mapped key itself, the script drops it too
+        # (and a file is left to FileTiers.collect)
+        k = f"{self.root_diretory}/{skey}"
+        self.scripts["delete"](
+            keys=[k, self.root_diretory, self.index_diretory],
+            args=[skey, self.chunk_size],
+            client=pipe,
+        )
+        self.value_cache.pop(skey, None)
+        return
 
     # Public methods
     def set(
@@ -224,6 +755,7 @@ class DataStorage(Borg):
         datum: Any,
         coding: StoreType = StoreType.COMPRESSED,
         ex: int = None,
+        compression: Dict = None,
     ) -> None:
         """Set the memory key with datum
 
@@ -232,18 +764,36 @@ class DataStorage(Borg):
             datum (Any): the datum
             coding (StoreType, optional): The encoding type to be used. Defaults to StoreType.COMPRESSED.
             ex (int): expiration in seconds, default to 3600.
+            compression (Dict, optional): Overrides the store compression options for this value. Defaults to None.
         """
         # Set the expiration
         ex = ex if ex else self.expire
+        skey = key if type(key) is str else str(key, "utf-8")
 
-        if key in self.keyname_map:
-            self.delete(key)
-
-        # Initiate the communication pipeline
-        with self.con.pipeline() as pipe:
-            self._key_data_update(key, datum, coding, pipe, ex, pipe.set)
-            # Execute the communication pipeline
-            pipe.execute()
+        with self._measure("set") as m:
+            # Every write gets a new store-wide version, invalidating the L2 copies
+            with m.phase("network"):
+                version = self.con.incr(self.version_tag)
+
+            if self._parallel(datum):
+                size = self._key_data_stream(
+                    skey, datum, coding, ex, version, compression, m
+                )
+                self._cache_value(skey, version, datum, size)
+                return
+
+            # Initiate the communication pipeline, the chunks go first and the replace
+            # script publishes them (dropping the previous value) atomically
+            with self.con.pipeline(transaction=False) as pipe:
+                size = self._key_data_update(
+                    key, datum, coding, pipe, ex, version, compression, m
+                )
+                # Execute the communication pipeline
+                with m.phase("network"):
+                    pipe.execute()
+            with m.phase("network"):
+                self._collect_garbage()
+        self._cache_value(skey, version, datum, size)
         return
 
     def get(self, key: str, ex: int = 3600) -> Any:
@@ -256,22 +806,167 @@ class DataStorage(Borg):
         Returns:
             Any: None if not found, the stored value otherwise
         """
-        # try to find a key mapping in the L1 or in the external memory
-        mapped_key, dtsize, coding, n_chunks = self.__find_mapped_key(key)
-        # if it is none, no key has been found... Return None
-        if not mapped_key:
-            return None
+        with self._measure("get") as m:
+            # With L2 enabled, a local copy still holding the stored version is enough
+            skey = key if type(key) is str else str(key, "utf-8")
+            if self.value_cache.capacity > 0:
+                with m.phase("network"):
+                    entry = self._cached_value(skey, ex)
+                if entry is not None:
+                    return copy_value(entry[1])
+
+            # try to find a key mapping in the L1 or in the external memory
+            cached = skey in self.keyname_map
+            with m.phase("network"):
+                metadata = self._find_metadata(skey)
+            # if it is none, no key has been found... Return None
+            if metadata is None:
+                return None
+
+            # Values spanning several windows are decoded while the chunks arrive,
+            # so the whole encoded payload never sits in memory (and the fetch time
+            # can't be told apart, it is all accounted as deserialize)
+            if (
+                len(self._chunks(metadata)) > self.stream_window
+                or self.parallel.reads(metadata)
+            ):
+                # A stale L1 entry would fail in the middle of the stream, make
+                # sure the metadata is current (a round trip among many)
+                if cached:
+                    with m.phase("network"):
+                        metadata = self._reload_metadata(skey)
+                    if metadata is None:
+                        return None
+                with m.phase("deserialize"), self._open_read(
+                    skey, metadata, ex
+                ) as stream:
+                    datum = self.serializer[metadata["coding"]].decode_stream(
+                        io.BufferedReader(stream, self.chunk_size)
+                    )
+                if m:
+                    m.add(metadata["dtsize"], 0, len(self._chunks(metadata)))
+                self._cache_value(skey, metadata["version"], datum, metadata["dtsize"])
+                return datum
+
+            # So, we have a key, let's look for a datum (the TTLs are refreshed
+            # in the same round trip)
+            with m.phase("network"):
+                metadata, payload = self._key_data_get(skey, ex, metadata, cached)
+            # if it is none, so this key is note in the storage memory... Return None
+            # Actually, it should be an error, but forward it to the upper layers
+            if payload is None:
+                return None
+            # So, habemus datum, decode and return it
+            self._measure_value(m, metadata, payload)
+            with m.phase("deserialize"):
+                datum = self._decode(metadata, payload)
+        self._cache_value(skey, metadata["version"], datum, metadata["dtsize"])
+        return datum
+
+    def open_read(self, key: str, ex: int = 3600) -> io.RawIOBase:
+        """Open a stored value for reading, as a binary file-like object
+
+        The chunks are fetched a window at a time while the value is read (see
+        ChunkReader.iter_chunks), values in shared memory are read from their mapping.
+        The bytes are the encoded value, decode them with
+        self.serializer[coding].load(stream).
+
+        Args:
+            key (str): the key to look for
+            ex (int): expiration in seconds, default to 3600.
 
-        # So, we have a key, let's look for a datum
-        payload = self._key_data_get(key, self.con.get)
-        # if it is none, so this key is note in the storage memory... Return None
-        # Actually, it should be an error, but forward it to the upper layers
-        if payload is None:
+        Returns:
+            io.RawIOBase: the reader, None if the key is not found
+        """
+        skey = key if type(key) is str else str(key, "utf-8")
+        # The metadata in L1 may be stale, and a stream can't start over
+        metadata = self._reload_metadata(skey)
+        if metadata is None:
             return None
-        # So, habemus datum, decode, refresh both keys and return it
-        self.con.expire(key, ex)
-        self.con.expire(mapped_key, ex)
-        return self.serializer[coding].decode(payload)
+        return self._open_read(skey, metadata, ex)
+
+    def _open_read(self, skey: str, metadata: Dict, ex: int) -> io.RawIOBase:
+        """Open the value of a key for reading, see open_read"""
+        if self.files.tier(metadata) is not None:
+            self.con.expire(f"{self.root_diretory}/{skey}", ex, gt=self._expire_gt())
+            view = self.files.read(metadata)
+            return ViewReader(view) if view is not None else None
+
+        if metadata["backend"] == "ref":
+            # Readers expect the encoded value, encode the object on demand
+            datum = self._key_data_get(skey, ex, metadata, False)[1]
+            encoded_data = self.serializer[metadata["coding"]].encode(datum)
+            return ViewReader(memoryview(encoded_data))
+
+        return ChunkReader(
+            self.con,
+            self._chunks(metadata),
+            ex,
+            self.stream_window,
+            refresh=[f"{self.root_diretory}/{skey}"],
+            gt=self._expire_gt(),
+            executor=self.parallel.workers() if self.parallel.reads(metadata) else None,
+        )
+
+    def open_write(
+        self, key: str, coding: StoreType = StoreType.NONE, ex: int = None
+    ) -> io.RawIOBase:
+        """Open a key for writing, as a binary file-like object
+
+        The chunks are sent a window at a time while the value is written, and the
+        key is published when the writer is closed (a with block that raises
+        publishes nothing, see ChunkWriter.abort). The bytes written must already
+        be encoded with coding, e.g. self.serializer[coding.value].dump(value, stream).
+
+        Args:
+            key (str): User key
+            coding (StoreType, optional): The encoding of the bytes written. Defaults to StoreType.NONE.
+            ex (int): expiration in seconds, default to 3600.
+
+        Returns:
+            io.RawIOBase: the writer, to be closed (or used as a context manager)
+        """
+        ex = ex if ex else self.expire
+        skey = key if type(key) is str else str(key, "utf-8")
+        return self._chunk_writer(skey, coding, ex, self.con.incr(self.version_tag))
+
+    def _chunk_writer(
+        self, skey: str, coding: StoreType, ex: int, version: int, parallel=False
+    ) -> ChunkWriter:
+        """A ChunkWriter publishing version of skey when closed, see open_write
+
+        A parallel writer has a stripe per worker thread, uploaded concurrently.
+        """
+        mapped_key = f"{self.chunk_diretory}/{skey}@{version}"
+        stripes = self.stripes
+        if parallel:
+            stripes = max(stripes, self.parallel.parallelism)
+        chunks = HashChunks(mapped_key, 0, stripes)
+
+        def publish(size: int) -> None:
+            metadata = build_metadata(
+                mapped_key,
+                size,
+                coding.value,
+                size // self.chunk_size,
+                version,
+                stripes=stripes,
+            )
+            with self.con.pipeline() as pipe:
+                self._queue_key_metadata(skey, metadata, pipe, ex)
+                pipe.execute()
+            self._collect_garbage()
+            return
+
+        return ChunkWriter(
+            self.con,
+            chunks,
+            self.chunk_size,
+            ex,
+            self.stream_window,
+            publish,
+            executor=self.parallel.workers() if parallel else None,
+        )
 
     def get_keys(self, wkey: str) -> List:
         """Retrung arbitrary filtered key list from the storage memory
@@ -282,15 +977,58 @@ class DataStorage(Borg):
         Returns:
             List: List with keys found into the storage (using the wildcard key)
         """
-        # Try to fetch from the storage memory, return None if not found
-        key_set = self.con.smembers(self.root_diretory)
-        decoded_keys = list()
-        for i in sorted(list(key_set)):
-            decoded_keys.append(i.decode())
+        return sorted(self.iter_keys(wkey))
 
-        # Build and return a list of keys. Reversed to respect the creation order and
-        # decoded from bytes to strings
-        return fnmatch.filter(decoded_keys, wkey)
+    def iter_keys(self, wkey: str, count: int = 1000) -> Iterator[str]:
+        """Stream the keys matching a wildcard, a page of count keys per round trip
+
+        A wildcard starting with a literal prefix (e.g. "STATUS-*") walks only that
+        range of the name index, in name order. Any other wildcard scans the whole
+        directory with SSCAN, in no particular order.
+
+        Args:
+            wkey (str): key wildcard
+            count (int, optional): keys fetched per round trip. Defaults to 1000.
+
+        Yields:
+            Iterator[str]: the matching keys
+        """
+        prefix = re.split(r"[*?\[]", wkey, maxsplit=1)[0]
+        if not prefix:
+            for key in self.con.sscan_iter(self.root_diretory, count=count):
+                key = key.decode()
+                if fnmatch.fnmatchcase(key, wkey):
+                    yield key
+            return
+
+        self._check_index()
+        lower = b"[" + prefix.encode()
+        upper = lower + b"\xff"
+        start = 0
+        while True:
+            page = self.con.zrangebylex(self.index_diretory, lower, upper, start, count)
+            for key in page:
+                key = key.decode()
+                if fnmatch.fnmatchcase(key, wkey):
+                    yield key
+            if len(page) < count:
+                return
+            start += count
+
+    def _check_index(self) -> None:
+        """Rebuild the name index if it misses keys listed by an older writer"""
+        with self.con.pipeline(transaction=False) as pipe:
+            pipe.scard(self.root_diretory)
+            pipe.zcard(self.index_diretory)
+            n_keys, n_indexed = pipe.execute()
+        if n_keys == n_indexed:
+            return
+        with self.con.pipeline(transaction=False) as pipe:
+            pipe.delete(self.index_diretory)
+            for key in self.con.sscan_iter(self.root_diretory, count=1000):
+                pipe.zadd(self.index_diretory, {key: 0})
+            pipe.execute()
+        return
 
     def enqueue(
         self,
@@ -306,30 +1044,61 @@ class DataStorage(Borg):
             datum (Any): datum to be enqueued
             coding (StoreType, optional): The encoding type to be used. Defaults to StoreType.COMPRESSED.
         """
-        # Creates an internal key representation with User's key and Store Type Encoding
-        skey = key if type(key) is str else str(key, "utf-8")
-        mapped_key = f"/{self.store_name}/data/{skey}"
-
-        self.keyname_map[skey] = {
-            "data": mapped_key,
-            "dtsize": 0,
-            "coding": coding.value,
-            "chunks": 0,
-        }
+        self.enqueue_many(key, [datum], coding, ex)
+        return
 
-        # Encode the data and push it into the queue
-        encoded_data = self.serializer[coding.value].encode(datum)
+    def enqueue_many(
+        self,
+        key: str,
+        data: Iterable[Any],
+        coding: StoreType = StoreType.COMPRESSED,
+        ex: int = 3600,
+    ) -> None:
+        """Enqueue many data into a queue with a single RPUSH
 
-        with self.con.pipeline() as pipe:
-            for kk, vv in self.keyname_map[skey].items():
-                k = f"{self.root_diretory}/{skey}"
-                pipe.hset(k, kk, vv)
-            pipe.expire(k, ex)
-            pipe.rpush(mapped_key, encoded_data)
-            pipe.expire(mapped_key, ex)
-            pipe.sadd(self.root_diretory, key)
-            pipe.execute()
+        The queue metadata is written by the first push of this process only, later
+        pushes just refresh its expiration (and write it again if it is gone).
 
+        Args:
+            key (str): key is the queue name
+            data (Iterable[Any]): data to be enqueued, in order
+            coding (StoreType, optional): The encoding type to be used. Defaults to StoreType.COMPRESSED.
+            ex (int): expiration in seconds, default to 3600.
+        """
+        # Creates an internal key representation with User's key and Store Type Encoding
+        skey = key if type(key) is str else str(key, "utf-8")
+        mapped_key = f"/{self.store_name}/data/{skey}"
+        k = f"{self.root_diretory}/{skey}"
+
+        with self._measure("enqueue") as m:
+            # Encode the data and push it into the queue
+            serializer = self.serializer[coding.value]
+            with m.phase("serialize"):
+                encoded_data = [serializer.encode(datum) for datum in data]
+            if not encoded_data:
+                return
+            if m:
+                for item in encoded_data:
+                    m.add(len(item), serializer.raw_size(item), 0)
+
+            known = skey in self.keyname_map
+            with self.con.pipeline() as pipe, m.phase("network"):
+                if not known:
+                    self._queue_key_metadata(
+                        skey, build_metadata(mapped_key, coding=coding.value), pipe, ex
+                    )
+                pipe.rpush(mapped_key, *encoded_data)
+                pipe.expire(mapped_key, ex)
+                pipe.expire(k, ex)
+                metadata_found = pipe.execute()[-1]
+
+            if known and not metadata_found:
+                # Expired or deleted by another process while the queue was in use
+                with self.con.pipeline() as pipe, m.phase("network"):
+                    self._queue_key_metadata(
+                        skey, build_metadata(mapped_key, coding=coding.value), pipe, ex
+                    )
+                    pipe.execute()
         return
 
     def dequeue(
@@ -344,23 +1113,77 @@ class DataStorage(Borg):
         Returns:
             Any: The datum dequeued from the queue, otherwise None
         """
-        # try to find a key mapping in the L1 or in the external memory
-        mapped_key, data_size, coding, chunks = self.__find_mapped_key(key)
+        with self._measure("dequeue") as m:
+            # try to find a key mapping in the L1 or in the external memory
+            with m.phase("network"):
+                mapped_key, data_size, coding, chunks = self.__find_mapped_key(key)
+
+            if mapped_key is None:
+                return None
+
+            # try to pop an element from the queue (the wait counts as network)
+            with m.phase("network"):
+                item = self.con.blpop(mapped_key, timeout)
+            # if found, decode the datum, else, return None
+            if item:
+                if m:
+                    m.add(len(item[1]), self.serializer[coding].raw_size(item[1]), 0)
+                with m.phase("deserialize"):
+                    return self.serializer[coding].decode(item[1])
+        return item
 
-        if mapped_key is None:
-            return None
+    def dequeue_many(self, key: str, n: int) -> List[Any]:
+        """Dequeue up to n items from the queue in one round trip, without blocking
 
-        # try to pop an element from the queue
-        item = self.con.blpop(mapped_key, timeout)
-        # if found, decode the datum, else, return None
-        if item:
-            return self.serializer[coding].decode(item[1])
-        return item
+        Args:
+            key (str): key is the queue name
+            n (int): maximum number of items
+
+        Returns:
+            List[Any]: the data dequeued, in order (empty if the queue is empty or not found)
+        """
+        with self._measure("dequeue") as m:
+            with m.phase("network"):
+                mapped_key, data_size, coding, chunks = self.__find_mapped_key(key)
+
+            if mapped_key is None or n <= 0:
+                return list()
+
+            # LRANGE and LTRIM in a transaction, so concurrent consumers never share
+            # items
+            with self.con.pipeline() as pipe, m.phase("network"):
+                pipe.lrange(mapped_key, 0, n - 1)
+                pipe.ltrim(mapped_key, n, -1)
+                items = pipe.execute()[0]
+            serializer = self.serializer[coding]
+            if m:
+                for item in items:
+                    m.add(len(item), serializer.raw_size(item), 0)
+            with m.phase("deserialize"):
+                return [serializer.decode(item) for item in items]
+
+    def drain(self, key: str, batch: int = 1000) -> Iterator[Any]:
+        """Dequeue every item of the queue, batch items per round trip
+
+        The generator stops as soon as the queue is found empty, so no end sentinel
+        has to be pushed. Items enqueued after that are left in the queue.
+
+        Args:
+            key (str): key is the queue name
+            batch (int, optional): items fetched per round trip. Defaults to 1000.
+
+        Yields:
+            Iterator[Any]: the data dequeued, in order
+        """
+        while True:
+            items = self.dequeue_many(key, batch)
+            yield from items
+            if len(items) < batch:
+                return
 
     def delete_queue(self, key: str) -> None:
-        mapped_key, data_size, coding, chunks = self.__find_mapped_key(key)
-        self.con.delete(mapped_key)
-        self.con.srem(self.root_diretory, key)
+        # The metadata goes too, so the next enqueue writes it (and lists the queue) again
+        self.delete(key)
         return
 
     def delete(self, key: str) -> None:
@@ -368,30 +1191,303 @@ class DataStorage(Borg):
         # if it has been found, delete the storage key, the key from the storage mapping
         # and from L1
         skey = key if type(key) is str else str(key, "utf-8")
-        mapped_key, dtsize, coding, n_chunks = self.__find_mapped_key(key)
+        with self._measure("delete") as m, m.phase("network"):
+            metadata = self._find_metadata(skey)
 
-        if mapped_key:
-            with self.con.pipeline() as pipe:
-                k = f"{self.root_diretory}/{skey}"
+            if metadata:
+                with self.con.pipeline() as pipe:
+                    self._queue_key_data_delete(skey, metadata, pipe)
+                    pipe.execute()
+                self._collect_garbage()
+                self.keyname_map.pop(skey, None)
 
-                for this_chunk in range(n_chunks):
-                    pipe.delete(f"{mapped_key}:{this_chunk}")
-                # Read the tail from the DataStore
-                if int(dtsize % self.chunk_size) > 0:
-                    pipe.delete(f"{mapped_key}:{n_chunks}")
+        return
 
-                pipe.delete(k)
-                pipe.srem(self.root_diretory, skey)
-                pipe.execute()
-            self.keyname_map.pop(skey, None)
+    def pin(self, key: str, lease: int = None) -> bool:
+        """Keep a value in the store, whatever its TTL, until unpin (or the lease ends)
+
+        The TTLs of the metadata hash and of the chunk stripes are lifted (or set to
+        the lease), a few commands whatever the size of the value. Reads never
+        shorten them, but a new set of the key replaces the pinned value.
+
+        Args:
+            key (str): the key to pin
+            lease (int, optional): seconds the value is kept, None until unpin. Defaults to None.
+
+        Returns:
+            bool: False if the key is not in the store
+
+        Raises:
+            RuntimeError: the server does not take EXPIRE ... GT (Redis < 7.0)
+        """
+        if not self._expire_gt():
+            raise RuntimeError("pinning a value needs Redis 7.0 or later (EXPIRE GT)")
+        return self._set_ttl(key, lease)
+
+    def unpin(self, key: str, ex: int = None) -> bool:
+        """Let a pinned value expire again
+
+        Args:
+            key (str): the key to unpin
+            ex (int): expiration in seconds, default to 3600.
+
+        Returns:
+            bool: False if the key is not in the store
+        """
+        return self._set_ttl(key, ex if ex else self.expire)
+
+    def _set_ttl(self, key: str, ex: int) -> bool:
+        """Set the TTL of a value (metadata and chunks), None to lift it"""
+        skey = key if type(key) is str else str(key, "utf-8")
+        k = f"{self.root_diretory}/{skey}"
+        # The current version, the one in L1 may be stale
+        metadata = self._cache_metadata(skey, self.con.hmget(k, self.metadata_fields))
+        if metadata is None:
+            return False
+
+        with self.con.pipeline(transaction=False) as pipe:
+            for ttl_key in [k] + self._chunks(metadata).keys:
+                if ex is None:
+                    pipe.persist(ttl_key)
+                else:
+                    pipe.expire(ttl_key, ex)
+            pipe.execute()
+        return True
+
+    def bulk_set(
+        self,
+        data: Dict[str, Any],
+        coding: StoreType = StoreType.COMPRESSED,
+        ex: int = None,
+        compression: Dict = None,
+    ) -> None:
+        """Set many memory keys in a single pipelined transaction
+
+        Args:
+            data (Dict[str, Any]): maps every user key to its datum
+            coding (StoreType, optional): The encoding type to be used. Defaults to StoreType.COMPRESSED.
+            ex (int): expiration in seconds, default to 3600.
+            compression (Dict, optional): Overrides the store compression options for these values. Defaults to None.
+        """
+        # Set the expiration
+        ex = ex if ex else self.expire
+
+        if not data:
+            return
+
+        with self._measure("bulk_set") as m:
+            # Reserve one version per key in a single round trip
+            with m.phase("network"):
+                version = self.con.incrby(self.version_tag, len(data)) - len(data)
+
+            versions, sizes = dict(), dict()
+            with self.con.pipeline(transaction=False) as pipe:
+                for key, datum in data.items():
+                    skey = key if type(key) is str else str(key, "utf-8")
+                    version += 1
+                    versions[skey] = version
+                    sizes[skey] = self._key_data_update(
+                        key, datum, coding, pipe, ex, version, compression, m
+                    )
+                with m.phase("network"):
+                    pipe.execute()
+            with m.phase("network"):
+                self._collect_garbage()
+        for key, datum in data.items():
+            skey = key if type(key) is str else str(key, "utf-8")
+            self._cache_value(skey, versions[skey], datum, sizes[skey])
+        return
 
+    def bulk_get(self, keys: Iterable[str], ex: int = 3600) -> Dict[str, Any]:
+        """Get the data stored into many keys in (at most) two round trips
+
+        The keys whose metadata in L1 turns out to be stale (a chunk or the file is
+        gone) are fetched once more, from their metadata in the store (two more round
+        trips).
+
+        Args:
+            keys (Iterable[str]): the keys to look for
+            ex (int): expiration in seconds, default to 3600.
+
+        Returns:
+            Dict[str, Any]: maps every key to its datum (None if not found)
+        """
+        skeys = [k if type(k) is str else str(k, "utf-8") for k in keys]
+        with self._measure("bulk_get") as m:
+            cached = [skey for skey in skeys if skey in self.keyname_map]
+            result = self._bulk_get(skeys, ex, m)
+            stale = [skey for skey in cached if result[skey] is None]
+            for skey in stale:
+                self.keyname_map.pop(skey, None)
+            if stale:
+                result.update(self._bulk_get(stale, ex, m))
+        return result
+
+    def _bulk_get(self, skeys: List[str], ex: int, m: Measurement) -> Dict[str, Any]:
+        """Get the data stored into many keys, see bulk_get"""
+        with m.phase("network"):
+            mapping = self.__find_mapped_keys(skeys)
+        found = [skey for skey, md in mapping.items() if md is not None]
+        result = {skey: None for skey in mapping}
+
+        with self.con.pipeline(transaction=False) as pipe, m.phase("network"):
+            n_replies = [
+                self._queue_key_data_get(skey, mapping[skey], pipe, ex)
+                for skey in found
+            ]
+            replies = pipe.execute() if found else []
+
+        offset = 0
+        for skey, n in zip(found, n_replies):
+            payload = self._join_chunks(mapping[skey], replies[offset : offset + n])
+            offset += n
+            if payload is not None:
+                self._measure_value(m, mapping[skey], payload)
+                with m.phase("deserialize"):
+                    result[skey] = self._decode(mapping[skey], payload)
+        return result
+
+    def bulk_delete(self, keys: Iterable[str]) -> None:
+        """Delete many keys (and their chunks) in a single pipelined transaction
+
+        Args:
+            keys (Iterable[str]): the keys to be deleted
+        """
+        mapping = self.__find_mapped_keys(list(keys))
+        found = [skey for skey, m in mapping.items() if m is not None]
+        if not found:
+            return
+
+        with self.con.pipeline() as pipe:
+            for skey in found:
+                self._queue_key_data_delete(skey, mapping[skey], pipe)
+            pipe.execute()
+        self._collect_garbage()
+        for skey in found:
+            self.keyname_map.pop(skey, None)
         return
 
-    def reset_datastore(self) -> None:
-        for k in self.con.smembers(self.root_diretory):
-            self.delete(k)
+    def sadd(
+        self,
+        key: str,
+        datum: Any,
+        coding: StoreType = StoreType.PLAIN,
+        ex: int = 3600,
+    ) -> None:
+        """Add a datum to a set
+
+        Args:
+            key (str): key is the set name
+            datum (Any): datum to be added
+            coding (StoreType, optional): The encoding type to be used. Defaults to StoreType.PLAIN.
+            ex (int): expiration in seconds, default to 3600.
+        """
+        skey = key if type(key) is str else str(key, "utf-8")
+        mapped_key = f"/{self.store_name}/data/{skey}"
+
+        metadata = build_metadata(mapped_key, coding=coding.value)
+        encoded_data = self.serializer[coding.value].encode(datum)
+
         with self.con.pipeline() as pipe:
-            pipe.delete(self.unique_id_tag)
-            pipe.delete(self.root_diretory)
+            self._queue_key_metadata(skey, metadata, pipe, ex)
+            pipe.sadd(mapped_key, encoded_data)
+            pipe.expire(mapped_key, ex)
             pipe.execute()
         return
+
+    def smembers(self, key: str) -> List:
+        """Return every member of a set
+
+        Args:
+            key (str): key is the set name
+
+        Returns:
+            List: the decoded members, empty if the set is not found
+        """
+        mapped_key, data_size, coding, chunks = self.__find_mapped_key(key)
+
+        if mapped_key is None:
+            return list()
+
+        decoder = self.serializer[coding]
+        return [decoder.decode(member) for member in self.con.smembers(mapped_key)]
+
+    def generate_unique_id(self, key: str) -> str:
+        """Generate a store-wide unique id in the format "key#n"
+
+        Args:
+            key (str): the id prefix, every prefix has its own counter
+
+        Returns:
+            str: the unique id
+        """
+        return f"{key}#{self.con.hincrby(self.unique_id_tag, key, 1)}"
+
+    def collect_metrics(self) -> Dict[str, OperationStats]:
+        """Hand out the operation metrics recorded by this process and start over
+
+        The result is picklable, e.g. to be enqueued with a task's statistics, and the
+        results of many processes are summed up with instrumentation.merge.
+
+        Returns:
+            Dict[str, OperationStats]: metrics by operation, None if the instrumentation is off
+        """
+        if self.metrics is None:
+            return None
+        return self.metrics.collect()
+
+    def dedup_statistics(self) -> Dict[str, float]:
+        """Bytes written with dedup on, and the share of them actually uploaded
+
+        Returns:
+            Dict[str, float]: bytes (written), stored (uploaded) and ratio (bytes per stored byte)
+        """
+        return self.cas.statistics(self.con)
+
+    def connection_statistics(self) -> Dict[str, int]:
+        """Counters of the process-wide connection pools
+
+        Returns:
+            Dict[str, int]: hits (a DataStorage reused a pool), misses (a pool was built) and pools
+        """
+        return pool_statistics()
+
+    def sweep_files(self, grace: int = 600) -> int:
+        """Unlink the files of the file tiers no metadata points to: the value expired,
+        or its writer died before publishing it
+
+        Args:
+            grace (int, optional): seconds a file is kept after it is written, its
+                value may not be published yet. Defaults to 600.
+
+        Returns:
+            int: number of files unlinked
+        """
+        return self.files.sweep(self.con, grace)
+
+    def reset_datastore(self, batch: int = 1000) -> None:
+        """Remove every key of the store, batch keys per script call
+
+        Args:
+            batch (int, optional): keys removed per call, bounding how long Redis is busy. Defaults to 1000.
+        """
+        # The version counter is kept, so no L2 entry can match a new value
+        removed = batch
+        while removed == batch:
+            removed = self.scripts["wipe"](
+                keys=[
+                    self.root_diretory,
+                    self.index_diretory,
+                    self.unique_id_tag,
+                    self.cas.refs,
+                    self.cas.stats,
+                    self.files.files_tag,
+                ],
+                args=[batch, self.chunk_size, f"{self.root_diretory}/"],
+            )
+        self._collect_garbage(batch)
+        self.cas.reset(self.con, batch)
+        self.files.reset()
+        self.keyname_map.clear()
+        self.value_cache.clear()
+        return
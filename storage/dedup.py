@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+
+""" dedup.py. Content-addressed chunks of the External Data Storage (@) 2022
+This module stores the chunks of the values by content: a chunk is named after
+its hash, uploaded once and shared by every value holding it, and the scripts
+count its references (see scripts.CAS_ACQUIRE and DROP_VALUE).
+This program is free software: you can redistribute it and/or modify it under
+the terms of the GNU General Public License as published by the Free Software
+Foundation, either version 3 of the License, or (at your option) any later
+version.
+This program is distributed in the hope that it will be useful, but WITHOUT
+ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+You should have received a copy of the GNU General Public License along with
+this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+
+# COPYRIGHT SECTION
+__author__ = "Diego Carvalho"
+__copyright__ = "Copyright 2022"
+__credits__ = ["Diego Carvalho"]
+__license__ = "GPL"
+__version__ = "1.0.1"
+__maintainer__ = "Diego Carvalho"
+__email__ = "d.carvalho@ieee.org"
+__status__ = "Research"
+
+import hashlib
+from typing import Any, Dict
+
+from .scripts import DIGEST_SIZE
+from .sharding import ShardedRedis
+
+
+class ContentStore(object):
+    """The content-addressed chunks of a store, /{store}/cas/{digest}.
+
+    The references of every chunk are counted in casrefs, and casstats sums the
+    bytes written and the ones actually uploaded (see statistics).
+    """
+
+    def __init__(self, store_name: str) -> None:
+        self.prefix = f"/{store_name}/cas/"
+        self.refs = f"/{store_name}/casrefs"
+        self.stats = f"/{store_name}/casstats"
+        return
+
+    def queue_chunks(
+        self,
+        con: Any,
+        acquire: Any,
+        metadata: Dict,
+        view: memoryview,
+        chunk_size: int,
+        pipe: Any,
+        ex: int,
+    ) -> Dict:
+        """Reference the content-addressed chunks of a datum, queueing only the new ones
+
+        The references are taken (in one round trip) before the pipeline runs, so a
+        chunk already stored can't be dropped before the value is published.
+
+        Args:
+            con (Any): the client of the store
+            acquire (Any): the cas_acquire script
+            metadata (Dict): the metadata of the datum, in the chunked layout
+            view (memoryview): the encoded datum
+            chunk_size (int): size in bytes of a chunk
+            pipe (Any): the pipeline collecting the commands
+            ex (int): expiration in seconds
+
+        Returns:
+            Dict: the metadata of the datum in the content-addressed layout
+        """
+        digests = [
+            hashlib.blake2b(
+                view[offset : offset + chunk_size], digest_size=DIGEST_SIZE // 2
+            ).hexdigest()
+            for offset in range(0, len(view), chunk_size)
+        ]
+        missing = {
+            digest.decode()
+            for digest in acquire(keys=[self.refs], args=[ex, self.prefix] + digests)
+        }
+        if isinstance(con, ShardedRedis) and missing:
+            # The script only sees the chunks of the first server, EXPIRE finds the
+            # others and keeps them from expiring before the value is published
+            probed = sorted(missing)
+            with con.pipeline(transaction=False) as probe:
+                for digest in probed:
+                    probe.expire(f"{self.prefix}{digest}", ex)
+                found = probe.execute()
+            missing = {digest for digest, f in zip(probed, found) if not f}
+        uploaded = 0
+        for this_chunk, digest in enumerate(digests):
+            if digest in missing:
+                missing.discard(digest)
+                offset = this_chunk * chunk_size
+                chunk = view[offset : offset + chunk_size]
+                pipe.set(f"{self.prefix}{digest}", chunk, ex=ex)
+                uploaded += len(chunk)
+        pipe.hincrby(self.stats, "bytes", len(view))
+        pipe.hincrby(self.stats, "stored", uploaded)
+        return dict(metadata, backend="cas", manifest="".join(digests), stripes=0)
+
+    def statistics(self, con: Any) -> Dict[str, float]:
+        """Bytes written with dedup on, and the share of them actually uploaded
+
+        Returns:
+            Dict[str, float]: bytes (written), stored (uploaded) and ratio (bytes
+                per stored byte)
+        """
+        stats = con.hmget(self.stats, ["bytes", "stored"])
+        written, stored = (int(value) if value else 0 for value in stats)
+        return {
+            "bytes": written,
+            "stored": stored,
+            "ratio": written / stored if stored else 1.0,
+        }
+
+    def reset(self, con: Any, batch: int = 1000) -> None:
+        """Unlink the chunks a wipe (see scripts.WIPE) leaves behind in a sharded
+        store, where the scripts leave them to expire"""
+        if isinstance(con, ShardedRedis):
+            con.unlink_matching(f"{self.prefix}*", batch)
+        return
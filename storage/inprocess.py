@@ -0,0 +1,538 @@
+# -*- coding: utf-8 -*-
+
+""" inprocess.py. In-process backend for the External Data Storage (@) 2022
+This module provides a Redis look-alike living inside the Python process. It
+implements the commands (and the scripts) DataStorage relies on, with their TTL,
+blocking pop and pipeline semantics, so apps sharing a process (e.g. the
+local_threads configuration) or the tests run with no redis-server. Values are
+kept by reference, DataStorage stores the objects themselves, not their encoding.
+This program is free software: you can redistribute it and/or modify it under
+the terms of the GNU General Public License as published by the Free Software
+Foundation, either version 3 of the License, or (at your option) any later
+version.
+This program is distributed in the hope that it will be useful, but WITHOUT
+ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+You should have received a copy of the GNU General Public License along with
+this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+
+# COPYRIGHT SECTION
+__author__ = "Diego Carvalho"
+__copyright__ = "Copyright 2022"
+__credits__ = ["Diego Carvalho"]
+__license__ = "GPL"
+__version__ = "1.0.1"
+__maintainer__ = "Diego Carvalho"
+__email__ = "d.carvalho@ieee.org"
+__status__ = "Research"
+
+import fnmatch
+import threading
+import time
+from typing import Any, Callable, Dict, Iterator, List
+
+from . import scripts
+
+
+def _key(key) -> str:
+    if type(key) is str:
+        return key
+    # Hash fields may be numbers, e.g. the chunk indexes
+    return str(key, "utf-8") if isinstance(key, bytes) else str(key)
+
+
+def _member(value) -> bytes:
+    """Encode a hash value, set member or list item the way Redis returns it"""
+    if isinstance(value, bytes):
+        return value
+    if isinstance(value, str):
+        return value.encode()
+    if isinstance(value, (int, float)):
+        return str(value).encode()
+    return bytes(value)
+
+
+def _lex_bound(bound, lower: bool) -> Callable:
+    """Turn a ZRANGEBYLEX bound ("-", "+", "[value" or "(value") into a predicate"""
+    bound = _member(bound)
+    if bound in (b"-", b"+"):
+        return lambda member: True
+    value = bound[1:]
+    inclusive = bound[:1] == b"["
+    if lower:
+        return (lambda m: m >= value) if inclusive else (lambda m: m > value)
+    return (lambda m: m <= value) if inclusive else (lambda m: m < value)
+
+
+class InProcessScript(object):
+    """A registered script, run on the server or queued into one of its pipelines"""
+
+    def __init__(self, server, function: Callable) -> None:
+        self.server = server
+        self.function = function
+        return
+
+    def __call__(self, keys: List = [], args: List = [], client=None) -> Any:
+        if isinstance(client, InProcessPipeline):
+            client.commands.append((self.function, (keys, args), dict()))
+            return client
+        with self.server._lock:
+            return self.function(keys, args)
+
+
+class InProcessPipeline(object):
+    """Commands queued and run together, atomically, when executed"""
+
+    def __init__(self, server) -> None:
+        self.server = server
+        self.commands = list()
+        return
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.reset()
+        return
+
+    def __len__(self) -> int:
+        return len(self.commands)
+
+    def __getattr__(self, name: str) -> Callable:
+        method = getattr(self.server, name)
+
+        def queue(*args, **kwargs):
+            self.commands.append((method, args, kwargs))
+            return self
+
+        return queue
+
+    def execute(self) -> List:
+        with self.server._lock:
+            replies = [method(*args, **kw) for method, args, kw in self.commands]
+        self.commands = list()
+        return replies
+
+    def reset(self) -> None:
+        self.commands = list()
+        return
+
+
+class InProcessRedis(object):
+    """The subset of the Redis client API used by DataStorage, served from a dict.
+
+    Every command runs under one lock, so commands, pipelines and scripts are
+    atomic with respect to each other, as they are in Redis. Expired keys are
+    dropped when touched, and swept every sweep_interval writes.
+    """
+
+    _instance = None
+    _instance_lock = threading.Lock()
+
+    # Borg-held clients compare their pool to decide if they must reconnect
+    connection_pool = None
+
+    sweep_interval = 1024
+
+    @classmethod
+    def instance(cls):
+        """Return the server shared by the whole process"""
+        with cls._instance_lock:
+            if cls._instance is None:
+                cls._instance = cls()
+            return cls._instance
+
+    def __init__(self) -> None:
+        self._lock = threading.RLock()
+        self._pushed = threading.Condition(self._lock)
+        self._data = dict()
+        self._expires = dict()
+        self._writes = 0
+        self._scripts = {
+            scripts.REPLACE: self._replace,
+            scripts.DELETE: self._delete,
+            scripts.WIPE: self._wipe,
+            scripts.CAS_ACQUIRE: self._cas_acquire,
+        }
+        return
+
+    def __repr__(self) -> str:
+        return f"{self.__class__.__name__}({len(self._data)} keys)"
+
+    # Key space
+    def _alive(self, key: str) -> bool:
+        deadline = self._expires.get(key)
+        if deadline is not None and deadline <= time.monotonic():
+            self._remove(key)
+        return key in self._data
+
+    def _remove(self, key: str) -> bool:
+        self._expires.pop(key, None)
+        found = key in self._data
+        self._data.pop(key, None)
+        return found
+
+    def _lookup(self, key, default: Callable = None) -> Any:
+        """Return the value of a live key, creating it with default() if asked to"""
+        key = _key(key)
+        if self._alive(key):
+            return self._data[key]
+        if default is None:
+            return None
+        self._data[key] = default()
+        return self._data[key]
+
+    def _drop_if_empty(self, key) -> None:
+        key = _key(key)
+        if key in self._data and len(self._data[key]) == 0:
+            self._remove(key)
+        return
+
+    def _written(self) -> None:
+        self._writes += 1
+        if self._writes % self.sweep_interval == 0:
+            now = time.monotonic()
+            expired = [k for k, deadline in self._expires.items() if deadline <= now]
+            for key in expired:
+                self._remove(key)
+        return
+
+    def pipeline(self, transaction: bool = True) -> InProcessPipeline:
+        return InProcessPipeline(self)
+
+    def register_script(self, script: str) -> InProcessScript:
+        if script not in self._scripts:
+            raise NotImplementedError("only the DataStorage scripts run in process")
+        return InProcessScript(self, self._scripts[script])
+
+    def ping(self) -> bool:
+        return True
+
+    def flushall(self) -> bool:
+        with self._lock:
+            self._data.clear()
+            self._expires.clear()
+        return True
+
+    def exists(self, *keys) -> int:
+        with self._lock:
+            return sum(1 for key in keys if self._alive(_key(key)))
+
+    def delete(self, *keys) -> int:
+        with self._lock:
+            keys = [_key(key) for key in keys]
+            return sum(1 for key in keys if self._alive(key) and self._remove(key))
+
+    unlink = delete
+
+    def keys(self, pattern: str = "*") -> List[bytes]:
+        with self._lock:
+            pattern = _key(pattern)
+            return [
+                key.encode()
+                for key in list(self._data)
+                if self._alive(key) and fnmatch.fnmatchcase(key, pattern)
+            ]
+
+    def expire(self, key, seconds: int, gt: bool = False) -> bool:
+        with self._lock:
+            key = _key(key)
+            if not self._alive(key):
+                return False
+            deadline = time.monotonic() + int(seconds)
+            # GT: only push the deadline further, a key without one never expires
+            if gt and deadline <= self._expires.get(key, float("inf")):
+                return False
+            self._expires[key] = deadline
+            self._written()
+            return True
+
+    def persist(self, key) -> bool:
+        with self._lock:
+            key = _key(key)
+            if not self._alive(key):
+                return False
+            return self._expires.pop(key, None) is not None
+
+    def ttl(self, key) -> int:
+        with self._lock:
+            key = _key(key)
+            if not self._alive(key):
+                return -2
+            if key not in self._expires:
+                return -1
+            return round(self._expires[key] - time.monotonic())
+
+    # Strings, kept by reference
+    def get(self, key) -> Any:
+        with self._lock:
+            return self._lookup(key)
+
+    def set(self, key, value: Any, ex: int = None) -> bool:
+        with self._lock:
+            key = _key(key)
+            self._data[key] = value
+            self._expires.pop(key, None)
+            if ex:
+                self._expires[key] = time.monotonic() + int(ex)
+            self._written()
+            return True
+
+    def mget(self, keys, *args) -> List[Any]:
+        keys = [keys] if isinstance(keys, (str, bytes)) else list(keys)
+        with self._lock:
+            return [self._lookup(key) for key in keys + list(args)]
+
+    def incrby(self, key, amount: int = 1) -> int:
+        with self._lock:
+            key = _key(key)
+            value = int(self._lookup(key) or 0) + amount
+            self._data[key] = value
+            return value
+
+    def incr(self, key, amount: int = 1) -> int:
+        return self.incrby(key, amount)
+
+    # Hashes
+    def hset(self, name, key=None, value=None, mapping: Dict = None) -> int:
+        with self._lock:
+            fields = dict(mapping) if mapping else dict()
+            if key is not None:
+                fields[key] = value
+            h = self._lookup(name, dict)
+            added = sum(1 for field in fields if _key(field) not in h)
+            h.update({_key(field): _member(value) for field, value in fields.items()})
+            self._written()
+            return added
+
+    def hget(self, name, key) -> bytes:
+        with self._lock:
+            return (self._lookup(name) or dict()).get(_key(key))
+
+    def hmget(self, name, keys, *args) -> List[bytes]:
+        keys = [keys] if isinstance(keys, (str, bytes)) else list(keys)
+        with self._lock:
+            h = self._lookup(name) or dict()
+            return [h.get(_key(key)) for key in keys + list(args)]
+
+    def hlen(self, name) -> int:
+        with self._lock:
+            return len(self._lookup(name) or dict())
+
+    def hgetall(self, name) -> Dict[bytes, bytes]:
+        with self._lock:
+            h = self._lookup(name) or dict()
+            return {field.encode(): value for field, value in h.items()}
+
+    def hdel(self, name, *keys) -> int:
+        with self._lock:
+            h = self._lookup(name) or dict()
+            removed = sum(1 for key in keys if h.pop(_key(key), None) is not None)
+            self._drop_if_empty(name)
+            return removed
+
+    def hincrby(self, name, key, amount: int = 1) -> int:
+        with self._lock:
+            h = self._lookup(name, dict)
+            value = int(h.get(_key(key), 0)) + amount
+            h[_key(key)] = _member(value)
+            return value
+
+    # Sets
+    def sadd(self, name, *values) -> int:
+        with self._lock:
+            s = self._lookup(name, set)
+            size = len(s)
+            s.update(_member(value) for value in values)
+            self._written()
+            return len(s) - size
+
+    def srem(self, name, *values) -> int:
+        with self._lock:
+            s = self._lookup(name) or set()
+            size = len(s)
+            s.difference_update(_member(value) for value in values)
+            self._drop_if_empty(name)
+            return size - len(s)
+
+    def smembers(self, name) -> set:
+        with self._lock:
+            return set(self._lookup(name) or set())
+
+    def scard(self, name) -> int:
+        with self._lock:
+            return len(self._lookup(name) or set())
+
+    def spop(self, name, count: int = None) -> Any:
+        with self._lock:
+            s = self._lookup(name) or set()
+            n = min(len(s), 1 if count is None else count)
+            popped = [s.pop() for _ in range(n)]
+            self._drop_if_empty(name)
+            if count is None:
+                return popped[0] if popped else None
+            return popped
+
+    def sscan_iter(
+        self, name, match: str = None, count: int = None
+    ) -> Iterator[bytes]:
+        # A snapshot, so the set may change while it is walked, as with SSCAN
+        for member in self.smembers(name):
+            if match is None or fnmatch.fnmatchcase(member.decode(), _key(match)):
+                yield member
+
+    # Sorted sets (only the lexicographic ranges DataStorage uses)
+    def zadd(self, name, mapping: Dict) -> int:
+        with self._lock:
+            z = self._lookup(name, dict)
+            added = sum(1 for member in mapping if _member(member) not in z)
+            z.update({_member(member): score for member, score in mapping.items()})
+            self._written()
+            return added
+
+    def zrem(self, name, *values) -> int:
+        with self._lock:
+            z = self._lookup(name) or dict()
+            removed = sum(1 for v in values if z.pop(_member(v), None) is not None)
+            self._drop_if_empty(name)
+            return removed
+
+    def zcard(self, name) -> int:
+        with self._lock:
+            return len(self._lookup(name) or dict())
+
+    def zrangebylex(
+        self, name, min, max, start: int = None, num: int = None
+    ) -> List[bytes]:
+        above, below = _lex_bound(min, True), _lex_bound(max, False)
+        with self._lock:
+            z = self._lookup(name) or dict()
+            members = sorted(m for m in z if above(m) and below(m))
+        if start is not None:
+            members = members[start : start + num]
+        return members
+
+    # Lists
+    def rpush(self, name, *values) -> int:
+        with self._lock:
+            items = self._lookup(name, list)
+            items.extend(_member(value) for value in values)
+            self._pushed.notify_all()
+            self._written()
+            return len(items)
+
+    def lpop(self, name) -> bytes:
+        with self._lock:
+            items = self._lookup(name) or list()
+            item = items.pop(0) if items else None
+            self._drop_if_empty(name)
+            return item
+
+    def blpop(self, keys, timeout: int = 0) -> tuple:
+        """Pop from the first non-empty list, waiting up to timeout seconds (0 forever)"""
+        keys = [keys] if isinstance(keys, (str, bytes)) else list(keys)
+        deadline = time.monotonic() + timeout if timeout else None
+        with self._lock:
+            while True:
+                for key in keys:
+                    item = self.lpop(key)
+                    if item is not None:
+                        return (_member(key), item)
+                remaining = deadline - time.monotonic() if deadline else None
+                if remaining is not None and remaining <= 0:
+                    return None
+                self._pushed.wait(remaining)
+
+    def llen(self, name) -> int:
+        with self._lock:
+            return len(self._lookup(name) or list())
+
+    def lrange(self, name, start: int, end: int) -> List[bytes]:
+        with self._lock:
+            items = self._lookup(name) or list()
+            return items[start : (end + 1) or None]
+
+    def ltrim(self, name, start: int, end: int) -> bool:
+        with self._lock:
+            items = self._lookup(name) or list()
+            items[:] = items[start : (end + 1) or None]
+            self._drop_if_empty(name)
+            return True
+
+    # Scripts, mirroring the Lua sources in scripts.py
+    def _drop_value(self, meta: str, chunk_size: int, keep: str = None) -> None:
+        data, dtsize, chunks, backend, manifest, stripes = self.hmget(
+            meta, ["data", "dtsize", "chunks", "backend", "manifest", "stripes"]
+        )
+        if data is None or data.decode() == keep:
+            return
+        if backend in (b"shm", b"disk"):
+            self.rpush("/" + meta.split("/")[1] + "/files", data)
+            return
+        if backend == b"cas":
+            self._release_chunks(data.decode(), manifest.decode())
+            return
+        if int(stripes or 0) > 0:
+            keys = [f"{data.decode()}#{s}" for s in range(int(stripes))]
+        else:
+            n = int(chunks) + (1 if int(dtsize) % chunk_size > 0 else 0)
+            keys = [f"{data.decode()}:{i}" for i in range(n)]
+        self.delete(data, *keys)
+        return
+
+    def _release_chunks(self, data: str, manifest: str) -> None:
+        store = "/" + data.split("/")[1]
+        for i in range(0, len(manifest), scripts.DIGEST_SIZE):
+            digest = manifest[i : i + scripts.DIGEST_SIZE]
+            if self.hincrby(f"{store}/casrefs", digest, -1) <= 0:
+                self.hdel(f"{store}/casrefs", digest)
+                self.delete(f"{store}/cas/{digest}")
+        return
+
+    def _cas_acquire(self, keys: List, args: List) -> List[bytes]:
+        (refs,) = keys
+        ex, prefix, digests = int(args[0]), args[1], [_key(d) for d in args[2:]]
+        missing = list()
+        for digest in dict.fromkeys(digests):
+            chunk = f"{prefix}{digest}"
+            self.hincrby(refs, digest, digests.count(digest))
+            if not self.exists(chunk):
+                missing.append(digest.encode())
+            elif self.ttl(chunk) < ex:
+                self.expire(chunk, ex)
+        return missing
+
+    def _replace(self, keys: List, args: List) -> int:
+        meta, directory, index = keys
+        skey, ex, chunk_size, data = args[:4]
+        self._drop_value(meta, int(chunk_size), data)
+        self.delete(meta)
+        self.hset(meta, mapping=dict(zip(args[4::2], args[5::2])))
+        self.expire(meta, ex)
+        self.sadd(directory, skey)
+        self.zadd(index, {skey: 0})
+        return 1
+
+    def _delete(self, keys: List, args: List) -> int:
+        meta, directory, index = keys
+        skey, chunk_size = args
+        self._drop_value(meta, int(chunk_size))
+        self.delete(meta)
+        self.srem(directory, skey)
+        self.zrem(index, skey)
+        return 1
+
+    def _wipe(self, keys: List, args: List) -> int:
+        directory, index = keys[:2]
+        batch, chunk_size, prefix = int(args[0]), int(args[1]), args[2]
+        skeys = self.spop(directory, batch)
+        for skey in skeys:
+            meta = f"{prefix}{skey.decode()}"
+            self._drop_value(meta, chunk_size)
+            self.delete(meta)
+        if skeys:
+            self.zrem(index, *skeys)
+        if len(skeys) < batch:
+            self.delete(*keys)
+        return len(skeys)
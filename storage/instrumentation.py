@@ -0,0 +1,278 @@
+# -*- coding: utf-8 -*-
+
+""" instrumentation.py. Operation metrics of the External Data Storage (@) 2022
+This module records, for every DataStorage operation, where the time goes
+(serialize, network, deserialize), the bytes on the wire, the chunks and the
+compression ratio. Latencies and sizes go to HDR-style histograms, which merge
+losslessly, so the metrics of every worker process can be summed up at the end.
+This program is free software: you can redistribute it and/or modify it under
+the terms of the GNU General Public License as published by the Free Software
+Foundation, either version 3 of the License, or (at your option) any later
+version.
+This program is distributed in the hope that it will be useful, but WITHOUT
+ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+You should have received a copy of the GNU General Public License along with
+this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+
+# COPYRIGHT SECTION
+__author__ = "Diego Carvalho"
+__copyright__ = "Copyright 2022"
+__credits__ = ["Diego Carvalho"]
+__license__ = "GPL"
+__version__ = "1.0.1"
+__maintainer__ = "Diego Carvalho"
+__email__ = "d.carvalho@ieee.org"
+__status__ = "Research"
+
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager, nullcontext
+from typing import Dict, Iterable, List
+
+
+class Histogram(object):
+    """A log-linear histogram of non-negative integers, in the HDR histogram layout.
+
+    Values are grouped by magnitude (power of two), and every magnitude is split
+    into 2**sub_bucket_bits linear buckets, so the relative error of a reported
+    value is below 2**-(sub_bucket_bits - 1) whatever its magnitude.
+    """
+
+    sub_bucket_bits = 7
+
+    def __init__(self) -> None:
+        self.counts = defaultdict(int)
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = 0
+        return
+
+    def __repr__(self) -> str:
+        return f"{self.__class__.__name__}({self.count}, {self.min}..{self.max})"
+
+    def _bucket(self, value: int) -> int:
+        shift = max(0, value.bit_length() - self.sub_bucket_bits)
+        return (shift << self.sub_bucket_bits) + (value >> shift)
+
+    def _highest_value(self, bucket: int) -> int:
+        shift = bucket >> self.sub_bucket_bits
+        sub_bucket = bucket & ((1 << self.sub_bucket_bits) - 1)
+        return ((sub_bucket + 1) << shift) - 1
+
+    def record(self, value: int) -> None:
+        value = max(0, int(value))
+        self.counts[self._bucket(value)] += 1
+        self.count += 1
+        self.total += value
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = max(self.max, value)
+        return
+
+    def merge(self, other: "Histogram") -> None:
+        """Add the values recorded by other into this histogram"""
+        for bucket, count in other.counts.items():
+            self.counts[bucket] += count
+        self.count += other.count
+        self.total += other.total
+        if other.min is not None:
+            self.min = other.min if self.min is None else min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        return
+
+    def value_at_percentile(self, percentile: float) -> int:
+        """Value (within the bucket precision) below which percentile % of the values are"""
+        if self.count == 0:
+            return 0
+        rank = max(1, round(self.count * percentile / 100))
+        seen = 0
+        for bucket in sorted(self.counts):
+            seen += self.counts[bucket]
+            if seen >= rank:
+                return min(self._highest_value(bucket), self.max)
+        return self.max
+
+    def summary(self) -> Dict[str, float]:
+        return {
+            "count": self.count,
+            "min": self.min if self.min is not None else 0,
+            "mean": self.total / self.count if self.count else 0,
+            "p50": self.value_at_percentile(50),
+            "p90": self.value_at_percentile(90),
+            "p99": self.value_at_percentile(99),
+            "p999": self.value_at_percentile(99.9),
+            "max": self.max,
+        }
+
+
+class OperationStats(object):
+    """Histograms (microseconds and bytes) and totals of one kind of operation"""
+
+    phases = ("serialize", "network", "deserialize")
+
+    def __init__(self) -> None:
+        self.latency = Histogram()
+        self.phase = {phase: Histogram() for phase in self.phases}
+        self.wire_bytes = Histogram()
+        self.raw_bytes = 0
+        self.chunks = 0
+        return
+
+    def merge(self, other: "OperationStats") -> None:
+        self.latency.merge(other.latency)
+        for phase in self.phases:
+            self.phase[phase].merge(other.phase[phase])
+        self.wire_bytes.merge(other.wire_bytes)
+        self.raw_bytes += other.raw_bytes
+        self.chunks += other.chunks
+        return
+
+    def summary(self) -> Dict[str, float]:
+        """A flat summary: latency percentiles, mean time per phase, bytes and ratio"""
+        latency = self.latency.summary()
+        summary = {f"LATENCY_{k.upper()}_US": v for k, v in latency.items()}
+        summary["COUNT"] = summary.pop("LATENCY_COUNT_US")
+        for phase in self.phases:
+            summary[f"{phase.upper()}_MEAN_US"] = self.phase[phase].summary()["mean"]
+        summary["WIRE_BYTES"] = self.wire_bytes.total
+        summary["WIRE_BYTES_P99"] = self.wire_bytes.value_at_percentile(99)
+        summary["CHUNKS"] = self.chunks
+        summary["COMPRESSION_RATIO"] = (
+            self.raw_bytes / self.wire_bytes.total if self.wire_bytes.total else 1.0
+        )
+        return summary
+
+
+class Measurement(object):
+    """The metrics of a single operation, recorded when the operation is done"""
+
+    def __init__(self, instrumentation: "Instrumentation", operation: str) -> None:
+        self.instrumentation = instrumentation
+        self.operation = operation
+        self.times = dict.fromkeys(OperationStats.phases, 0.0)
+        self.wire_bytes = 0
+        self.raw_bytes = 0
+        self.chunks = 0
+        self.start = time.perf_counter()
+        return
+
+    def __bool__(self) -> bool:
+        return True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.instrumentation.record(self, time.perf_counter() - self.start)
+        return
+
+    @contextmanager
+    def phase(self, name: str):
+        """Add the time spent in the with block to one of the phases"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.times[name] += time.perf_counter() - start
+
+    def add(self, wire_bytes: int, raw_bytes: int, chunks: int) -> None:
+        """Count a value moved by the operation (encoded, uncompressed sizes and chunks)"""
+        self.wire_bytes += wire_bytes
+        self.raw_bytes += raw_bytes
+        self.chunks += chunks
+        return
+
+
+class NullMeasurement(object):
+    """Stands for a Measurement when the instrumentation is off, doing nothing"""
+
+    def __bool__(self) -> bool:
+        return False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args) -> None:
+        return
+
+    def phase(self, name: str):
+        return nullcontext()
+
+    def add(self, wire_bytes: int, raw_bytes: int, chunks: int) -> None:
+        return
+
+
+NULL_MEASUREMENT = NullMeasurement()
+
+
+class Instrumentation(object):
+    """The operation metrics of a process, by operation name"""
+
+    def __init__(self) -> None:
+        self.operations = defaultdict(OperationStats)
+        self._lock = threading.Lock()
+        return
+
+    def measure(self, operation: str) -> Measurement:
+        """Start measuring an operation, use the result as a context manager"""
+        return Measurement(self, operation)
+
+    def record(self, measurement: Measurement, elapsed: float) -> None:
+        with self._lock:
+            stats = self.operations[measurement.operation]
+            stats.latency.record(elapsed * 1e6)
+            for phase, seconds in measurement.times.items():
+                stats.phase[phase].record(seconds * 1e6)
+            stats.wire_bytes.record(measurement.wire_bytes)
+            stats.raw_bytes += measurement.raw_bytes
+            stats.chunks += measurement.chunks
+        return
+
+    def collect(self) -> Dict[str, OperationStats]:
+        """Hand out the metrics recorded so far and start over (picklable, see merge)"""
+        with self._lock:
+            operations, self.operations = self.operations, defaultdict(OperationStats)
+        return dict(operations)
+
+    def summary(self) -> List[Dict]:
+        """One row per operation, see OperationStats.summary"""
+        with self._lock:
+            return summary_rows(self.operations)
+
+
+def process_metrics(
+    instrument: bool, metrics: Instrumentation = None
+) -> Instrumentation:
+    """The metrics of the process: None when the instrumentation is off, metrics
+    (those recorded so far) or a new Instrumentation when it is on"""
+    if not instrument:
+        return None
+    return metrics if metrics is not None else Instrumentation()
+
+
+def measure(metrics: Instrumentation, operation: str) -> Measurement:
+    """Start measuring an operation, a no-op when metrics is None"""
+    if metrics is None:
+        return NULL_MEASUREMENT
+    return metrics.measure(operation)
+
+
+def merge(
+    collections: Iterable[Dict[str, OperationStats]]
+) -> Dict[str, OperationStats]:
+    """Merge the metrics collected by several processes (or tasks)"""
+    merged = defaultdict(OperationStats)
+    for operations in collections:
+        for operation, stats in operations.items():
+            merged[operation].merge(stats)
+    return dict(merged)
+
+
+def summary_rows(operations: Dict[str, OperationStats]) -> List[Dict]:
+    return [
+        dict(OPERATION=operation, **stats.summary())
+        for operation, stats in sorted(operations.items())
+    ]
@@ -3,33 +3,143 @@
 
 import subprocess
 import time
+from typing import List, Tuple
 
 import redis
 
 
 class RedisServer(object):
-    def __init__(self, host="localhost", port=7777, logfile=None) -> None:
+    def __init__(
+        self,
+        host="localhost",
+        port=7777,
+        logfile=None,
+        instances=1,
+        unix_socket=None,
+        persistence=False,
+        maxmemory=None,
+        maxmemory_policy=None,
+        io_threads=None,
+    ) -> None:
+        """A local redis-server, or instances of them on consecutive ports
+
+        The servers hold ephemeral pipeline data, so by default nothing is saved to
+        disk (no RDB snapshots, no AOF).
+
+        Args:
+            host (str, optional): Host of the servers. Defaults to "localhost".
+            port (int, optional): Port of the first server. Defaults to 7777.
+            logfile (str, optional): Log of the servers. Defaults to redis-{host}-{port}.log.
+            instances (int, optional): Servers to launch, e.g. one per core for a sharded
+                DataStorage (see endpoints). Defaults to 1.
+            unix_socket (str, optional): Listen on this unix domain socket instead of TCP, the path
+                may hold {port} (required with instances > 1). Defaults to None (TCP).
+            persistence (bool, optional): Keep the default RDB snapshots. Defaults to False.
+            maxmemory (str, optional): Memory limit of every server, e.g. "8gb". Defaults to None.
+            maxmemory_policy (str, optional): Eviction policy at the limit, e.g. "volatile-lru".
+                Defaults to None (redis-server default, noeviction).
+            io_threads (int, optional): Threads doing the socket I/O of every server. Defaults to None.
+        """
         self.host = host
         self.port = port
         self.logfile = logfile
+        self.instances = instances
+        self.unix_socket = unix_socket
+        self.persistence = persistence
+        self.maxmemory = maxmemory
+        self.maxmemory_policy = maxmemory_policy
+        self.io_threads = io_threads
+        self.processes = list()
         return
 
-    def start_redis_server(self) -> None:
-        log_filename = (
-            self.logfile if self.logfile else f"redis-{self.host}-{self.port}.log"
-        )
-        with open(log_filename, "a+") as log:
-            subprocess.Popen(
-                ["redis-server", "--port", f"{self.port}"],
-                close_fds=True,
-                stdout=log,
-                stderr=log,
+    @property
+    def endpoints(self) -> List[Tuple[str, int]]:
+        """The endpoint of every server, as expected by DataStorage(endpoints=...)
+
+        A server on a unix socket is (socket path, None).
+        """
+        ports = range(self.port, self.port + self.instances)
+        if self.unix_socket:
+            return [(self.unix_socket.format(port=port), None) for port in ports]
+        return [(self.host, port) for port in ports]
+
+    def _arguments(self, host: str, port: int) -> List[str]:
+        if port is None:
+            arguments = ["--port", "0", "--unixsocket", host, "--unixsocketperm", "700"]
+        else:
+            arguments = ["--port", f"{port}"]
+        if not self.persistence:
+            arguments += ["--save", "", "--appendonly", "no"]
+        if self.maxmemory:
+            arguments += ["--maxmemory", f"{self.maxmemory}"]
+        if self.maxmemory_policy:
+            arguments += ["--maxmemory-policy", self.maxmemory_policy]
+        if self.io_threads:
+            arguments += ["--io-threads", f"{self.io_threads}"]
+            arguments += ["--io-threads-do-reads", "yes"]
+        return arguments
+
+    def _client(self, host: str, port: int) -> redis.Redis:
+        if port is None:
+            return redis.Redis(unix_socket_path=host, db=0)
+        return redis.Redis(host=host, port=port, db=0)
+
+    def start_redis_server(self, timeout: float = 10.0) -> None:
+        """Launch the servers, returning once every one of them answers PING
+
+        Args:
+            timeout (float, optional): Seconds to wait for the servers. Defaults to 10.0.
+        """
+        for port, (host, endpoint_port) in enumerate(self.endpoints, self.port):
+            log_filename = (
+                self.logfile if self.logfile else f"redis-{self.host}-{port}.log"
             )
+            with open(log_filename, "a+") as log:
+                self.processes.append(
+                    subprocess.Popen(
+                        ["redis-server"] + self._arguments(host, endpoint_port),
+                        close_fds=True,
+                        stdout=log,
+                        stderr=log,
+                    )
+                )
+
+        self.wait_until_ready(timeout)
+        return
+
+    def wait_until_ready(self, timeout: float = 10.0) -> None:
+        """Probe every server with PING until it answers
+
+        Args:
+            timeout (float, optional): Seconds to wait for the servers. Defaults to 10.0.
 
-        time.sleep(2)
+        Raises:
+            RuntimeError: a server exited, or did not answer in time
+        """
+        deadline = time.monotonic() + timeout
+        for host, port in self.endpoints:
+            con = self._client(host, port)
+            while True:
+                try:
+                    if con.ping():
+                        break
+                except redis.ConnectionError:
+                    pass
+                if any(process.poll() is not None for process in self.processes):
+                    raise RuntimeError(
+                        f"redis-server {host}:{port} exited, see its log"
+                    )
+                if time.monotonic() > deadline:
+                    raise RuntimeError(f"redis-server {host}:{port} is not answering")
+                time.sleep(0.01)
+            con.close()
         return
 
     def stop_redis_server(self) -> None:
-        con = redis.Redis(host=self.host, port=self.port, db=0)
-        con.shutdown(False)
+        for host, port in self.endpoints:
+            con = self._client(host, port)
+            con.shutdown(False)
+        for process in self.processes:
+            process.wait()
+        self.processes = list()
         return
@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+
+""" parallel.py. Parallel I/O of the External Data Storage (@) 2022
+This module holds the threads moving a large value: its frames are compressed
+in parallel while the chunks already encoded are uploaded, a stripe per thread
+(and connection), and it is read back the same way (see stream).
+This program is free software: you can redistribute it and/or modify it under
+the terms of the GNU General Public License as published by the Free Software
+Foundation, either version 3 of the License, or (at your option) any later
+version.
+This program is distributed in the hope that it will be useful, but WITHOUT
+ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+You should have received a copy of the GNU General Public License along with
+this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+
+# COPYRIGHT SECTION
+__author__ = "Diego Carvalho"
+__copyright__ = "Copyright 2022"
+__credits__ = ["Diego Carvalho"]
+__license__ = "GPL"
+__version__ = "1.0.1"
+__maintainer__ = "Diego Carvalho"
+__email__ = "d.carvalho@ieee.org"
+__status__ = "Research"
+
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict
+
+from .cache import estimate_size
+
+
+class ParallelIO(object):
+    """The worker threads of a process, parallelism of them, and which values they
+    move: the ones from threshold bytes in memory (see estimate_size).
+
+    The threads are started on the first large value, and a forked worker process
+    starts its own.
+    """
+
+    def __init__(
+        self, parallelism: int, threshold: int, previous: "ParallelIO" = None
+    ) -> None:
+        """ParallelIO Constructor
+
+        Args:
+            parallelism (int): threads (and connections) moving a value, 1 is off
+            threshold (int): in-memory size from which a value is moved in parallel
+            previous (ParallelIO, optional): the parallel I/O of a previous
+                construction, its threads are taken over. Defaults to None.
+        """
+        self.parallelism = parallelism
+        self.threshold = threshold
+        self.executor = previous.executor if previous else None
+        self.owner = previous.owner if previous else None
+        return
+
+    def workers(self) -> ThreadPoolExecutor:
+        """The threads moving large values"""
+        owner = (os.getpid(), self.parallelism)
+        if self.executor is None or self.owner != owner:
+            if self.executor is not None and self.owner[0] == owner[0]:
+                self.executor.shutdown(wait=False)
+            self.executor = ThreadPoolExecutor(
+                max_workers=self.parallelism, thread_name_prefix="datastorage"
+            )
+            self.owner = owner
+        return self.executor
+
+    def writes(self, datum: Any) -> bool:
+        """Whether a datum is large enough to be written in parallel"""
+        return self.parallelism > 1 and estimate_size(datum) >= self.threshold
+
+    def reads(self, metadata: Dict) -> bool:
+        """Whether a stored value is large enough to be read in parallel"""
+        return (
+            self.parallelism > 1
+            and metadata["stripes"] > 1
+            and metadata["dtsize"] >= self.threshold
+        )
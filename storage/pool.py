@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+
+""" pool.py. Shared Redis connections for the External Data Storage (@) 2022
+This module keeps one connection pool per (host, port, pid), so every DataStorage
+built by the tasks of a worker process reuses the same sockets. A forked child
+never inherits the pools of its parent, it builds its own on first use.
+This program is free software: you can redistribute it and/or modify it under
+the terms of the GNU General Public License as published by the Free Software
+Foundation, either version 3 of the License, or (at your option) any later
+version.
+This program is distributed in the hope that it will be useful, but WITHOUT
+ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+You should have received a copy of the GNU General Public License along with
+this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+
+# COPYRIGHT SECTION
+__author__ = "Diego Carvalho"
+__copyright__ = "Copyright 2022"
+__credits__ = ["Diego Carvalho"]
+__license__ = "GPL"
+__version__ = "1.0.1"
+__maintainer__ = "Diego Carvalho"
+__email__ = "d.carvalho@ieee.org"
+__status__ = "Research"
+
+import os
+import threading
+from typing import Dict, Tuple
+
+import redis
+
+_pools: Dict[Tuple[str, int, int], redis.ConnectionPool] = dict()
+_lock = threading.Lock()
+_statistics = {"hits": 0, "misses": 0}
+
+
+def connection_pool(host: str, port: int = None) -> redis.ConnectionPool:
+    """Return the connection pool of this process for a Redis server
+
+    Args:
+        host (str): Host where the RedisServer is running, or the path of its unix socket
+        port (int, optional): Port number of the RedisServer, None for a unix socket. Defaults to None.
+
+    Returns:
+        redis.ConnectionPool: the pool shared by every client of (host, port) in this process
+    """
+    key = (host, port, os.getpid())
+    with _lock:
+        pool = _pools.get(key)
+        if pool is not None:
+            _statistics["hits"] += 1
+            return pool
+        _statistics["misses"] += 1
+        if port is None:
+            # A local server, no TCP stack on the way
+            pool = redis.ConnectionPool(
+                connection_class=redis.UnixDomainSocketConnection,
+                path=host,
+                db=0,
+                health_check_interval=30,
+                socket_timeout=10,
+                retry_on_timeout=True,
+            )
+        else:
+            pool = redis.ConnectionPool(
+                host=host,
+                port=port,
+                db=0,
+                health_check_interval=30,
+                socket_timeout=10,
+                socket_keepalive=True,
+                socket_connect_timeout=10,
+                retry_on_timeout=True,
+            )
+        _pools[key] = pool
+    return pool
+
+
+def pool_statistics() -> Dict[str, int]:
+    """Pool lookups served by an existing pool (hits) or that built one (misses)"""
+    with _lock:
+        return dict(_statistics, pools=len(_pools))
+
+
+def _after_fork_in_child() -> None:
+    # The sockets belong to the parent: forget them without closing them, and
+    # start the child with a fresh lock in case the fork happened while it was held
+    global _lock
+    _lock = threading.Lock()
+    _pools.clear()
+    _statistics.update(hits=0, misses=0)
+    return
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_after_fork_in_child)
@@ -0,0 +1,227 @@
+# -*- coding: utf-8 -*-
+
+""" scripts.py. Server-side scripts of the External Data Storage (@) 2022
+This module holds the Lua scripts DataStorage runs inside Redis (through
+EVALSHA) to publish, delete and wipe values atomically. A script never leaves a
+key half updated, and a whole operation costs a single command in a pipeline.
+This program is free software: you can redistribute it and/or modify it under
+the terms of the GNU General Public License as published by the Free Software
+Foundation, either version 3 of the License, or (at your option) any later
+version.
+This program is distributed in the hope that it will be useful, but WITHOUT
+ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+You should have received a copy of the GNU General Public License along with
+this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+
+# COPYRIGHT SECTION
+__author__ = "Diego Carvalho"
+__copyright__ = "Copyright 2022"
+__credits__ = ["Diego Carvalho"]
+__license__ = "GPL"
+__version__ = "1.0.1"
+__maintainer__ = "Diego Carvalho"
+__email__ = "d.carvalho@ieee.org"
+__status__ = "Research"
+
+from typing import Dict
+
+# Hex digest length of the content-addressed chunks (blake2b, 16 bytes)
+DIGEST_SIZE = 32
+
+# Unlink the data key and the chunks (the stripes hashes, or a key per chunk in
+# the older layout) of the value described by a metadata hash, unless the value
+# is in the data key being kept. The file of a value in shared memory or on disk
+# is pushed to /{store}/files, for the client to unlink once the script ran. The
+# content-addressed chunks of a "cas" value are released, and unlinked when no
+# other value references them. In a sharded store (see sharded) the chunks live
+# on other servers: their keys are pushed to /{store}/garbage for the client to
+# unlink, and the content-addressed ones are left to expire, since a writer may
+# be taking them back.
+DROP_VALUE = (
+    "local DIGEST_SIZE = %d\nlocal SHARDED = false\n" % DIGEST_SIZE
+    + """
+local function unlink_all(keys)
+    for i = 1, #keys, 1000 do
+        redis.call("UNLINK", unpack(keys, i, math.min(i + 999, #keys)))
+    end
+end
+
+local function drop_chunks(data, keys)
+    if not SHARDED then
+        unlink_all(keys)
+        return
+    end
+    local garbage = "/" .. string.match(data, "^/([^/]+)/") .. "/garbage"
+    for i = 1, #keys, 1000 do
+        redis.call("RPUSH", garbage, unpack(keys, i, math.min(i + 999, #keys)))
+    end
+end
+
+local function release_chunks(data, manifest)
+    local store = "/" .. string.match(data, "^/([^/]+)/")
+    local gone = {}
+    for i = 1, #manifest, DIGEST_SIZE do
+        local digest = string.sub(manifest, i, i + DIGEST_SIZE - 1)
+        if redis.call("HINCRBY", store .. "/casrefs", digest, -1) <= 0 then
+            redis.call("HDEL", store .. "/casrefs", digest)
+            gone[#gone + 1] = store .. "/cas/" .. digest
+        end
+    end
+    if #gone > 0 and not SHARDED then
+        unlink_all(gone)
+    end
+end
+
+local function drop_value(meta, chunk_size, keep)
+    local m = redis.call(
+        "HMGET", meta, "data", "dtsize", "chunks", "backend", "manifest", "stripes"
+    )
+    if not m[1] or m[1] == keep then
+        return
+    end
+    if m[4] == "shm" or m[4] == "disk" then
+        redis.call("RPUSH", "/" .. string.match(meta, "^/([^/]+)/") .. "/files", m[1])
+        return
+    end
+    if m[4] == "cas" then
+        release_chunks(m[1], m[5])
+        return
+    end
+    redis.call("UNLINK", m[1])
+    local keys = {}
+    local stripes = tonumber(m[6]) or 0
+    if stripes > 0 then
+        for s = 0, stripes - 1 do
+            keys[#keys + 1] = m[1] .. "#" .. s
+        end
+    else
+        local n = tonumber(m[3])
+        if tonumber(m[2]) % chunk_size > 0 then
+            n = n + 1
+        end
+        for i = 0, n - 1 do
+            keys[#keys + 1] = m[1] .. ":" .. i
+        end
+    end
+    drop_chunks(m[1], keys)
+end
+"""
+)
+
+# KEYS: metadata hash, directory, name index
+# ARGV: user key, expiration, chunk size, data key, then the metadata field/value pairs
+REPLACE = (
+    DROP_VALUE
+    + """
+drop_value(KEYS[1], tonumber(ARGV[3]), ARGV[4])
+redis.call("DEL", KEYS[1])
+redis.call("HSET", KEYS[1], unpack(ARGV, 5))
+redis.call("EXPIRE", KEYS[1], ARGV[2])
+redis.call("SADD", KEYS[2], ARGV[1])
+redis.call("ZADD", KEYS[3], 0, ARGV[1])
+return 1
+"""
+)
+
+# KEYS: metadata hash, directory, name index
+# ARGV: user key, chunk size
+DELETE = (
+    DROP_VALUE
+    + """
+drop_value(KEYS[1], tonumber(ARGV[2]), false)
+redis.call("UNLINK", KEYS[1])
+redis.call("SREM", KEYS[2], ARGV[1])
+redis.call("ZREM", KEYS[3], ARGV[1])
+return 1
+"""
+)
+
+# Remove a batch of keys from the store, returns how many were removed. The
+# directory, the index, the unique ids and any other key given go with the last
+# (partial) batch.
+# KEYS: directory, name index, unique ids, then the other store-wide keys
+# ARGV: batch size, chunk size, metadata hash prefix
+WIPE = (
+    DROP_VALUE
+    + """
+if redis.replicate_commands then
+    redis.replicate_commands()
+end
+local batch = tonumber(ARGV[1])
+local skeys = redis.call("SPOP", KEYS[1], batch)
+local metas = {}
+for _, skey in ipairs(skeys) do
+    local meta = ARGV[3] .. skey
+    drop_value(meta, tonumber(ARGV[2]), false)
+    metas[#metas + 1] = meta
+end
+if #metas > 0 then
+    unlink_all(metas)
+    for i = 1, #skeys, 1000 do
+        redis.call("ZREM", KEYS[2], unpack(skeys, i, math.min(i + 999, #skeys)))
+    end
+end
+if #skeys < batch then
+    redis.call("UNLINK", unpack(KEYS))
+end
+return #skeys
+"""
+)
+
+
+# Take a reference to every chunk of a content-addressed value before it is
+# published, returns the digests of the chunks that must be uploaded. A chunk
+# already there is pinned by the reference and its TTL is stretched to ex.
+# A count is never reset: one left by a value that expired only keeps the chunk
+# until its TTL, while a reset could drop a chunk another writer is uploading.
+# KEYS: reference counts hash
+# ARGV: expiration, chunk key prefix, then the chunk digests in value order
+CAS_ACQUIRE = """
+local ex = tonumber(ARGV[1])
+local counts, digests = {}, {}
+for i = 3, #ARGV do
+    local digest = ARGV[i]
+    if not counts[digest] then
+        counts[digest] = 0
+        digests[#digests + 1] = digest
+    end
+    counts[digest] = counts[digest] + 1
+end
+local missing = {}
+for _, digest in ipairs(digests) do
+    local chunk = ARGV[2] .. digest
+    redis.call("HINCRBY", KEYS[1], digest, counts[digest])
+    if redis.call("EXISTS", chunk) == 0 then
+        missing[#missing + 1] = digest
+    elseif redis.call("TTL", chunk) < ex then
+        redis.call("EXPIRE", chunk, ex)
+    end
+end
+return missing
+"""
+
+
+def sharded(script: str) -> str:
+    """The variant of a script for a store whose chunks are spread over several servers"""
+    return script.replace("local SHARDED = false", "local SHARDED = true", 1)
+
+
+def register_scripts(con, sharded_store: bool = False) -> Dict:
+    """Register the scripts on a client, they run with EVALSHA (loaded on demand)
+
+    Args:
+        con (redis.Redis): the client
+        sharded_store (bool, optional): the chunks live on other servers (see sharded). Defaults to False.
+
+    Returns:
+        Dict: the replace, delete, wipe and cas_acquire scripts, callable with keys, args and client
+    """
+    variant = sharded if sharded_store else str
+    return {
+        "replace": con.register_script(variant(REPLACE)),
+        "delete": con.register_script(variant(DELETE)),
+        "wipe": con.register_script(variant(WIPE)),
+        "cas_acquire": con.register_script(CAS_ACQUIRE),
+    }
@@ -0,0 +1,341 @@
+# -*- coding: utf-8 -*-
+
+""" sharding.py. Sharded Redis client of the External Data Storage (@) 2022
+This module spreads the chunks of the stored values over several Redis servers
+by consistent hashing, while every other key (metadata, directory, index, queues
+and counters) stays pinned to the first server, where the scripts run. The
+chunks of a large value land on every server, and a pipeline talks to all of
+them in parallel.
+This program is free software: you can redistribute it and/or modify it under
+the terms of the GNU General Public License as published by the Free Software
+Foundation, either version 3 of the License, or (at your option) any later
+version.
+This program is distributed in the hope that it will be useful, but WITHOUT
+ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+You should have received a copy of the GNU General Public License along with
+this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+
+# COPYRIGHT SECTION
+__author__ = "Diego Carvalho"
+__copyright__ = "Copyright 2022"
+__credits__ = ["Diego Carvalho"]
+__license__ = "GPL"
+__version__ = "1.0.1"
+__maintainer__ = "Diego Carvalho"
+__email__ = "d.carvalho@ieee.org"
+__status__ = "Research"
+
+import bisect
+import hashlib
+import re
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, List, Tuple
+
+import redis
+
+# Chunk keys live under a prefix of their own, that no user key (queue, set) can
+# take: /{store}/chunk/ (the stripes "{mapped_key}#{n}" of the hash layout, or
+# "{mapped_key}:{n}" in the key per chunk layout) and /{store}/cas/
+CHUNK_KEY = re.compile(r"^/[^/]+/(?:chunk|cas)/")
+STRIPE_KEY = re.compile(r"^(.*)#(\d+)$")
+
+
+def parse_endpoints(endpoints) -> List[Tuple[str, int]]:
+    """Normalize a list of Redis endpoints, given as "host:port", (host, port), or
+    a unix socket as "unix:///path", "/path" or (path, None)
+
+    Args:
+        endpoints: a list, or a comma separated str, of endpoints
+
+    Returns:
+        List[Tuple[str, int]]: the (host, port) pairs, (path, None) for unix sockets
+    """
+    if isinstance(endpoints, str):
+        endpoints = [e for e in endpoints.split(",") if e.strip()]
+    parsed = list()
+    for endpoint in endpoints:
+        if isinstance(endpoint, str):
+            endpoint = endpoint.strip()
+            if endpoint.startswith("unix://"):
+                endpoint = (endpoint[len("unix://") :], None)
+            elif endpoint.startswith("/"):
+                endpoint = (endpoint, None)
+            else:
+                host, _, port = endpoint.rpartition(":")
+                endpoint = (host, port)
+        host, port = endpoint
+        parsed.append((host, int(port) if port is not None else None))
+    return parsed
+
+
+def endpoint_name(endpoint: Tuple[str, int]) -> str:
+    """The name of an endpoint in the hash ring, "host:port" or the socket path"""
+    host, port = endpoint
+    return host if port is None else f"{host}:{port}"
+
+
+def _key(key) -> str:
+    return key.decode() if isinstance(key, bytes) else str(key)
+
+
+class HashRing(object):
+    """Consistent hashing of keys over named nodes.
+
+    Every node owns replicas points of the ring, and a key belongs to the node of
+    the first point after its hash, so adding or removing a node only moves the
+    keys of that node.
+    """
+
+    def __init__(self, names: List[str], replicas: int = 128) -> None:
+        points = sorted(
+            (self.hash(f"{name}#{replica}"), node)
+            for node, name in enumerate(names)
+            for replica in range(replicas)
+        )
+        self.hashes = [point for point, _ in points]
+        self.nodes = [node for _, node in points]
+        return
+
+    @staticmethod
+    def hash(key: str) -> int:
+        return int.from_bytes(
+            hashlib.blake2b(key.encode(), digest_size=8).digest(), "big"
+        )
+
+    def node(self, key: str) -> int:
+        """Index (in names) of the node owning key"""
+        point = bisect.bisect(self.hashes, self.hash(key)) % len(self.hashes)
+        return self.nodes[point]
+
+
+class ShardedScript(object):
+    """A script of the first server, queued in its part of a ShardedPipeline"""
+
+    def __init__(self, script) -> None:
+        self.script = script
+        return
+
+    def __call__(self, keys: List = [], args: List = [], client=None) -> Any:
+        if isinstance(client, ShardedPipeline):
+            return client.queue_script(self.script, keys, args)
+        return self.script(keys=keys, args=args, client=client)
+
+
+class ShardedPipeline(object):
+    """A pipeline per server, replies handed back in the order commands were queued.
+
+    Multi-key commands (mget, unlink, delete, exists) are split by server. The
+    servers are sent their commands in parallel, except when a script is queued:
+    the pinned commands then wait for the chunks, so a script never publishes a
+    value whose chunks are still on their way.
+    """
+
+    # Commands taking any number of keys, and how their partial replies combine
+    multi_key = {"unlink": sum, "delete": sum, "exists": sum}
+
+    def __init__(self, con: "ShardedRedis", transaction: bool = True) -> None:
+        self.con = con
+        self.pinned = con.primary.pipeline(transaction=transaction)
+        self.shards = [client.pipeline(transaction=False) for client in con.clients]
+        self.replies = list()
+        self.ordered = False
+        return
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.reset()
+        return
+
+    def __len__(self) -> int:
+        return len(self.replies)
+
+    def _pipe(self, key):
+        node = self.con.node(key)
+        return self.pinned if node is None else self.shards[node]
+
+    def _queue(self, pipe, command: str, *args, **kwargs) -> Tuple:
+        getattr(pipe, command)(*args, **kwargs)
+        return (pipe, len(pipe) - 1)
+
+    def __getattr__(self, command: str) -> Callable:
+        if command.startswith("_"):
+            raise AttributeError(command)
+
+        def queue(*args, **kwargs):
+            if command in self.multi_key:
+                by_pipe = dict()
+                for key in args:
+                    by_pipe.setdefault(self._pipe(key), list()).append(key)
+                parts = [
+                    self._queue(pipe, command, *keys) for pipe, keys in by_pipe.items()
+                ]
+                self.replies.append((self.multi_key[command], parts))
+                return self
+            key = args[0] if args else kwargs["name"]
+            part = self._queue(self._pipe(key), command, *args, **kwargs)
+            self.replies.append((lambda replies: replies[0], [part]))
+            return self
+
+        return queue
+
+    def mget(self, keys, *args):
+        keys = [keys] if isinstance(keys, (str, bytes)) else list(keys)
+        keys += list(args)
+        positions = dict()
+        for position, key in enumerate(keys):
+            positions.setdefault(self._pipe(key), list()).append(position)
+        parts = [
+            self._queue(pipe, "mget", [keys[position] for position in at])
+            for pipe, at in positions.items()
+        ]
+        order = list(positions.values())
+
+        def combine(replies: List) -> List:
+            values = [None] * len(keys)
+            for at, reply in zip(order, replies):
+                for position, value in zip(at, reply):
+                    values[position] = value
+            return values
+
+        self.replies.append((combine, parts))
+        return self
+
+    def queue_script(self, script, keys: List, args: List):
+        script(keys=keys, args=args, client=self.pinned)
+        part = (self.pinned, len(self.pinned) - 1)
+        self.replies.append((lambda replies: replies[0], [part]))
+        self.ordered = True
+        return self
+
+    def execute(self) -> List:
+        shards = [pipe for pipe in self.shards if len(pipe) > 0]
+        if len(self.pinned) > 0 and not self.ordered:
+            shards.append(self.pinned)
+        replies = self.con.map(lambda pipe: pipe.execute(), shards)
+        results = dict(zip(map(id, shards), replies))
+        if len(self.pinned) > 0 and self.ordered:
+            results[id(self.pinned)] = self.pinned.execute()
+        replies = [
+            combine([results[id(pipe)][i] for pipe, i in parts])
+            for combine, parts in self.replies
+        ]
+        self.reset()
+        return replies
+
+    def reset(self) -> None:
+        self.pinned.reset()
+        for pipe in self.shards:
+            pipe.reset()
+        self.replies = list()
+        self.ordered = False
+        return
+
+
+class ShardedRedis(object):
+    """A Redis client over several servers: the chunk keys are spread by consistent
+    hashing (see HashRing), every other key lives in the first server.
+
+    Chunk commands (get, set, hset, hmget, mget, expire, persist, ttl, unlink,
+    delete, exists) are routed by key, any other command goes to the first server.
+    """
+
+    routed = {
+        "get",
+        "set",
+        "hset",
+        "hmget",
+        "mget",
+        "expire",
+        "persist",
+        "ttl",
+        "unlink",
+        "delete",
+        "exists",
+    }
+
+    def __init__(self, clients: List[redis.Redis], names: List[str]) -> None:
+        self.clients = clients
+        self.primary = clients[0]
+        self.ring = HashRing(names)
+        self.pools = [client.connection_pool for client in clients]
+        self.connection_pool = self.primary.connection_pool
+        self._executor = None
+        return
+
+    def __repr__(self) -> str:
+        return f"{self.__class__.__name__}({len(self.clients)} servers)"
+
+    def __getattr__(self, command: str) -> Any:
+        if command not in self.routed:
+            return getattr(self.primary, command)
+
+        def call(*args, **kwargs):
+            with self.pipeline(transaction=False) as pipe:
+                getattr(pipe, command)(*args, **kwargs)
+                return pipe.execute()[0]
+
+        return call
+
+    def node(self, key) -> int:
+        """Index of the server holding a chunk key (under the chunk prefixes, see
+        CHUNK_KEY), None for the other keys
+
+        The stripes of a value go to consecutive servers from the one of the value,
+        so they never share a server while there are enough of them.
+        """
+        key = _key(key)
+        if not CHUNK_KEY.match(key):
+            return None
+        stripe = STRIPE_KEY.match(key)
+        if stripe:
+            first = self.ring.node(stripe.group(1))
+            return (first + int(stripe.group(2))) % len(self.clients)
+        return self.ring.node(key)
+
+    def client(self, key) -> redis.Redis:
+        """The client of the server holding key"""
+        node = self.node(key)
+        return self.primary if node is None else self.clients[node]
+
+    def map(self, function: Callable, items: List) -> List:
+        """Apply function to every item, in parallel (one thread per server)"""
+        if len(items) <= 1:
+            return [function(item) for item in items]
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=len(self.clients) + 1)
+        return list(self._executor.map(function, items))
+
+    def pipeline(self, transaction: bool = True) -> ShardedPipeline:
+        return ShardedPipeline(self, transaction)
+
+    def register_script(self, script: str) -> ShardedScript:
+        return ShardedScript(self.primary.register_script(script))
+
+    def collect_garbage(self, tag: str, batch: int = 1000) -> None:
+        """Unlink the chunk keys the scripts pushed to the list tag, as they only
+        reach the first server (see scripts.sharded)
+
+        Args:
+            tag (str): the list of chunk keys
+            batch (int, optional): chunk keys unlinked per round trip. Defaults to 1000.
+        """
+        while True:
+            with self.primary.pipeline() as pipe:
+                pipe.lrange(tag, 0, batch - 1)
+                pipe.ltrim(tag, batch, -1)
+                chunk_keys = pipe.execute()[0]
+            if chunk_keys:
+                self.unlink(*chunk_keys)
+            if len(chunk_keys) < batch:
+                return
+
+    def unlink_matching(self, pattern: str, batch: int = 1000) -> None:
+        """Unlink the keys matching a pattern on every server"""
+        for client in self.clients:
+            for key in client.scan_iter(pattern, count=batch):
+                client.unlink(key)
+        return
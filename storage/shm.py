@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+
+""" shm.py. Shared memory tier for the External Data Storage (@) 2022
+This module keeps large encoded values as memory-mapped files under /dev/shm,
+so processes on the same host exchange them without going through the Redis
+socket. Redis keeps only the metadata (pointing to the file) and the directory.
+This program is free software: you can redistribute it and/or modify it under
+the terms of the GNU General Public License as published by the Free Software
+Foundation, either version 3 of the License, or (at your option) any later
+version.
+This program is distributed in the hope that it will be useful, but WITHOUT
+ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+You should have received a copy of the GNU General Public License along with
+this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+
+# COPYRIGHT SECTION
+__author__ = "Diego Carvalho"
+__copyright__ = "Copyright 2022"
+__credits__ = ["Diego Carvalho"]
+__license__ = "GPL"
+__version__ = "1.0.1"
+__maintainer__ = "Diego Carvalho"
+__email__ = "d.carvalho@ieee.org"
+__status__ = "Research"
+
+import mmap
+import os
+import shutil
+import time
+from typing import Iterator, Tuple
+from urllib.parse import quote, unquote
+
+
+class SharedMemoryBackend(object):
+    """Memory-mapped files under a tmpfs directory, one file per key version.
+
+    Every version of a key has its own file, written under a temporary name and
+    renamed, so a reader that already mapped (or is about to map) a value keeps
+    seeing it until the file of a replaced version is unlinked, once the new
+    metadata is published.
+    """
+
+    def __init__(self, store_name: str, directory: str = "/dev/shm") -> None:
+        self.directory = os.path.join(directory, f"datastorage-{store_name}")
+        return
+
+    def path(self, skey: str, version: int) -> str:
+        """Return the file holding a version of the value of a user key"""
+        return os.path.join(self.directory, f"{quote(skey, safe='')}@{version}")
+
+    def write(self, skey: str, version: int, encoded_data) -> str:
+        """Store an encoded value and return the path recorded in the metadata"""
+        os.makedirs(self.directory, exist_ok=True)
+        path = self.path(skey, version)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(encoded_data)
+        os.replace(tmp_path, path)
+        return path
+
+    def read(self, path: str) -> memoryview:
+        """Map a stored value read-only, None if the file is gone"""
+        try:
+            with open(path, "rb") as f:
+                if os.fstat(f.fileno()).st_size == 0:
+                    return memoryview(b"")
+                # The mapping outlives the descriptor, and it is released when
+                # the last buffer referencing it (e.g. a decoded frame) goes away
+                return memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+        except FileNotFoundError:
+            return None
+
+    def unlink(self, path: str) -> None:
+        """Remove a stored value (processes still mapping it keep their copy)"""
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+        return
+
+    def files(self, grace: float = 0) -> Iterator[Tuple[str, str]]:
+        """The (path, user key) of the files not modified for grace seconds
+
+        Temporary files left by a writer that died are named after no key (None).
+        """
+        try:
+            names = os.listdir(self.directory)
+        except FileNotFoundError:
+            return
+        deadline = time.time() - grace
+        for name in names:
+            path = os.path.join(self.directory, name)
+            try:
+                if os.stat(path).st_mtime > deadline:
+                    continue
+            except FileNotFoundError:
+                continue
+            skey = None if name.endswith(".tmp") else unquote(name.rpartition("@")[0])
+            yield path, skey
+
+    def reset(self) -> None:
+        """Remove every value of the store"""
+        shutil.rmtree(self.directory, ignore_errors=True)
+        return
@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+
+""" spill.py. Disk tier for the External Data Storage (@) 2022
+This module keeps large encoded values as compressed files in a local directory,
+where DataStorage spills them while Redis is running out of memory. Redis keeps
+only the metadata (pointing to the file) and the directory, and the values are
+read back, transparently, by the same get.
+This program is free software: you can redistribute it and/or modify it under
+the terms of the GNU General Public License as published by the Free Software
+Foundation, either version 3 of the License, or (at your option) any later
+version.
+This program is distributed in the hope that it will be useful, but WITHOUT
+ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+You should have received a copy of the GNU General Public License along with
+this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+
+# COPYRIGHT SECTION
+__author__ = "Diego Carvalho"
+__copyright__ = "Copyright 2022"
+__credits__ = ["Diego Carvalho"]
+__license__ = "GPL"
+__version__ = "1.0.1"
+__maintainer__ = "Diego Carvalho"
+__email__ = "d.carvalho@ieee.org"
+__status__ = "Research"
+
+import os
+
+import blosc
+
+from .shm import SharedMemoryBackend
+from tools.serializer import BloscCodec, FrameWriter
+
+
+class SpillBackend(SharedMemoryBackend):
+    """Compressed files under a local directory, one file per key.
+
+    A file starts with a tag: b"Z" when the value was compressed into blosc frames
+    (see FrameWriter), b"R" when it is stored as is, e.g. because it is already
+    compressed. Files are replaced atomically, as in SharedMemoryBackend.
+    """
+
+    frame_size = 4 * 1024 * 1024
+
+    def __init__(self, store_name: str, directory: str, codec: BloscCodec = None):
+        super().__init__(store_name, directory)
+        self.codec = codec if codec else BloscCodec("lz4", clevel=5, typesize=1)
+        return
+
+    def write(
+        self, skey: str, version: int, encoded_data, compress: bool = True
+    ) -> str:
+        """Store an encoded value and return the path recorded in the metadata"""
+        os.makedirs(self.directory, exist_ok=True)
+        path = self.path(skey, version)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            if compress:
+                f.write(b"Z")
+                with FrameWriter(f, self.frame_size, self.codec) as frames:
+                    frames.write(encoded_data)
+            else:
+                f.write(b"R")
+                f.write(encoded_data)
+        os.replace(tmp_path, path)
+        return path
+
+    def read(self, path: str) -> memoryview:
+        """Load a stored value (mapped when it is not compressed), None if the file is gone"""
+        view = super().read(path)
+        if view is None:
+            return None
+        if view[:1] == b"R":
+            return view[1:]
+        frames, offset = list(), 1
+        while offset < len(view):
+            (size,) = FrameWriter.header.unpack_from(view, offset)
+            offset += FrameWriter.header.size
+            frames.append(blosc.decompress(view[offset : offset + size]))
+            offset += size
+        return memoryview(b"".join(frames))
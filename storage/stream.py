@@ -0,0 +1,327 @@
+# -*- coding: utf-8 -*-
+
+""" stream.py. Streaming access to the External Data Storage (@) 2022
+This module provides the chunk layouts of a value in Redis, and the file-like
+objects returned by DataStorage.open_read and DataStorage.open_write. They move a
+value chunk by chunk (a window of chunks per round trip), so a value never has to
+be fully materialized to be read or written.
+This program is free software: you can redistribute it and/or modify it under
+the terms of the GNU General Public License as published by the Free Software
+Foundation, either version 3 of the License, or (at your option) any later
+version.
+This program is distributed in the hope that it will be useful, but WITHOUT
+ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+You should have received a copy of the GNU General Public License along with
+this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+
+# COPYRIGHT SECTION
+__author__ = "Diego Carvalho"
+__copyright__ = "Copyright 2022"
+__credits__ = ["Diego Carvalho"]
+__license__ = "GPL"
+__version__ = "1.0.1"
+__maintainer__ = "Diego Carvalho"
+__email__ = "d.carvalho@ieee.org"
+__status__ = "Research"
+
+import io
+from concurrent.futures import Executor, Future, wait
+from typing import Callable, Iterator, List
+
+
+class KeyChunks(object):
+    """Chunks kept in a string key each (content-addressed chunks, and the values
+    written before the hash layout), fetched with MGET
+    """
+
+    def __init__(self, keys: List[str]) -> None:
+        # The keys holding the chunks, a TTL each
+        self.keys = keys
+        return
+
+    def __len__(self) -> int:
+        return len(self.keys)
+
+    def queue_fetch(self, pipe, first: int, last: int) -> int:
+        """Queue the commands fetching chunks [first, last), returns the replies queued"""
+        if last <= first:
+            return 0
+        pipe.mget(self.keys[first:last])
+        return 1
+
+    def join(self, replies: List, first: int, last: int) -> List[bytes]:
+        """The chunks [first, last) in the replies of queue_fetch (None if gone)"""
+        return replies[0] if last > first else list()
+
+
+class HashChunks(object):
+    """Chunks kept in the fields of stripes hashes: chunk n is field n of the hash
+    "{mapped_key}#{n % stripes}". A single EXPIRE per stripe covers all the chunks,
+    so they expire together, and the stripes of a sharded store land on different
+    servers (see sharding).
+    """
+
+    def __init__(self, mapped_key: str, n_chunks: int, stripes: int) -> None:
+        # The keys holding the chunks, a TTL each
+        self.keys = [f"{mapped_key}#{stripe}" for stripe in range(stripes)]
+        self.n_chunks = n_chunks
+        return
+
+    def __len__(self) -> int:
+        return self.n_chunks
+
+    def stripe(self, n: int) -> int:
+        """The stripe holding chunk n"""
+        return n % len(self.keys)
+
+    def queue_store(self, pipe, n: int, chunk) -> None:
+        """Queue the command storing chunk n (the TTLs are set by queue_expire)"""
+        pipe.hset(self.keys[self.stripe(n)], n, chunk)
+        return
+
+    def queue_expire(self, pipe, ex: int) -> None:
+        for key in self.keys:
+            pipe.expire(key, ex)
+        return
+
+    def stripe_fields(self, first: int, last: int) -> List:
+        """The (key, fields) holding chunks [first, last) in every stripe"""
+        stripes = len(self.keys)
+        fields = [list(range(first + s, last, stripes)) for s in range(stripes)]
+        # Chunk first is in stripe first % stripes, rotate so the lists line up
+        shift = first % stripes
+        return [(self.keys[(shift + s) % stripes], f) for s, f in enumerate(fields)]
+
+    def queue_fetch(self, pipe, first: int, last: int) -> int:
+        """Queue the commands fetching chunks [first, last), returns the replies queued"""
+        queued = 0
+        for key, fields in self.stripe_fields(first, last):
+            if fields:
+                pipe.hmget(key, fields)
+                queued += 1
+        return queued
+
+    def join(self, replies: List, first: int, last: int) -> List[bytes]:
+        """The chunks [first, last) in the replies of queue_fetch (None if gone)"""
+        chunks = [None] * (last - first)
+        stripes = [fields for _, fields in self.stripe_fields(first, last) if fields]
+        for fields, reply in zip(stripes, replies):
+            for n, chunk in zip(fields, reply):
+                chunks[n - first] = chunk
+        return chunks
+
+
+class ChunkReader(io.RawIOBase):
+    """Read a chunked value, fetching a window of chunks per round trip.
+
+    The TTLs of the value are refreshed with the first window. A chunk that
+    expired underneath the reader raises an IOError. Given an executor, the
+    stripes of a HashChunks window are fetched in parallel, a connection each,
+    and the next window is on its way while the current one is read.
+    """
+
+    def __init__(
+        self,
+        con,
+        chunks,
+        ex: int,
+        window: int,
+        refresh: List[str] = None,
+        gt: bool = False,
+        executor: Executor = None,
+    ) -> None:
+        self.con = con
+        self.chunks = chunks
+        self.ex = ex
+        self.window = window
+        self.refresh = refresh if refresh else list()
+        # Refresh with EXPIRE ... GT, leaving pinned values alone
+        self.gt = gt
+        self.executor = executor
+        self._chunks = self.iter_chunks()
+        self._chunk = memoryview(b"")
+        return
+
+    def readable(self) -> bool:
+        return True
+
+    def _queue_refresh(self, pipe) -> None:
+        for key in self.chunks.keys + self.refresh:
+            pipe.expire(key, self.ex, gt=self.gt)
+        return
+
+    def _fetch(self, first: int, last: int) -> List[bytes]:
+        with self.con.pipeline(transaction=False) as pipe:
+            n = self.chunks.queue_fetch(pipe, first, last)
+            if first == 0:
+                self._queue_refresh(pipe)
+            return self.chunks.join(pipe.execute()[:n], first, last)
+
+    def _fetch_stripe(self, key: str, fields: List, refresh: bool) -> List[bytes]:
+        with self.con.pipeline(transaction=False) as pipe:
+            pipe.hmget(key, fields)
+            if refresh:
+                self._queue_refresh(pipe)
+            return pipe.execute()[0]
+
+    def _submit(self, first: int, last: int) -> List[Future]:
+        stripes = [sf for sf in self.chunks.stripe_fields(first, last) if sf[1]]
+        return [
+            self.executor.submit(self._fetch_stripe, key, fields, first == 0 and i == 0)
+            for i, (key, fields) in enumerate(stripes)
+        ]
+
+    def iter_chunks(self) -> Iterator[bytes]:
+        """Yield the chunks of the value as they arrive"""
+        n_chunks, upcoming = len(self.chunks), None
+        for first in range(0, n_chunks, self.window):
+            last = min(first + self.window, n_chunks)
+            if self.executor is None:
+                buffers = self._fetch(first, last)
+            else:
+                if upcoming is None:
+                    upcoming = self._submit(first, last)
+                fetching, upcoming = upcoming, None
+                if last < n_chunks:
+                    upcoming = self._submit(last, min(last + self.window, n_chunks))
+                replies = [future.result() for future in fetching]
+                buffers = self.chunks.join(replies, first, last)
+            for buffer in buffers:
+                if buffer is None:
+                    raise IOError("chunk expired while streaming the value")
+                yield buffer
+        return
+
+    def readinto(self, b) -> int:
+        while len(self._chunk) == 0:
+            buffer = next(self._chunks, None)
+            if buffer is None:
+                return 0
+            self._chunk = memoryview(buffer)
+        n = min(len(b), len(self._chunk))
+        b[:n] = self._chunk[:n]
+        self._chunk = self._chunk[n:]
+        return n
+
+
+class ChunkWriter(io.RawIOBase):
+    """Write a chunked value, sending a window of chunks per round trip.
+
+    The value becomes visible (publish is called with its size) only when the
+    writer is closed, so readers never see a partially written value. Every
+    window also sets the TTLs, so an abandoned value expires, and a with block
+    that raises aborts the value instead (see abort). Given an executor,
+    the stripes of a window are uploaded in parallel, a connection each, while
+    the next window is being written.
+    """
+
+    def __init__(
+        self,
+        con,
+        chunks: HashChunks,
+        chunk_size: int,
+        ex: int,
+        window: int,
+        publish: Callable,
+        executor: Executor = None,
+    ) -> None:
+        self.con = con
+        self.chunks = chunks
+        self.chunk_size = chunk_size
+        self.ex = ex
+        self.window = window
+        self.publish = publish
+        self.executor = executor
+        self.size = 0
+        self.n_chunks = 0
+        self.buffer = bytearray()
+        self.pipe = self.con.pipeline(transaction=False)
+        # The (n, chunk) of the window being written, and the uploads on their way
+        self.batch = list()
+        self.uploads = list()
+        return
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, b) -> int:
+        with memoryview(b) as view:
+            self.buffer += view
+            n = view.nbytes
+        self.size += n
+        while len(self.buffer) >= self.chunk_size:
+            self._write_chunk(self.chunk_size)
+        return n
+
+    def _write_chunk(self, n: int) -> None:
+        if self.executor is None:
+            self.chunks.queue_store(self.pipe, self.n_chunks, bytes(self.buffer[:n]))
+        else:
+            self.batch.append((self.n_chunks, bytes(self.buffer[:n])))
+        del self.buffer[:n]
+        self.n_chunks += 1
+        if max(len(self.pipe), len(self.batch)) >= self.window:
+            self._flush()
+        return
+
+    def _flush(self) -> None:
+        if self.executor is None:
+            self.chunks.queue_expire(self.pipe, self.ex)
+            self.pipe.execute()
+            return
+        # A single window on its way, so the chunks in memory stay bounded
+        self._wait()
+        stripes = dict()
+        for n, chunk in self.batch:
+            stripes.setdefault(self.chunks.stripe(n), list()).append((n, chunk))
+        self.uploads = [
+            self.executor.submit(self._upload, stripe, batch)
+            for stripe, batch in stripes.items()
+        ]
+        self.batch = list()
+        return
+
+    def _upload(self, stripe: int, batch: List) -> None:
+        with self.con.pipeline(transaction=False) as pipe:
+            for n, chunk in batch:
+                self.chunks.queue_store(pipe, n, chunk)
+            pipe.expire(self.chunks.keys[stripe], self.ex)
+            pipe.execute()
+        return
+
+    def _wait(self) -> None:
+        for upload in self.uploads:
+            upload.result()
+        self.uploads = list()
+        return
+
+    def close(self) -> None:
+        """Send the tail chunk and publish the value"""
+        if not self.closed:
+            if len(self.buffer) > 0:
+                self._write_chunk(len(self.buffer))
+            self._flush()
+            self._wait()
+            self.pipe.reset()
+            self.publish(self.size)
+        super().close()
+        return
+
+    def abort(self) -> None:
+        """Drop the value without publishing it, deleting the chunks already sent"""
+        if not self.closed:
+            self.pipe.reset()
+            # The uploads on their way land before their stripes are deleted
+            wait(self.uploads)
+            self.uploads, self.batch = list(), list()
+            self.buffer.clear()
+            self.con.delete(*self.chunks.keys)
+        super().close()
+        return
+
+    def __exit__(self, exc_type, *args) -> None:
+        if exc_type is not None:
+            self.abort()
+        return super().__exit__(exc_type, *args)
@@ -0,0 +1,212 @@
+# -*- coding: utf-8 -*-
+
+""" tiers.py. File tiers of the External Data Storage (@) 2022
+This module decides which large values leave Redis for a file on this host: the
+shared memory tier (see shm) and the disk tier, while Redis runs short of memory
+(see spill). Only the metadata of those values stays in Redis, and the files of
+the values replaced, deleted or expired are unlinked here.
+This program is free software: you can redistribute it and/or modify it under
+the terms of the GNU General Public License as published by the Free Software
+Foundation, either version 3 of the License, or (at your option) any later
+version.
+This program is distributed in the hope that it will be useful, but WITHOUT
+ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+You should have received a copy of the GNU General Public License along with
+this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+
+# COPYRIGHT SECTION
+__author__ = "Diego Carvalho"
+__copyright__ = "Copyright 2022"
+__credits__ = ["Diego Carvalho"]
+__license__ = "GPL"
+__version__ = "1.0.1"
+__maintainer__ = "Diego Carvalho"
+__email__ = "d.carvalho@ieee.org"
+__status__ = "Research"
+
+import tempfile
+import time
+from typing import Any, Dict, List, Tuple
+
+from .shm import SharedMemoryBackend
+from .spill import SpillBackend
+
+
+class FileTiers(object):
+    """The file tiers of a store, on this host.
+
+    Values from shm_threshold bytes go to shared memory when shared is on, and
+    values from spill_threshold bytes go to the disk tier (spill_dir) while Redis
+    uses more than spill_watermark of its memory. The metadata of such a value
+    points to its file: the backend is "shm" or "disk", and data the path.
+    """
+
+    # Seconds between two sweeps of the files, see sweep
+    sweep_interval = 600
+
+    def __init__(
+        self,
+        store_name: str,
+        shared: bool = False,
+        shm_dir: str = "/dev/shm",
+        shm_threshold: int = 1024 * 1024,
+        spill_dir: str = None,
+        spill_watermark: float = 0.8,
+        spill_threshold: int = 1024 * 1024,
+        previous: "FileTiers" = None,
+    ) -> None:
+        """FileTiers Constructor
+
+        Args:
+            store_name (str): Name of the store
+            shared (bool, optional): Write large values to shared memory. Defaults
+                to False.
+            shm_dir (str, optional): tmpfs directory of the shared memory tier.
+                Defaults to "/dev/shm".
+            shm_threshold (int, optional): Encoded size from which values go to
+                shared memory. Defaults to 1 MiB.
+            spill_dir (str, optional): Directory of the disk tier, None turns it off
+                (the files are still read from the paths in the metadata). Defaults
+                to None.
+            spill_watermark (float, optional): Share of the Redis memory from which
+                values are spilled. Defaults to 0.8.
+            spill_threshold (int, optional): Encoded size from which values may be
+                spilled. Defaults to 1 MiB.
+            previous (FileTiers, optional): The tiers of a previous construction,
+                the memory pressure and the time of the last sweep are carried over.
+                Defaults to None.
+        """
+        self.shm = SharedMemoryBackend(store_name, shm_dir)
+        self.spill = SpillBackend(
+            store_name, spill_dir if spill_dir else tempfile.gettempdir()
+        )
+        self.shared = shared
+        self.shm_threshold = shm_threshold
+        self.spill_dir = spill_dir
+        self.spill_watermark = spill_watermark
+        self.spill_threshold = spill_threshold
+        # The files of the values replaced or deleted, pushed by the scripts
+        self.files_tag = f"/{store_name}/files"
+        self.root_diretory = f"/{store_name}/keys"
+        self.pressure = previous.pressure if previous else (0.0, False)
+        self.swept = previous.swept if previous else 0.0
+        return
+
+    def tier(self, metadata: Dict) -> SharedMemoryBackend:
+        """The tier holding a datum in a file (shared memory or disk), None if it is
+        in Redis"""
+        if metadata["backend"] == "shm":
+            return self.shm
+        if metadata["backend"] == "disk":
+            return self.spill
+        return None
+
+    def active(self) -> List[SharedMemoryBackend]:
+        """The tiers this store writes to"""
+        tiers = [self.shm] if self.shared else []
+        return tiers + [self.spill] if self.spill_dir else tiers
+
+    def memory_pressure(self, con: Any) -> bool:
+        """Whether Redis uses more than spill_watermark of its memory
+
+        INFO memory is polled at most once a second, the answer is kept in between.
+        """
+        checked, high = self.pressure
+        if time.monotonic() - checked > 1.0:
+            info = con.info("memory")
+            limit = info.get("maxmemory") or info.get("total_system_memory")
+            high = bool(limit) and info["used_memory"] > self.spill_watermark * limit
+            self.pressure = (time.monotonic(), high)
+        return high
+
+    def spilling(self, con: Any) -> bool:
+        """Whether large values go to the disk tier right now"""
+        return bool(self.spill_dir) and self.memory_pressure(con)
+
+    def place(
+        self, con: Any, skey: str, version: int, encoded_data, compress: bool
+    ) -> Tuple[str, str]:
+        """Write an encoded value to a file, when it belongs to a file tier
+
+        Args:
+            con (Any): the client of the store, asked for its memory use
+            skey (str): the user key
+            version (int): the version of the value
+            encoded_data: the encoded value
+            compress (bool): compress it in the disk tier (the coding is not)
+
+        Returns:
+            Tuple[str, str]: the (path, backend) of the metadata, None if the value
+                stays in Redis
+        """
+        size = len(encoded_data)
+        if self.shared and size >= self.shm_threshold:
+            return self.shm.write(skey, version, encoded_data), "shm"
+        if size >= self.spill_threshold and self.spilling(con):
+            path = self.spill.write(skey, version, encoded_data, compress)
+            return path, "disk"
+        return None
+
+    def read(self, metadata: Dict) -> memoryview:
+        """Read a datum in a file tier, None if the file is gone"""
+        return self.tier(metadata).read(metadata["data"])
+
+    def collect(self, con: Any, batch: int = 1000) -> None:
+        """Unlink the files of the values the scripts replaced or deleted
+
+        The scripts push them to files_tag, so a file goes only once no metadata
+        points to it. The files left behind by values that expired are swept every
+        sweep_interval seconds (see sweep).
+
+        Args:
+            con (Any): the client of the store
+            batch (int, optional): files taken per round trip. Defaults to 1000.
+        """
+        if not self.active():
+            return
+        while True:
+            with con.pipeline() as pipe:
+                pipe.lrange(self.files_tag, 0, batch - 1)
+                pipe.ltrim(self.files_tag, batch, -1)
+                paths = pipe.execute()[0]
+            for path in paths:
+                self.shm.unlink(path.decode())
+            if len(paths) < batch:
+                break
+        if time.monotonic() - self.swept > self.sweep_interval:
+            self.sweep(con)
+        return
+
+    def sweep(self, con: Any, grace: int = 600) -> int:
+        """Unlink the files no metadata points to: the value expired, or its writer
+        died before publishing it
+
+        Args:
+            con (Any): the client of the store
+            grace (int, optional): seconds a file is kept after it is written, its
+                value may not be published yet. Defaults to 600.
+
+        Returns:
+            int: number of files unlinked
+        """
+        self.swept = time.monotonic()
+        files = [item for tier in self.active() for item in tier.files(grace)]
+        named = [(path, skey) for path, skey in files if skey is not None]
+        with con.pipeline(transaction=False) as pipe:
+            for _, skey in named:
+                pipe.hget(f"{self.root_diretory}/{skey}", "data")
+            current = set(data for data in pipe.execute() if data is not None)
+        orphans = [
+            path for path, skey in files if skey is None or path.encode() not in current
+        ]
+        for path in orphans:
+            self.shm.unlink(path)
+        return len(orphans)
+
+    def reset(self) -> None:
+        """Remove every file of the store"""
+        self.shm.reset()
+        self.spill.reset()
+        return
@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+
+""" conftest.py. Fixtures of the tests (@) 2022
+This module holds the fixtures shared by the tests: synthetic day zips of minute
+JSON files, as delivered by the bus GPS feed.
+This program is free software: you can redistribute it and/or modify it under
+the terms of the GNU General Public License as published by the Free Software
+Foundation, either version 3 of the License, or (at your option) any later
+version.
+This program is distributed in the hope that it will be useful, but WITHOUT
+ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+You should have received a copy of the GNU General Public License along with
+this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+
+# COPYRIGHT SECTION
+__author__ = "Diego Carvalho"
+__copyright__ = "Copyright 2022"
+__credits__ = ["Diego Carvalho"]
+__license__ = "GPL"
+__version__ = "1.0.1"
+__maintainer__ = "Diego Carvalho"
+__email__ = "d.carvalho@ieee.org"
+__status__ = "Research"
+
+import json
+import random
+import zipfile
+
+import pytest
+
+DAY = "G1-2017-07-12"
+
+
+def minute_files(minutes: int, buses, seed: int = 2017) -> dict:
+    """The minute files of a synthetic day, by member name
+
+    Every bus reports once a minute, at a random second, and a minute file repeats
+    the last report of every bus, as the feed does.
+
+    Args:
+        minutes (int): minute files, from 00:00
+        buses (int or Callable[[int], int]): buses reporting, or the buses reporting
+            in a minute
+        seed (int, optional): the seed of the reports. Defaults to 2017.
+    """
+    rng = random.Random(seed)
+    last = dict()
+    members = dict()
+    for minute in range(minutes):
+        data = list()
+        for bus in range(buses(minute) if callable(buses) else buses):
+            report = [
+                f"07-12-2017 {minute // 60:02d}:{minute % 60:02d}:{rng.randint(0, 59):02d}",
+                f"B{31000 + bus}",
+                float(100 + bus % 7),
+                round(-22.9 + bus * 1e-3 + minute * 1e-4, 5),
+                round(-43.3 + rng.random() / 10, 5),
+                round(rng.random() * 60, 1),
+            ]
+            data.extend([last[bus], report] if bus in last else [report])
+            last[bus] = report
+        document = {
+            "COLUMNS": ["DATAHORA", "ORDEM", "LINHA", "LATITUDE", "LONGITUDE"],
+            "DATA": data,
+        }
+        members[f"{minute // 60:02d}-{minute % 60:02d}.json"] = json.dumps(document)
+    return members
+
+
+@pytest.fixture
+def synthetic_members():
+    """The members of a synthetic day zip (see minute_files)"""
+    return minute_files
+
+
+@pytest.fixture
+def zip_of(tmp_path):
+    """A factory of day zips of the given members (name -> contents)"""
+
+    def factory(members: dict, name: str = f"{DAY}.zip") -> str:
+        path = str(tmp_path / name)
+        with zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED) as day:
+            for member, contents in members.items():
+                day.writestr(member, contents)
+        return path
+
+    return factory
+
+
+@pytest.fixture
+def day_zip(zip_of):
+    """A factory of synthetic day zips (see minute_files)"""
+
+    def factory(minutes: int = 30, buses=20, seed: int = 2017) -> str:
+        return zip_of(minute_files(minutes, buses, seed))
+
+    return factory
@@ -24,29 +24,52 @@ __maintainer__ = "Diego Carvalho"
 __email__ = "d.carvalho@ieee.org"
 __status__ = "Research"
 
+
+import pytest
+
 import gear.storage as ds
 
 
-def test_set_get():
-    d = ds.DataStorage("local")
+@pytest.fixture
+def store():
+    """A factory of DataStorage("local", **options), the store is empty when the
+    first one is built
+
+    Every DataStorage shares its state, so the store is wiped after the test and
+    the defaults (backend, chunk size, tiers) are restored for the next one.
+    """
+    stores = list()
+
+    def factory(**options):
+        stores.append(ds.DataStorage("local", **options))
+        if len(stores) == 1:
+            stores[0].reset_datastore()
+        return stores[-1]
+
+    yield factory
+    if stores:
+        stores[-1].reset_datastore()
+    ds.DataStorage("local")
+
+
+def test_set_get(store):
+    d = store()
     d.set("tstset", "test")
     v = d.get("tstset")
     assert v == "test", "Should be str(test)"
-    d.reset_datastore()
 
 
-def test_sadd_smembers():
-    d = ds.DataStorage("local")
+def test_sadd_smembers(store):
+    d = store()
     d.sadd("tstset", "test1")
     d.sadd("tstset", "test2")
     d.sadd("tstset", "test2")
     v = d.smembers("tstset")
     assert sorted(v) == sorted(["test2", "test1"]), "Should be ['test1', 'test2']"
-    d.reset_datastore()
 
 
-def test_bulk_set():
-    d = ds.DataStorage("local")
+def test_bulk_set(store):
+    d = store()
     a = dict()
     for i in range(20):
         a[f"k{i}"] = i
@@ -54,30 +77,38 @@ def test_bulk_set():
     for k, v in a.items():
         sv = d.get(k)
         assert sv == v, f"Should be {v}"
-    d.reset_datastore()
 
 
-def test_serializer():
-    d = ds.DataStorage("local")
+def test_serializer(store):
+    d = store()
     d.set("tstset", "test", ds.StoreType.PLAIN)
     v = d.get("tstset")
     assert v == "test", "Should be str(test)"
-    d.reset_datastore()
 
 
-def test_queue():
-    d = ds.DataStorage("local")
+def test_queue(store):
+    d = store()
     for i in range(10):
         d.enqueue("tstq", i)
     for i in range(10):
         j = d.dequeue("tstq")
         assert i == j, f"Should be {i} == {j}"
-    d.reset_datastore()
 
 
-def test_keys():
-    d = ds.DataStorage("local")
-    d.reset_datastore()
+def test_queue_batch(store):
+    d = store()
+    d.enqueue_many("tstq", range(10))
+    d.enqueue("tstq", 10)
+    assert d.dequeue_many("tstq", 3) == [0, 1, 2], "Should pop the first three"
+    assert list(d.drain("tstq", batch=4)) == list(range(3, 11)), "Should drain"
+    assert d.dequeue_many("tstq", 3) == [], "Should be empty"
+    d.delete_queue("tstq")
+    d.enqueue("tstq", 0)
+    assert d.get_keys("tstq") == ["tstq"], "Should list the queue again"
+
+
+def test_keys(store):
+    d = store()
     key_orig = ["a", "b"]
     for i in key_orig:
         d.set(i, 1)
@@ -85,15 +116,449 @@ def test_keys():
     for i in k:
         assert i in key_orig, f"Should be {i} in {key_orig}"
     assert len(k) == len(key_orig), f"Should be {len(key_orig)}"
-    d.reset_datastore()
 
 
-def test_inc_keys():
-    d = ds.DataStorage("local")
+def test_inc_keys(store):
+    d = store()
     v = d.generate_unique_id("test")
     assert v == "test#1", "Should be test#1"
     v = d.generate_unique_id("test")
     assert v == "test#2", "Should be test#2"
     v = d.generate_unique_id("test")
     assert v == "test#3", "Should be test#3"
+
+
+def test_arrow_frame(store):
+    import pandas as pd
+
+    d = store()
+    df = pd.DataFrame({"BUSID": ["A1", "B2"], "LAT": [-22.9, -22.8]})
+    d.set("tstframe", df, ds.StoreType.ARROW)
+    v = d.get("tstframe")
+    assert v.equals(df), "Should be the same frame"
+    df["LINE"] = pd.Categorical(["100", None], categories=["200", "100"])
+    df.index = pd.CategoricalIndex(["x", "y"])
+    d.set("tstframe", df, ds.StoreType.ARROW)
+    pd.testing.assert_frame_equal(d.get("tstframe"), df, obj="Should keep categories")
+
+
+def test_bulk_get_delete(store):
+    d = store()
+    a = dict()
+    for i in range(20):
+        a[f"k{i}"] = i
+    d.bulk_set(a)
+    v = d.bulk_get(list(a.keys()) + ["missing"])
+    assert v["missing"] is None, "Should be None"
+    for k, sv in a.items():
+        assert v[k] == sv, f"Should be {sv}"
+    d.bulk_delete(a.keys())
+    assert d.get_keys("k*") == [], "Should be empty"
+
+
+def test_async_set_get():
+    import asyncio
+
+    async def roundtrip():
+        async with ds.AsyncDataStorage("local", connections=4) as d:
+            payload = bytes(range(256)) * 8192
+            await d.set("tstasync", payload, ds.StoreType.NONE)
+            v = await d.get("tstasync")
+            await d.enqueue("tstq", 1)
+            j = await d.dequeue("tstq")
+            await d.delete("tstasync")
+            await d.delete_queue("tstq")
+            return v == payload and j == 1
+
+    assert asyncio.run(roundtrip()), "Should read back what was written"
+
+
+def test_async_layouts(store, tmp_path):
+    import asyncio
+    import os
+
+    payload = bytes(range(256)) * 8192
+
+    async def striped(d):
+        async with ds.AsyncDataStorage("local", connections=4) as a:
+            await a.set("tstasync", payload, ds.StoreType.NONE)
+            await a.set("tstasync", payload, ds.StoreType.NONE)
+            assert d.get("tstasync") == payload, "Should be read by DataStorage"
+            assert len(d.con.keys("/local/chunk/*")) == 4, "Should drop the old stripes"
+            await a.delete("tstasync")
+            assert d.con.keys("/local/chunk/*") == [], "Should drop the stripes"
+
+    async def written(d, key):
+        async with ds.AsyncDataStorage("local") as a:
+            value = await a.get(key)
+            await a.delete(key)
+            return value
+
+    asyncio.run(striped(store(backend="redis")))
+
+    d = store(backend="redis", dedup=True)
+    d.set("tstcas", payload, ds.StoreType.NONE)
+    assert asyncio.run(written(d, "tstcas")) == payload, "Should read the cas layout"
+    assert d.con.keys("/local/cas/*") == [], "Should release the chunks"
+
+    d = store(spill_dir=str(tmp_path), spill_watermark=0.0, spill_threshold=1024)
+    d.set("tstspill", payload, ds.StoreType.NONE)
+    assert asyncio.run(written(d, "tstspill")) == payload, "Should read the disk"
+    assert os.listdir(d.files.spill.directory) == [], "Should unlink the file"
+
+
+def test_value_cache(store):
+    d = store(cache_size=1024 * 1024, backend="redis")
+    d.set("tstset", [1, 2, 3])
+    v = d.get("tstset")
+    assert v == [1, 2, 3], "Should be [1, 2, 3]"
+    hits = d.value_cache.hits
+    v = d.get("tstset")
+    assert d.value_cache.hits == hits + 1, "Should be served by the cache"
+    # A write from another process bumps the version and invalidates the copy
+    d.value_cache["tstset"] = (0, "stale", 1)
+    v = d.get("tstset")
+    assert v == [1, 2, 3], "Should not return the stale copy"
+    # The callers own what they set and get, L2 keeps copies
+    datum = [1, 2, 3]
+    d.set("tstset", datum)
+    datum.append(4)
+    v = d.get("tstset")
+    v.append(5)
+    assert d.get("tstset") == [1, 2, 3], "Should not share the cached object"
+
+
+def test_value_cache_weight(store):
+    import numpy as np
+
+    d = store(cache_size=1024 * 1024, backend="redis")
+    # 8 MiB of zeros compress to a few KiB, but take their decoded size in L2
+    d.set("tstzeros", np.zeros(1024 * 1024))
+    d.set("tstsmall", np.zeros(1024))
+    assert "tstzeros" not in d.value_cache, "Should weigh the decoded array"
+    assert d.value_cache.weight == 8 * 1024, "Should weigh the small array"
+
+
+def test_lru_cache_threads():
+    from concurrent.futures import ThreadPoolExecutor
+
+    from gear.storage.cache import LRUCache
+
+    cache = LRUCache(64)
+
+    def hammer(worker):
+        for i in range(2000):
+            key = f"{worker}:{i % 100}"
+            cache[key] = i
+            cache.get(key)
+            cache.pop(f"{worker}:{(i + 50) % 100}")
+
+    with ThreadPoolExecutor(8) as executor:
+        list(executor.map(hammer, range(8)))
+    assert len(cache) <= 64, "Should stay under the capacity"
+    assert cache.weight == len(cache), "Should account every entry once"
+
+
+def test_shm_backend(store, tmp_path):
+    import os
+
+    d = store(backend="shm", shm_threshold=1024, shm_dir=str(tmp_path))
+    shm = d.files.shm
+    payload = os.urandom(4096)
+    d.set("tstshm", payload[::-1], ds.StoreType.NONE)
+    old = d.keyname_map["tstshm"]["data"]
+    d.set("tstshm", payload, ds.StoreType.NONE)
+    d.set("tstsmall", "test")
+    (name,) = os.listdir(shm.directory)
+    assert os.path.join(shm.directory, name) != old, "Should drop the old file"
+    d.keyname_map.clear()
+    assert d.get("tstshm") == payload, "Should map the value back"
+    assert d.get("tstsmall") == "test", "Should be str(test)"
+    d.delete("tstshm")
+    assert len(os.listdir(shm.directory)) == 0, "Should unlink the value"
+    # The metadata of a value expired, a writer died before publishing
+    d.set("tstexpired", payload, ds.StoreType.NONE, ex=1)
+    d.con.delete("/local/keys/tstexpired")
+    open(f"{shm.path('tstdead', 0)}.1234.tmp", "wb").close()
+    d.set("tstshm", payload, ds.StoreType.NONE)
+    assert d.sweep_files(grace=0) == 2, "Should unlink the orphan files"
+    assert len(os.listdir(shm.directory)) == 1, "Should keep the live value"
+
+
+def test_stream(store):
+    d = store(stream_window=2)
+    d.chunk_size = 1024
+    payload = bytes(range(256)) * 40
+    with d.open_write("tststream") as f:
+        for i in range(0, len(payload), 1000):
+            f.write(payload[i : i + 1000])
+    with d.open_read("tststream") as f:
+        v = f.read()
+    assert v == payload, "Should read back what was written"
+    with pytest.raises(ValueError):
+        with d.open_write("tststream") as f:
+            f.write(bytes(5000))
+            raise ValueError("the writer failed")
+    assert d.get("tststream") == payload, "Should keep the published value"
+    assert len(d.con.keys("/local/chunk/*")) == 1, "Should drop the written chunks"
+    d.set("tstlarge", list(range(10000)))
+    v = d.get("tstlarge")
+    assert v == list(range(10000)), "Should decode while streaming"
+
+
+def test_compression(store):
+    import numpy as np
+
+    d = store(compression={"cname": "zstd", "clevel": 5})
+    frame = np.linspace(-23.0, -22.0, 100000)
+    d.set("tstzstd", frame)
+    d.set("tstauto", frame, compression={"cname": "auto"})
+    d.set("tstlz4", frame, compression={"cname": "lz4", "nthreads": 2})
+    d.keyname_map.clear()
+    for key in ["tstzstd", "tstauto", "tstlz4"]:
+        assert (d.get(key) == frame).all(), "Should decode with any codec"
+
+
+def test_blosc_threads(store):
+    import blosc
+
+    store(compression={"nthreads": 3})
+    # The thread count is process-wide, a default store leaves it alone
+    store()
+    assert blosc.nthreads == 3, "Should keep the threads of the first store"
+    store(compression={"nthreads": 1})
+    assert blosc.nthreads == 1, "Should set the threads given"
+
+
+def test_connection_pool(store):
+    d = store(backend="redis")
+    hits = d.connection_statistics()["hits"]
+    d = store(backend="redis")
+    assert d.connection_statistics()["hits"] == hits + 1, "Should reuse the pool"
+    d.set("tstpool", "test")
+    assert d.get("tstpool") == "test", "Should be str(test)"
+    d.delete("tstpool")
+
+
+def test_iter_keys(store):
+    d = store()
+    d.bulk_set({f"STATUS-{i:03d}": i for i in range(25)})
+    d.set("WORKFLOW", [])
+    k = list(d.iter_keys("STATUS-01*", count=4))
+    assert k == [f"STATUS-{i:03d}" for i in range(10, 20)], "Should walk the prefix"
+    assert len(d.get_keys("*-0?0")) == 3, "Should scan the directory"
+    d.con.delete(d.index_diretory)
+    assert len(d.get_keys("STATUS-*")) == 25, "Should rebuild the index"
+
+
+def test_atomic_replace(store):
+    d = store(backend="redis")
+    d.chunk_size = 1024
+    d.set("tstset", bytes(5000), ds.StoreType.NONE)
+    d.set("tstset", bytes(3000), ds.StoreType.NONE)
+    assert len(d.con.keys("/local/chunk/*")) == 1, "Should drop the old chunks"
+    d.bulk_set({f"tst{i}": i for i in range(30)})
+    d.reset_datastore(batch=7)
+    assert d.con.keys("/local/*") == [b"/local/version"], "Should wipe the store"
+
+
+def test_inprocess_backend(store):
+    import threading
+    import time
+
+    d = store(backend="inprocess")
+    frame = {"lat": [-22.9], "lon": [-43.2]}
+    d.set("tstref", frame)
+    assert d.get("tstref") is frame, "Should pass the object by reference"
+    assert d.get_keys("tst*") == ["tstref"], "Should list the key"
+    d.set("tstttl", "test", ex=1)
+    d.enqueue("tstq", "first")
+    assert d.dequeue("tstq") == "first", "Should be str(first)"
+    threading.Timer(0.1, d.enqueue, ["tstq", "item"]).start()
+    assert d.dequeue("tstq") == "item", "Should block until the item arrives"
+    time.sleep(1.1)
+    assert d.get("tstttl") is None, "Should expire"
     d.reset_datastore()
+    assert d.con.keys("/local/*") == [b"/local/version"], "Should wipe the store"
+
+
+def test_inprocess_scripts():
+    import redis
+
+    from gear.storage.datastorage import build_metadata
+    from gear.storage.inprocess import InProcessRedis
+    from gear.storage.scripts import DIGEST_SIZE, register_scripts
+
+    def run(con):
+        """Replace, delete, wipe and take content-addressed chunks in every layout,
+        the key space after every step"""
+        scripts = register_scripts(con)
+        root, index, refs = "/parity/keys", "/parity/index", "/parity/casrefs"
+        cas = "/parity/cas/"
+        d1, d2 = "1" * DIGEST_SIZE, "2" * DIGEST_SIZE
+        steps = list()
+
+        def publish(skey, metadata):
+            items = [item for field in metadata.items() for item in field]
+            scripts["replace"](
+                keys=[f"{root}/{skey}", root, index],
+                args=[skey, 60, 4, metadata["data"]] + items,
+            )
+            steps.append(sorted(con.keys("/parity/*")))
+
+        con.set("/parity/chunk/a@1:0", b"abcd")
+        con.set("/parity/chunk/a@1:1", b"e")
+        publish("a", build_metadata("/parity/chunk/a@1", 5, 0, 1))
+        con.hset("/parity/chunk/b@2#0", 0, b"abcd")
+        con.hset("/parity/chunk/b@2#1", 1, b"e")
+        publish("b", build_metadata("/parity/chunk/b@2", 5, 0, 1, stripes=2))
+        con.hset("/parity/chunk/a@3#0", 0, b"xy")
+        publish("a", build_metadata("/parity/chunk/a@3", 2, 0, 0, stripes=1))
+        for digest in scripts["cas_acquire"](keys=[refs], args=[60, cas, d1, d1, d2]):
+            con.set(f"{cas}{digest.decode()}", b"abcd", ex=60)
+        manifest = d1 + d1 + d2
+        publish("c", build_metadata("/parity/chunk/c@4", 12, 0, 3, 4, "cas", manifest))
+        steps.append(scripts["cas_acquire"](keys=[refs], args=[60, cas, d1]))
+        publish("d", build_metadata("/parity/chunk/d@5", 4, 0, 1, 5, "cas", d1))
+        con.rpush("/parity/data/q", b"item")
+        publish("q", build_metadata("/parity/data/q"))
+        publish("q", build_metadata("/parity/data/q"))
+        publish("s", build_metadata("/dev/shm/parity/s@6", 8, backend="shm"))
+        publish("s", build_metadata("/dev/shm/parity/s@7", 8, backend="shm"))
+        steps.append(con.lrange("/parity/files", 0, -1))
+        scripts["delete"](keys=[f"{root}/c", root, index], args=["c", 4])
+        steps.append(sorted(con.keys("/parity/*")))
+        steps.append(sorted(con.hgetall(refs).items()))
+        steps.append(sorted(con.smembers(root)))
+        # SPOP takes any members, only the batches wiped can be compared
+        wiped = [2]
+        while wiped[-1] == 2:
+            keys = [root, index, refs, "/parity/files"]
+            wiped.append(scripts["wipe"](keys=keys, args=[2, 4, f"{root}/"]))
+        steps.append(wiped)
+        steps.append(sorted(con.keys("/parity/*")))
+        return steps
+
+    steps = run(InProcessRedis())
+    assert steps == run(redis.Redis()), "Should behave as the Lua scripts"
+    assert steps[-1] == [], "Should wipe every key"
+
+
+def test_instrumentation(store):
+    import numpy as np
+    from gear.storage.instrumentation import merge, summary_rows
+
+    d = store(instrument=True, backend="redis")
+    d.set("tstset", np.zeros(100000))
+    d.get("tstset")
+    d.enqueue("tstq", "test")
+    d.dequeue("tstq")
+    metrics = d.collect_metrics()
+    assert set(metrics) == {"set", "get", "enqueue", "dequeue"}, "Should measure"
+    assert metrics["set"].raw_bytes > metrics["set"].wire_bytes.total, "Compressed"
+    rows = summary_rows(merge([metrics, metrics]))
+    assert rows[0]["COUNT"] == 2, "Should merge the histograms"
+
+
+def test_dedup(store):
+    d = store(backend="redis", dedup=True)
+    d.chunk_size = 1024
+    payload = bytes(2048) + b"tail"
+    d.set("tstset1", payload, ds.StoreType.NONE)
+    d.set("tstset2", payload, ds.StoreType.NONE)
+    assert d.get("tstset2") == payload, "Should rebuild the value"
+    assert len(d.con.keys("/local/cas/*")) == 2, "Should store the chunks once"
+    assert d.dedup_statistics()["ratio"] > 3, "Should report the dedup ratio"
+    d.delete("tstset1")
+    assert d.get("tstset2") == payload, "Should keep the shared chunks"
+    d.delete("tstset2")
+    assert d.con.keys("/local/cas/*") == [], "Should drop the unreferenced chunks"
+
+
+def test_spill_to_disk(store, tmp_path):
+    import os
+
+    d = store(
+        backend="redis",
+        spill_dir=str(tmp_path),
+        spill_watermark=0.0,
+        spill_threshold=1024,
+    )
+    spill = d.files.spill
+    payload = bytes(8192)
+    d.set("tstspill", payload, ds.StoreType.NONE)
+    d.set("tstsmall", "test")
+    (name,) = os.listdir(spill.directory)
+    assert name.startswith("tstspill@"), "Should spill the large value"
+    path = os.path.join(spill.directory, name)
+    assert os.path.getsize(path) < 1024, "Should compress it"
+    d.keyname_map.clear()
+    assert d.get("tstspill") == payload, "Should load the value back"
+    d.delete("tstspill")
+    assert len(os.listdir(spill.directory)) == 0, "Should unlink the value"
+
+
+def test_pin(store):
+    d = store(backend="redis")
+    d.chunk_size = 1024
+    d.set("tstset", bytes(5000), ds.StoreType.NONE, ex=60)
+    (chunks,) = d.con.keys("/local/chunk/*")
+    assert d.con.hlen(chunks) == 5, "Should keep every chunk in a single hash"
+    assert d.pin("tstset"), "Should pin the value"
+    assert d.get("tstset") == bytes(5000), "Should read the pinned value"
+    assert d.con.ttl(chunks) == -1, "Should not expire a pinned value"
+    assert d.unpin("tstset", ex=60) and 0 < d.con.ttl(chunks) <= 60, "Unpinned"
+    assert not d.pin("missing"), "Should not pin a missing key"
+
+
+def test_parallel(store, monkeypatch):
+    import os
+    import threading
+
+    import blosc
+
+    # blosc has a thread count per process, the workers must leave it alone
+    callers = set()
+    set_nthreads = blosc.set_nthreads
+    monkeypatch.setattr(
+        blosc,
+        "set_nthreads",
+        lambda n: callers.add(threading.get_ident()) or set_nthreads(n),
+    )
+    d = store(backend="redis", parallelism=4, parallel_threshold=4096)
+    d.chunk_size = 1024
+    d.stream_window = 8
+    payload = os.urandom(256 * 1024)
+    d.set("tstset", payload, compression={"frame_size": 64 * 1024, "nthreads": 2})
+    assert callers == {threading.get_ident()}, "Should set the blosc threads once"
+    (metadata,) = d.con.hmget("/local/keys/tstset", ["stripes"])
+    assert int(metadata) == 4, "Should stripe the value over every connection"
+    d.keyname_map.clear()
+    assert d.get("tstset") == payload, "Should read the value back in parallel"
+    d.set("tstsmall", b"test")
+    assert d.get("tstsmall") == b"test", "Should keep the small values as they are"
+
+
+def test_stale_metadata(store):
+    class Process(ds.DataStorage):
+        # A state of its own, as the DataStorage of another process
+        _shared_state = dict()
+
+    d = store(backend="redis", stream_window=2)
+    d.chunk_size = 1024
+    other = Process("local", backend="redis")
+    d.set("tstset", [1, 2, 3])
+    d.set("tstbulk", "old")
+    d.set("tstlarge", bytes(5000))
+    assert d.get("tstset") == [1, 2, 3], "Should be [1, 2, 3]"
+    # The versions named in the L1 of d are dropped by the replace script
+    other.set("tstset", [4, 5])
+    other.set("tstbulk", "new")
+    other.set("tstlarge", bytes(3000))
+    assert d.get("tstset") == [4, 5], "Should retry with the current metadata"
+    assert d.bulk_get(["tstbulk"]) == {"tstbulk": "new"}, "Should retry the key"
+    assert d.get("tstlarge") == bytes(3000), "Should stream the current version"
+    other.set("tstlarge", bytes(4000))
+    with d.open_read("tstlarge") as f:
+        v = d.serializer[d.keyname_map["tstlarge"]["coding"]].load(f)
+    assert v == bytes(4000), "Should read the current version"
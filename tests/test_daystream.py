@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+
+""" test_daystream.py. Tests for the streaming stages of the pipeline (@) 2022
+This module tests the stages of the per-day pipeline that take a day a batch at
+a time against the ones that take the day whole.
+This program is free software: you can redistribute it and/or modify it under
+the terms of the GNU General Public License as published by the Free Software
+Foundation, either version 3 of the License, or (at your option) any later
+version.
+This program is distributed in the hope that it will be useful, but WITHOUT
+ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+You should have received a copy of the GNU General Public License along with
+this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+
+# COPYRIGHT SECTION
+__author__ = "Diego Carvalho"
+__copyright__ = "Copyright 2022"
+__credits__ = ["Diego Carvalho"]
+__license__ = "GPL"
+__version__ = "1.0.1"
+__maintainer__ = "Diego Carvalho"
+__email__ = "d.carvalho@ieee.org"
+__status__ = "Research"
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import gear.tools.daystream as dst
+import gear.tools.ingest as ti
+
+
+def join_regions(frame):
+    """A stand-in for the spatial join: the points east of -43.25 are in a region"""
+    inside = frame["LONG"] > -43.25
+    return frame.assign(
+        index_right=np.where(inside, 1.0, np.nan),
+        REGIAO_ADM=pd.Series("CENTRO", index=frame.index).where(inside),
+    )
+
+
+def sorted_values(frame, order):
+    """The rows sorted by order, the categoricals as their values (they would sort
+    in the order of their categories)"""
+    values = {
+        column: frame[column].cat.categories.dtype
+        for column in frame.columns
+        if isinstance(frame[column].dtype, pd.CategoricalDtype)
+    }
+    return frame.astype(values).sort_values(order, ignore_index=True)
+
+
+def assert_same_statistics(statistics, expected, points):
+    for key, value in expected.items():
+        if key.endswith(("_MIN_BUS", "_MAX_BUS")):
+            # a tie is taken by the first bus, in another order
+            variable, extreme = key.split("_")[:2]
+            tied = points.loc[points[variable] == expected[f"{variable}_{extreme}"]]
+            assert statistics[key] in set(tied["BUSID"]), f"Should be a bus of {key}"
+        elif key.startswith("INTERVAL"):
+            assert abs(statistics[key] - value) < pd.Timedelta(1, "ms"), key
+        elif isinstance(value, str):
+            assert statistics[key] == value, key
+        else:
+            assert statistics[key] == pytest.approx(value, rel=1e-9), key
+
+
+def test_stream_day_growing(day_zip, tmp_path):
+    # 100 buses overnight, 150 after 02:00 (past the int8 index of a categorical),
+    # and more than 32767 distinct times (past the int16 one)
+    zip_file_name = day_zip(660, lambda minute: 100 if minute < 120 else 150)
+    database_file = tmp_path / "database.parquet"
+    statdata_file = tmp_path / "statdata.parquet"
+
+    statistics = dst.DayStatistics("G1-2017-07-12")
+    codes = list()
+    with dst.ParquetStream(database_file) as database, dst.ParquetStream(
+        statdata_file
+    ) as statdata:
+        # The categoricals of the dictionaries of the day so far
+        for entries, _, _ in ti.stream_day(zip_file_name, batch_files=60):
+            dfjoin = join_regions(entries)
+            database.write(dfjoin)
+            statdata.write(statistics.add(dfjoin))
+            codes.append(tuple(dfjoin[c].cat.codes.dtype for c in ("BUSID", "DATE")))
+    assert codes[0] == ("int8", "int16"), "Should start with small indexes"
+    assert codes[-1] == ("int16", "int32"), "Should grow the indexes"
+
+    day, _, _ = ti.read_day(zip_file_name)
+    day = join_regions(day)
+    streamed = pd.read_parquet(database_file)
+    pd.testing.assert_frame_equal(
+        sorted_values(streamed, ti.COLUMNS),
+        sorted_values(day, ti.COLUMNS),
+        check_dtype=False,
+    )
+
+    before = day.copy()
+    points, expected = dst.day_statistics(day, "G1-2017-07-12")
+    pd.testing.assert_frame_equal(day, before, obj="Should leave the day as is")
+    assert_same_statistics(statistics.statistics(), expected, points)
+    order = ["BUSID", "DATE"]
+    pd.testing.assert_frame_equal(
+        sorted_values(pd.read_parquet(statdata_file), order),
+        sorted_values(points, order),
+        check_dtype=False,
+        check_like=True,
+    )
+
+
+def test_running_moments():
+    rng = np.random.default_rng(2017)
+    values = rng.normal(40.0, 12.0, 1000)
+    values[::97] = np.nan
+    labels = np.arange(1000).astype(str)
+    moments = dst.RunningMoments()
+    for first in range(0, 1000, 128):
+        moments.add(values[first : first + 128], labels[first : first + 128])
+    series = pd.Series(values)
+    assert moments.length == series.count(), "Should skip NaN"
+    assert moments.mean() == pytest.approx(series.mean(), rel=1e-12)
+    assert moments.std() == pytest.approx(series.std(), rel=1e-12)
+    assert moments.minimum_label == labels[series.idxmin()], "Should label the min"
+    assert moments.maximum_label == labels[series.idxmax()], "Should label the max"
+    assert np.isnan(dst.RunningMoments().std()), "Should be NaN without values"
+
+
+def test_incremental_day(zip_of, synthetic_members, tmp_path):
+    # A day processed whole, then delivered again with two more minute files
+    members = synthetic_members(12, 6)
+    first = zip_of({name: members[name] for name in list(members)[:8]}, "first.zip")
+    day_zip = zip_of({name: members[name] for name in list(members)[:10]})
+    database_file = tmp_path / "database.parquet"
+    day, _, _ = ti.read_day(first)
+    join_regions(day).to_parquet(database_file)
+
+    new = ti.incremental_members(ti.zip_manifest(day_zip), ti.zip_manifest(first))
+    entries, _, _ = ti.read_day(day_zip, members=new)
+    database = dst.merge_new_rows(pd.read_parquet(database_file), join_regions(entries))
+    points, statistics = dst.day_statistics(database, "G1-2017-07-12")
+
+    day, _, _ = ti.read_day(day_zip)
+    expected_points, expected = dst.day_statistics(join_regions(day), "G1-2017-07-12")
+    # The categories of the merged rows are sorted, the ones of the day are not
+    pd.testing.assert_frame_equal(points, expected_points, check_categorical=False)
+    pd.testing.assert_series_equal(pd.Series(statistics), pd.Series(expected))
@@ -0,0 +1,198 @@
+# -*- coding: utf-8 -*-
+
+""" test_ingest.py. Tests for the ingest of the minute files (@) 2022
+This module tests the reading of synthetic day zips into the unique entries of
+the day.
+This program is free software: you can redistribute it and/or modify it under
+the terms of the GNU General Public License as published by the Free Software
+Foundation, either version 3 of the License, or (at your option) any later
+version.
+This program is distributed in the hope that it will be useful, but WITHOUT
+ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+You should have received a copy of the GNU General Public License along with
+this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+
+# COPYRIGHT SECTION
+__author__ = "Diego Carvalho"
+__copyright__ = "Copyright 2022"
+__credits__ = ["Diego Carvalho"]
+__license__ = "GPL"
+__version__ = "1.0.1"
+__maintainer__ = "Diego Carvalho"
+__email__ = "d.carvalho@ieee.org"
+__status__ = "Research"
+
+import pytest
+
+import gear.tools.daystream as dst
+import gear.tools.ingest as ti
+
+
+def rows(frame):
+    return set(frame[ti.COLUMNS].itertuples(index=False, name=None))
+
+
+@pytest.fixture
+def day_versions(zip_of, synthetic_members):
+    """A day zip and its re-deliveries: one with new members, one with a member
+    changed, one removed and new ones"""
+    members = synthetic_members(12, 6)
+    first = {name: members[name] for name in list(members)[:8]}
+    appended = {name: members[name] for name in list(members)[:10]}
+    edited = dict(appended)
+    edited["00-03.json"] = members["00-03.json"].replace("B31002", "B39999")
+    del edited["00-05.json"]
+    return {
+        "first": zip_of(first, "G1-2017-07-12.zip"),
+        "appended": zip_of(appended, "G1-2017-07-12-appended.zip"),
+        "edited": zip_of(edited, "G1-2017-07-12-edited.zip"),
+    }
+
+
+def test_manifest_changes(day_versions):
+    previous = ti.zip_manifest(day_versions["first"])
+    assert list(previous["MEMBER"][:2]) == ["00-00.json", "00-01.json"], "In order"
+    new, changed, removed = ti.manifest_changes(
+        ti.zip_manifest(day_versions["edited"]), previous
+    )
+    assert new == ["00-08.json", "00-09.json"], "Should find the new members"
+    assert changed == ["00-03.json"], "Should find the changed member"
+    assert removed == ["00-05.json"], "Should find the removed member"
+    assert ti.incremental_members(previous, previous) == [], "Nothing to read"
+    assert ti.incremental_members(previous, None) is None, "Should read the day"
+
+
+def test_incremental_new_members(day_versions):
+    previous = ti.zip_manifest(day_versions["first"])
+    manifest = ti.zip_manifest(day_versions["appended"])
+    members = ti.incremental_members(manifest, previous)
+    assert members == ["00-08.json", "00-09.json"], "Should read the new members"
+
+    database, _, _ = ti.read_day(day_versions["first"])
+    entries, _, statistics = ti.read_day(day_versions["appended"], members=members)
+    assert statistics["ROWS"] == 2 * 2 * 6, "Should read only the new members"
+    merged = dst.merge_new_rows(database, entries)
+    full, _, _ = ti.read_day(day_versions["appended"])
+    assert len(merged) == len(full), "Should skip the rows the day holds"
+    assert rows(merged) == rows(full), "Should be the rows of a full run"
+
+
+def test_incremental_changed_members(day_versions):
+    previous = ti.zip_manifest(day_versions["first"])
+    manifest = ti.zip_manifest(day_versions["edited"])
+    assert ti.incremental_members(manifest, previous) is None, "Should read the day"
+    assert ti.incremental_members(manifest.iloc[1:], manifest) is None, "Removed"
+
+
+def test_read_day(day_zip):
+    zip_file_name = day_zip(30, 20)
+    frame, errors, statistics = ti.read_day(zip_file_name)
+    unique_entries, _, python_statistics = ti.read_day(zip_file_name, "python")
+    assert rows(frame) == unique_entries, "Should be the rows of the python engine"
+    assert len(frame) == len(unique_entries), "Should drop the repeated rows"
+    assert str(frame["BUSID"].dtype) == "category", "Should keep the dictionaries"
+    assert frame["LAT"].dtype == "float64", "Should hand out floats"
+    assert statistics["ROWS"] == python_statistics["ROWS"] == 2 * 20 * 30 - 20
+    assert errors["MOTIF"] == [], "Should have no errors"
+    _, errors, _ = ti.read_day("missing/G1-2017-07-12.zip")
+    assert errors["MOTIF"] == ["BADZIPFILE"], "Should report the bad zip"
+
+
+def test_unique_rows_collision(monkeypatch):
+    import numpy as np
+    import pandas as pd
+
+    columns = [np.array([3, 1, 3, 2, 1, 3]), np.array([0.5, 0.1, 0.5, 0.2, 0.9, 0.5])]
+    assert list(ti.unique_rows(columns)) == [0, 1, 3, 4], "Should keep the first ones"
+    # every row hashes the same, only the sort-unique can tell them apart
+    monkeypatch.setattr(
+        pd.util, "hash_array", lambda values: np.zeros(len(values), np.uint64)
+    )
+    assert list(ti.unique_rows(columns)) == [0, 1, 3, 4], "Should sort the rows"
+    assert len(ti.unique_rows([np.empty(0)])) == 0, "Should take no rows"
+
+
+def test_read_day_parallel(day_zip):
+    from concurrent.futures import ThreadPoolExecutor
+
+    zip_file_name = day_zip(30, 20)
+    frame, _, statistics = ti.read_day(zip_file_name)
+    parallel, _, parallel_statistics = ti.read_day(zip_file_name, workers=3)
+    assert parallel.equals(frame), "Should be the serial read, in order"
+    assert parallel_statistics["ROWS"] == statistics["ROWS"], "Should read every row"
+    with ThreadPoolExecutor(4) as executor:
+        threaded, _, _ = ti.read_day(zip_file_name, workers=4, executor=executor)
+        unique_entries, _, _ = ti.read_day(
+            zip_file_name, "python", workers=4, executor=executor
+        )
+    assert threaded.equals(frame), "Should take the executor"
+    assert unique_entries == rows(frame), "Should merge the sets"
+
+
+@pytest.fixture
+def odd_members(synthetic_members):
+    """Minute files that are valid JSON but not plain, and some that are broken"""
+    import json
+
+    document = json.loads(synthetic_members(2, 4)["00-01.json"])
+    data = document["DATA"]
+
+    def dumps(data, **kwargs):
+        return json.dumps(dict(document, DATA=data), **kwargs)
+
+    return {
+        "00-00.json": dumps(data, separators=(",", ":")),
+        "00-01.json": dumps(data),
+        "00-02.json": dumps(data, indent=2),
+        "00-03.json": dumps([data[0][:2] + ["SV, 2"] + data[0][3:]] + data[1:]),
+        "00-04.json": dumps([[data[0][0], None] + data[0][2:]] + data[1:]),
+        "00-05.json": dumps([[data[0][0], "Bé"] + data[0][2:]] + data[1:]),
+        "00-06.json": dumps([row[:3] + [int(row[3])] + row[4:] for row in data]),
+        "00-07.json": dumps(data)[:-20],
+        "00-08.json": dumps([]),
+        "00-09.json": dumps([row[:5] for row in data]),
+    }
+
+
+def test_decode_columns(odd_members):
+    plain = 0
+    for name, contents in odd_members.items():
+        data = contents.encode()
+        try:
+            batch = ti.decode_columns(data)
+        except ValueError:
+            continue  # left to the JSON decoder
+        plain += 1
+        expected = ti.rows_to_batch(ti.decode_entries(data))
+        assert batch.equals(expected), f"Should decode {name} as the JSON decoder"
+    assert plain == 3, "Should take the compact, spaced and integer files"
+
+
+def test_decode_numbers(zip_of, odd_members):
+    # Numbers in a string field, which the CSV path reads as text
+    contents = odd_members["00-01.json"]
+    contents = contents.replace(" 100.0,", " 555.50,").replace(" 101.0,", " 1e3,")
+    data = contents.encode()
+    batch = ti.decode_columns(data)
+    assert batch.equals(ti.rows_to_batch(ti.decode_entries(data))), "As the JSON"
+    zip_file_name = zip_of({"00-00.json": contents})
+    unique_entries, _, _ = ti.read_day(zip_file_name, "python")
+    for decoder in ti.DECODERS:
+        frame, _, _ = ti.read_day(zip_file_name, decoder=decoder)
+        assert rows(frame) == unique_entries, f"Should decode with {decoder}"
+    assert {"555.5", "1000.0"} <= set(frame["LINE"]), "Should be str(float)"
+
+
+def test_decoders(zip_of, odd_members):
+    zip_file_name = zip_of(odd_members)
+    unique_entries, python_errors, _ = ti.read_day(zip_file_name, "python")
+    for decoder in ti.DECODERS:
+        frame, errors, _ = ti.read_day(zip_file_name, decoder=decoder)
+        assert rows(frame) == unique_entries, f"Should decode with {decoder}"
+        assert errors == python_errors, "Should report the same errors"
+    assert python_errors["MOTIF"] == ["DECODE FAIL", "DECODE FAIL", "FIELDERROR"]
+    assert ti.json_decoder() is ti.DECODERS.get("orjson", ti.DECODERS["json"])
+    with pytest.raises(ValueError):
+        ti.json_decoder("simplejson")
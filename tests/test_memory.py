@@ -24,17 +24,72 @@ __maintainer__ = "Diego Carvalho"
 __email__ = "d.carvalho@ieee.org"
 __status__ = "Research"
 
+
+import pytest
+
 import gear.storage as ds
 import gear.storage.memory as mm
 import gear.tools.serializer as sz
 
 
-def test_memory():
-    redis = mm.RedisServer(port=7777)
-    redis.start_redis_server()
-    d = ds.DataStorage("local", port=redis.port)
+@pytest.fixture
+def redis_store():
+    """A factory of DataStorage("local") over a started RedisServer(**options)
+
+    The store is wiped and the servers stopped after the test, and DataStorage is
+    pointed back to the default server.
+    """
+    started = list()
+
+    def factory(**options):
+        redis = mm.RedisServer(**options)
+        redis.start_redis_server()
+        started.append(redis)
+        return ds.DataStorage("local", endpoints=redis.endpoints)
+
+    yield factory
+    for redis in started:
+        ds.DataStorage("local", endpoints=redis.endpoints).reset_datastore()
+        redis.stop_redis_server()
+    ds.DataStorage("local", endpoints=[("localhost", 6379)])
+
+
+def test_memory(redis_store):
+    d = redis_store(port=7777)
     d.set("tstset", "test")
     v = d.get("tstset")
     assert v == "test", "Should be str(test)"
-    d.reset_datastore()
-    redis.stop_redis_server()
+
+
+def test_sharded_memory(redis_store):
+    d = redis_store(port=7780, instances=3)
+    d.chunk_size = 1024
+    payload = bytes(range(256)) * 64
+    d.set("tstset", payload, ds.StoreType.NONE)
+    assert d.get("tstset") == payload, "Should rebuild the value"
+    shards = [len(c.keys("/local/chunk/*")) for c in d.con.clients]
+    assert all(n > 0 for n in shards), "Should stripe the chunks over every shard"
+    d.set("tstset", b"test", ds.StoreType.NONE)
+    assert sum(len(c.keys("/local/chunk/*")) for c in d.con.clients) == 1, "Collected"
+
+
+def test_sharded_queue(redis_store):
+    d = redis_store(port=7785, instances=3)
+    # names that look like chunk keys, whatever server their hash falls on
+    for queue in ["x:1", "x:2", "jobs:2"]:
+        d.enqueue(queue, "test")
+        assert d.dequeue(queue, timeout=1) == "test", "Should pop from the same server"
+        d.enqueue(queue, "test")
+        d.delete_queue(queue)
+        assert d.dequeue(queue, timeout=1) is None, "Should delete the queue"
+    d.sadd("x#2", "test")
+    assert d.smembers("x#2") == ["test"], "Should keep the set with the queues"
+    for client in d.con.clients[1:]:
+        assert client.keys("/local/data/*") == [], "Should leave the shards alone"
+
+
+def test_memory_unix_socket(redis_store):
+    d = redis_store(port=7790, unix_socket="/tmp/redis-test-{port}.sock")
+    d.set("tstset", "test")
+    assert d.get("tstset") == "test", "Should be str(test)"
+    assert d.con.config_get("save")["save"] == "", "Should not persist"
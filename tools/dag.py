@@ -103,18 +103,22 @@ def remove_done_workflow():
     if work_list == None:
         print("Empty worklist. Nothing to do.")
         return
-    status = memory.get_keys("STATUS-*")
+    status = memory.iter_keys("STATUS-*")
+    journals = list()
     for i in status:
         item_to_remove = str(i[7:])
         print(f"Removing jornal {item_to_remove}.")
-        memory.delete(item_to_remove)
+        journals.append(item_to_remove)
         os.system(f"rm -f database/{item_to_remove}.feather")
+    memory.bulk_delete(journals)
 
+    processed = list()
     for i in sorted(glob.glob("database/*.feather")):
         item_to_remove = decode_meta_name(i)
         if item_to_remove in work_list:
             print(f"Removing processed file {item_to_remove}.")
-            memory.delete(item_to_remove)
+            processed.append(item_to_remove)
             work_list.remove(item_to_remove)
+    memory.bulk_delete(processed)
     memory.set("WORKFLOW", work_list)
     return
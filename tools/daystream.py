@@ -0,0 +1,480 @@
+# -*- coding: utf-8 -*-
+
+""" daystream.py. Streaming stages of the per-day pipeline (@) 2022
+This module holds the stages of the per-day pipeline that can take a day a batch
+(e.g. an hour of minute files, see tools.ingest.stream_day) at a time: the
+spatial join with the regions, the Parquet outputs and the daily statistics.
+Only the state the statistics need crosses the batches: the last point of every
+bus and the running moments of the variables.
+This program is free software: you can redistribute it and/or modify it under
+the terms of the GNU General Public License as published by the Free Software
+Foundation, either version 3 of the License, or (at your option) any later
+version.
+This program is distributed in the hope that it will be useful, but WITHOUT
+ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+You should have received a copy of the GNU General Public License along with
+this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+
+# COPYRIGHT SECTION
+__author__ = "Diego Carvalho"
+__copyright__ = "Copyright 2022"
+__credits__ = ["Diego Carvalho"]
+__license__ = "GPL"
+__version__ = "1.0.1"
+__maintainer__ = "Diego Carvalho"
+__email__ = "d.carvalho@ieee.org"
+__status__ = "Research"
+
+from typing import Dict, Tuple
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from tools.ingest import COLUMNS, STRING_COLUMNS, unique_rows
+
+# The columns of the regions that are not kept after the spatial join
+REGION_DROP = ["Área", "AREA_PLANE", "LINK", "SHAPESTArea", "SHAPESTLength"]
+
+
+def join_regions(df: pd.DataFrame, area_gpd) -> pd.DataFrame:
+    """The entries (DATE, BUSID, LINE, LAT, LONG, VELOCITY) with the region they are in
+
+    Args:
+        df (pd.DataFrame): the entries
+        area_gpd (gpd.GeoDataFrame): the regions (Limite_de_Bairros.geojson)
+
+    Returns:
+        pd.DataFrame: the left spatial join of the entries and the regions
+    """
+    import geopandas as gpd
+
+    df = df.assign(
+        geometry=(
+            "POINT Z ("
+            + df["LONG"].astype(str)
+            + " "
+            + df["LAT"].astype(str)
+            + " "
+            + "0.00000)"
+        )
+    )
+
+    cp_union = gpd.GeoDataFrame(
+        df.loc[:, [c for c in df.columns if c != "geometry"]],
+        geometry=gpd.GeoSeries.from_wkt(df["geometry"]),
+        crs="epsg:4326",
+    )
+
+    dfjoin = gpd.sjoin(cp_union, area_gpd, how="left")
+    dfjoin.drop(columns=["geometry"] + REGION_DROP, inplace=True)
+    return pd.DataFrame(dfjoin)
+
+
+def merge_new_rows(existing: pd.DataFrame, frame: pd.DataFrame) -> pd.DataFrame:
+    """existing followed by the rows of frame it does not hold yet, the rows are
+    compared on the entry columns (DATE, BUSID, LINE, LAT, LONG, VELOCITY)
+
+    Args:
+        existing (pd.DataFrame): e.g. the database of a day
+        frame (pd.DataFrame): e.g. the entries of its changed minute files, joined
+            with the regions
+
+    Returns:
+        pd.DataFrame: the merged rows
+    """
+    both = pd.concat([existing[COLUMNS], frame[COLUMNS]], ignore_index=True)
+    columns = [
+        pd.factorize(both[column].astype(str))[0]
+        if column in STRING_COLUMNS
+        else both[column].to_numpy(dtype=np.float64)
+        for column in COLUMNS
+    ]
+    del both
+    keep = unique_rows(columns)
+    new = keep[keep >= len(existing)] - len(existing)
+    merged = pd.concat([existing, frame.iloc[new]], ignore_index=True)
+    for column in STRING_COLUMNS:
+        if isinstance(existing[column].dtype, pd.CategoricalDtype):
+            merged[column] = merged[column].astype("category")
+    return merged
+
+
+def haversine(lat1, lon1, lat2, lon2, to_radians=True, earth_radius=6371):
+    """
+    slightly modified version: of http://stackoverflow.com/a/29546836/2901002
+
+    Calculate the great circle distance between two points
+    on the earth (specified in decimal degrees or in radians)
+
+    All (lat, lon) coordinates must have numeric dtypes and be of equal length.
+
+    """
+    if to_radians:
+        lat1, lon1, lat2, lon2 = np.radians([lat1, lon1, lat2, lon2])
+
+    a = (
+        np.sin((lat2 - lat1) / 2.0) ** 2
+        + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2.0) ** 2
+    )
+
+    return earth_radius * 2 * np.arcsin(np.sqrt(a))
+
+
+def parse_dates(dates: pd.Series) -> pd.Series:
+    """The DATE of the entries (e.g. 07-12-2017 00:00:01) as datetimes, NaT when
+    it does not parse
+
+    A categorical DATE (see ColumnarBatches.frame) is parsed a category at a time,
+    pd.to_datetime would hand it back categorical.
+    """
+    if not isinstance(dates.dtype, pd.CategoricalDtype):
+        return pd.to_datetime(dates, format="%m-%d-%Y %H:%M:%S", errors="coerce")
+    parsed = pd.DatetimeIndex(
+        pd.to_datetime(
+            dates.cat.categories, format="%m-%d-%Y %H:%M:%S", errors="coerce"
+        )
+    )
+    return pd.Series(
+        parsed.take(dates.cat.codes.to_numpy(), allow_fill=True),
+        index=dates.index,
+        name=dates.name,
+    )
+
+
+def init_statistics_dict(tag: str, ndf: int, nbus: int) -> Dict:
+    """The statistics of a day without a point in a region"""
+    statistics_dict = dict()
+    statistics_dict["DAY"] = tag
+    statistics_dict["N_OBS"] = ndf
+    statistics_dict["N_BUS"] = nbus
+    statistics_dict["FILT_OBS"] = 0
+    statistics_dict["DIST_AVG"] = np.nan
+    statistics_dict["DIST_STD"] = np.nan
+    statistics_dict["DIST_MAX"] = np.nan
+    statistics_dict["DIST_MAX_BUS"] = "NONE"
+    statistics_dict["INTERVAL_AVG"] = np.nan
+    statistics_dict["INTERVAL_STD"] = np.nan
+    statistics_dict["INTERVAL_MIN"] = np.nan
+    statistics_dict["INTERVAL_MAX"] = np.nan
+    statistics_dict["INTERVAL_MIN_BUS"] = "NONE"
+    statistics_dict["INTERVAL_MAX_BUS"] = "NONE"
+    statistics_dict["AVGSPEED_AVG"] = np.nan
+    statistics_dict["AVGSPEED_STD"] = np.nan
+    statistics_dict["AVGSPEED_MIN"] = np.nan
+    statistics_dict["AVGSPEED_MAX"] = np.nan
+    statistics_dict["AVGSPEED_MIN_BUS"] = "NONE"
+    statistics_dict["AVGSPEED_MAX_BUS"] = "NONE"
+    statistics_dict["VELOCITY_AVG"] = np.nan
+    statistics_dict["VELOCITY_STD"] = np.nan
+    statistics_dict["VELOCITY_MIN"] = np.nan
+    statistics_dict["VELOCITY_MAX"] = np.nan
+    statistics_dict["VELOCITY_MIN_BUS"] = "NONE"
+    statistics_dict["VELOCITY_MAX_BUS"] = "NONE"
+    return statistics_dict
+
+
+def day_statistics(data_frame: pd.DataFrame, tag: str) -> Tuple[pd.DataFrame, Dict]:
+    """The statistics of a whole day, as computed by calculate_dayly_statistics
+
+    Args:
+        data_frame (pd.DataFrame): the entries of the day joined with the regions
+            (see join_regions)
+        tag (str): the day, e.g. G1-2017-07-12
+
+    Returns:
+        Tuple: the points in a region, bus after bus, with DIST, INTERVAL and
+            AVGSPEED (None for a day without a bus) and the statistics of the day
+    """
+    # The columns added and the sort stay in a copy, the caller's frame is left as is
+    data_frame = data_frame.copy(deep=False)
+
+    data_frame["NEWDATE"] = parse_dates(data_frame["DATE"])
+
+    data_frame["NDATE"] = data_frame["NEWDATE"]
+
+    data_frame.index = data_frame["NEWDATE"]
+
+    data_frame.sort_index(inplace=True)
+
+    busid_list = list(data_frame["BUSID"].unique())
+
+    statistics_dict = init_statistics_dict(tag, len(data_frame), len(busid_list))
+
+    if len(busid_list) == 0:
+        return None, statistics_dict
+
+    data_frame_list = list()
+    for bus in busid_list:
+        slice = data_frame[data_frame["BUSID"] == bus]
+        bus_df = pd.DataFrame(slice[slice["REGIAO_ADM"].notna()])
+        bus_df["DIST"] = haversine(
+            bus_df["LAT"],
+            bus_df["LONG"],
+            bus_df["LAT"].shift(),
+            bus_df["LONG"].shift(),
+        )
+        bus_df["INTERVAL"] = bus_df["NDATE"].diff()
+        bus_df["AVGSPEED"] = bus_df["DIST"] / (
+            bus_df["INTERVAL"] / np.timedelta64(1, "h")
+        )
+
+        bus_df.index = np.arange(len(bus_df))
+
+        data_frame_list.append(bus_df)
+
+    data_frame_result = pd.concat(data_frame_list, ignore_index=True)
+
+    data_frame_result.drop(
+        columns=[
+            "NEWDATE",
+            "NDATE",
+            "index_right",
+        ],
+        inplace=True,
+    )
+
+    statistics_dict["FILT_OBS"] = len(data_frame_result)
+    statistics_dict["DIST_AVG"] = data_frame_result["DIST"].mean()
+    statistics_dict["DIST_STD"] = data_frame_result["DIST"].std()
+    try:
+        statistics_dict["DIST_MAX"] = data_frame_result["DIST"].max()
+        statistics_dict["DIST_MAX_BUS"] = data_frame_result.iloc[
+            data_frame_result["DIST"].idxmax()
+        ]["BUSID"]
+    except Exception:
+        statistics_dict["DIST_MAX"] = np.nan
+        statistics_dict["DIST_MAX_BUS"] = "NONE"
+
+    for variable in ("INTERVAL", "AVGSPEED", "VELOCITY"):
+        statistics_dict[f"{variable}_AVG"] = data_frame_result[variable].mean()
+        statistics_dict[f"{variable}_STD"] = data_frame_result[variable].std()
+        try:
+            statistics_dict[f"{variable}_MIN"] = data_frame_result[variable].min()
+            statistics_dict[f"{variable}_MAX"] = data_frame_result[variable].max()
+            statistics_dict[f"{variable}_MIN_BUS"] = data_frame_result.iloc[
+                data_frame_result[variable].idxmin()
+            ]["BUSID"]
+            statistics_dict[f"{variable}_MAX_BUS"] = data_frame_result.iloc[
+                data_frame_result[variable].idxmax()
+            ]["BUSID"]
+        except Exception:
+            statistics_dict[f"{variable}_MIN"] = np.nan
+            statistics_dict[f"{variable}_MAX"] = np.nan
+            statistics_dict[f"{variable}_MIN_BUS"] = "NONE"
+            statistics_dict[f"{variable}_MAX_BUS"] = "NONE"
+
+    return data_frame_result, statistics_dict
+
+
+class ParquetStream(object):
+    """A Parquet file written a DataFrame at a time.
+
+    The first frame sets the schema, the next ones are converted to it (e.g. a
+    region column that is all null in a batch stays a string column). Categorical
+    columns are written as their values: the index type of a categorical grows
+    with its categories (int8 up to 128 buses, then int16), so it is not the same
+    from a frame to the next.
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.writer = None
+        return
+
+    def write(self, frame: pd.DataFrame) -> None:
+        categorical = {
+            column: frame[column].cat.categories.dtype
+            for column in frame.columns
+            if isinstance(frame[column].dtype, pd.CategoricalDtype)
+        }
+        if categorical:
+            frame = frame.astype(categorical)
+        if self.writer is None:
+            table = pa.Table.from_pandas(frame, preserve_index=False)
+            self.writer = pq.ParquetWriter(self.path, table.schema)
+        else:
+            table = pa.Table.from_pandas(
+                frame, schema=self.writer.schema, preserve_index=False
+            )
+        self.writer.write_table(table)
+        return
+
+    def close(self) -> None:
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+        return
+
+    def __enter__(self) -> "ParquetStream":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+        return
+
+
+class RunningMoments(object):
+    """Running mean and variance of a variable (Welford), a batch at a time: the
+    moments of a batch are merged into the running ones (Chan et al.). The extremes
+    are kept with the label (e.g. the bus) they were seen with. NaN are skipped.
+    """
+
+    def __init__(self) -> None:
+        self.length: int = 0
+        self.first_momentum: float = 0.0
+        self.second_momentum: float = 0.0
+        self.minimum: float = np.nan
+        self.maximum: float = np.nan
+        self.minimum_label = "NONE"
+        self.maximum_label = "NONE"
+        return
+
+    def add(self, values, labels) -> None:
+        """Add a batch of values
+
+        Args:
+            values (array_like): the values
+            labels (array_like): the label of every value
+        """
+        values = np.asarray(values, dtype=np.float64)
+        valid = ~np.isnan(values)
+        if not valid.any():
+            return
+        values, labels = values[valid], np.asarray(labels)[valid]
+
+        length = len(values)
+        mean = values.mean()
+        total = self.length + length
+        delta = mean - self.first_momentum
+        self.first_momentum += delta * length / total
+        self.second_momentum += (
+            ((values - mean) ** 2).sum() + delta**2 * self.length * length / total
+        )
+        self.length = total
+
+        # the first extreme is kept, as idxmin/idxmax do
+        i, j = values.argmin(), values.argmax()
+        if np.isnan(self.minimum) or values[i] < self.minimum:
+            self.minimum, self.minimum_label = values[i], labels[i]
+        if np.isnan(self.maximum) or values[j] > self.maximum:
+            self.maximum, self.maximum_label = values[j], labels[j]
+        return
+
+    def mean(self) -> float:
+        return self.first_momentum if self.length > 0 else np.nan
+
+    def std(self) -> float:
+        """The sample standard deviation, as pandas"""
+        if self.length < 2:
+            return np.nan
+        return float(np.sqrt(self.second_momentum / (self.length - 1)))
+
+
+class DayStatistics(object):
+    """The statistics of calculate_dayly_statistics, computed a batch at a time.
+
+    The points of a bus are taken in time order within a batch, and the first one
+    of a batch follows the last one of the previous batches, so the distances and
+    intervals are the ones of the whole day as long as the batches come in time
+    order (a report that arrives in a later batch is taken there).
+    """
+
+    VARIABLES = ("DIST", "INTERVAL", "AVGSPEED", "VELOCITY")
+
+    def __init__(self, tag: str) -> None:
+        self.tag = tag
+        self.n_obs = 0
+        self.filt_obs = 0
+        self.buses = set()
+        self.moments = {variable: RunningMoments() for variable in self.VARIABLES}
+        # the last point of every bus (in the region filter)
+        self.last = pd.DataFrame(
+            {
+                "BUSID": pd.Series(dtype=str),
+                "LAT": pd.Series(dtype=np.float64),
+                "LONG": pd.Series(dtype=np.float64),
+                "NDATE": pd.Series(dtype="datetime64[us]"),
+            }
+        )
+        return
+
+    def add(self, frame: pd.DataFrame) -> pd.DataFrame:
+        """Add a batch, the entries joined with the regions (see join_regions)
+
+        Args:
+            frame (pd.DataFrame): the batch
+
+        Returns:
+            pd.DataFrame: the points of the batch in a region, with DIST, INTERVAL
+                and AVGSPEED
+        """
+        self.n_obs += len(frame)
+        self.buses.update(frame["BUSID"].astype(str).unique())
+
+        bus_df = frame[frame["REGIAO_ADM"].notna()].assign(
+            NDATE=lambda df: parse_dates(df["DATE"])
+        )
+        bus_df = bus_df.sort_values("NDATE", kind="stable", ignore_index=True)
+        self.filt_obs += len(bus_df)
+
+        # The last points first: shift gives the previous point of the same bus
+        points = pd.concat(
+            [
+                self.last,
+                bus_df[["LAT", "LONG", "NDATE"]].assign(
+                    BUSID=bus_df["BUSID"].astype(str)
+                ),
+            ],
+            ignore_index=True,
+        )
+        previous = points.groupby("BUSID", sort=False).shift().iloc[len(self.last) :]
+        self.last = points.drop_duplicates("BUSID", keep="last")
+
+        bus_df["DIST"] = haversine(
+            bus_df["LAT"],
+            bus_df["LONG"],
+            previous["LAT"].to_numpy(),
+            previous["LONG"].to_numpy(),
+        )
+        bus_df["INTERVAL"] = bus_df["NDATE"] - previous["NDATE"].to_numpy()
+        bus_df["AVGSPEED"] = bus_df["DIST"] / (
+            bus_df["INTERVAL"] / np.timedelta64(1, "h")
+        )
+
+        labels = bus_df["BUSID"].astype(str).to_numpy()
+        self.moments["DIST"].add(bus_df["DIST"], labels)
+        self.moments["INTERVAL"].add(bus_df["INTERVAL"].dt.total_seconds(), labels)
+        self.moments["AVGSPEED"].add(bus_df["AVGSPEED"], labels)
+        self.moments["VELOCITY"].add(bus_df["VELOCITY"], labels)
+
+        return bus_df.drop(columns=["NDATE", "index_right"], errors="ignore")
+
+    def statistics(self) -> Dict:
+        """The statistics of the day, as enqueued to {squeue}-STATS"""
+        statistics_dict = dict()
+        statistics_dict["DAY"] = self.tag
+        statistics_dict["N_OBS"] = self.n_obs
+        statistics_dict["N_BUS"] = len(self.buses)
+        statistics_dict["FILT_OBS"] = self.filt_obs
+
+        def seconds(value):
+            if np.isnan(value):
+                return value
+            return pd.to_timedelta(value, unit="s").round("us")
+
+        for variable in self.VARIABLES:
+            moments = self.moments[variable]
+            convert = seconds if variable == "INTERVAL" else float
+            statistics_dict[f"{variable}_AVG"] = convert(moments.mean())
+            statistics_dict[f"{variable}_STD"] = convert(moments.std())
+            if variable != "DIST":
+                statistics_dict[f"{variable}_MIN"] = convert(moments.minimum)
+            statistics_dict[f"{variable}_MAX"] = convert(moments.maximum)
+            if variable != "DIST":
+                statistics_dict[f"{variable}_MIN_BUS"] = moments.minimum_label
+            statistics_dict[f"{variable}_MAX_BUS"] = moments.maximum_label
+        return statistics_dict
@@ -0,0 +1,691 @@
+# -*- coding: utf-8 -*-
+
+""" ingest.py. Ingest of the bus GPS minute files (@) 2022
+This module reads the minute JSON files of a day zip into the unique entries of
+the day. The columnar engine decodes every minute file straight into a typed
+record batch (dictionary-encoded strings, float64 coordinates and velocity) and
+deduplicates the rows of the day by sorting their columns, instead of building
+a Python set of tuples, several times larger than the data.
+This program is free software: you can redistribute it and/or modify it under
+the terms of the GNU General Public License as published by the Free Software
+Foundation, either version 3 of the License, or (at your option) any later
+version.
+This program is distributed in the hope that it will be useful, but WITHOUT
+ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+You should have received a copy of the GNU General Public License along with
+this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+
+# COPYRIGHT SECTION
+__author__ = "Diego Carvalho"
+__copyright__ = "Copyright 2022"
+__credits__ = ["Diego Carvalho"]
+__license__ = "GPL"
+__version__ = "1.0.1"
+__maintainer__ = "Diego Carvalho"
+__email__ = "d.carvalho@ieee.org"
+__status__ = "Research"
+
+import io
+import json
+import multiprocessing
+import re
+import resource
+import sys
+import time
+import zipfile
+from concurrent.futures import Executor, ProcessPoolExecutor
+from typing import Any, Callable, Dict, Iterator, List, Tuple
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as csv
+
+from tools.dag import decode_meta_name
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# The fields of a DATA row, in order
+COLUMNS = ["DATE", "BUSID", "LINE", "LAT", "LONG", "VELOCITY"]
+STRING_COLUMNS = COLUMNS[:3]
+FLOAT_COLUMNS = COLUMNS[3:]
+
+ENGINES = ("columnar", "python")
+
+
+def _orjson_loads(data: bytes) -> Any:
+    try:
+        return orjson.loads(data)
+    except orjson.JSONDecodeError:
+        # e.g. NaN, which the standard library takes
+        return json.loads(data)
+
+
+# The JSON decoders of the minute files, by name (see json_decoder)
+DECODERS = {"json": json.loads}
+if orjson is not None:
+    DECODERS["orjson"] = _orjson_loads
+
+
+def json_decoder(name: str = None) -> Callable[[bytes], Any]:
+    """A JSON decoder (loads) of the minute files
+
+    Args:
+        name (str, optional): "orjson" or "json" (the standard library). Defaults to
+            None, orjson when it is installed.
+
+    Raises:
+        ValueError: the decoder is unknown, or not installed
+    """
+    if name is None:
+        name = "orjson" if "orjson" in DECODERS else "json"
+    if name not in DECODERS:
+        raise ValueError(
+            f"unknown JSON decoder {name}, expected one of {list(DECODERS)}"
+        )
+    return DECODERS[name]
+
+
+def decode_entries(data: bytes, loads: Callable[[bytes], Any] = json.loads) -> List:
+    """The DATA rows of a minute file, None when it is not valid JSON"""
+    try:
+        return loads(data)["DATA"]
+    except ValueError:
+        # includes simplejson.decoder.JSONDecodeError
+        # invalid JSON numbers are encountered
+        return None
+
+
+DATA_START = re.compile(rb'"DATA"\s*:\s*\[\s*\[')
+NOT_PLAIN = (b"[", b"]", b"\\", b"null", b"true", b"false")
+
+# The DATA rows, rewritten as CSV (see decode_columns)
+CSV_READ = csv.ReadOptions(column_names=COLUMNS, use_threads=False)
+CSV_PARSE = csv.ParseOptions(quote_char=False, escape_char=False)
+CSV_CONVERT = csv.ConvertOptions(
+    column_types={
+        column: pa.string() if column in STRING_COLUMNS else pa.float64()
+        for column in COLUMNS
+    },
+    null_values=[],
+)
+
+
+def decode_columns(data: bytes) -> pa.RecordBatch:
+    """Decode the DATA rows of a minute file straight into a typed record batch, as
+    rows_to_batch, without a Python object per row or field: the DATA array is
+    rewritten as CSV, a line per row, and parsed by Arrow.
+
+    Only plain rows take this path: compact JSON (or with the ", " separators of
+    json.dumps), 6 fields, strings without commas, brackets or escapes, numbers in
+    the numeric fields and no null. A number in a string field is taken as the
+    JSON decoder does (see string_values).
+
+    Raises:
+        ValueError: the rows are not plain, the file is left to a JSON decoder
+    """
+    start = DATA_START.search(data)
+    end = data.find(b"]]", start.end()) if start else -1
+    if end < 0 or data[end + 2 : end + 3] not in (b",", b"}"):
+        raise ValueError("no DATA rows")
+    # A string with a comma is split in more than 6 fields, so it is never changed
+    rows = data[start.end() : end].replace(b", ", b",").replace(b"],[", b"\n")
+    if any(token in rows for token in NOT_PLAIN):
+        raise ValueError("DATA rows are not plain")
+    try:
+        table = csv.read_csv(
+            io.BytesIO(rows),
+            read_options=CSV_READ,
+            parse_options=CSV_PARSE,
+            convert_options=CSV_CONVERT,
+        )
+    except pa.ArrowInvalid as e:
+        # a row with other than 6 fields, a field that is not a number
+        raise ValueError(str(e))
+    arrays = [
+        string_values(table.column(column).combine_chunks())
+        for column in STRING_COLUMNS
+    ]
+    arrays += [table.column(column).combine_chunks() for column in FLOAT_COLUMNS]
+    return pa.RecordBatch.from_arrays(arrays, names=COLUMNS)
+
+
+def string_values(tokens: pa.Array) -> pa.DictionaryArray:
+    """The JSON tokens of a string field as a dictionary-encoded string column, as
+    string_column: a string without its quotes, a number as the str() of the one
+    json.loads decodes (e.g. 555.50 is 555.5, 1e3 is 1000.0)
+
+    Only the distinct tokens are decoded, and only the numbers in Python.
+
+    Raises:
+        ValueError: a token is not a JSON value
+    """
+    encoded = tokens.dictionary_encode()
+    quoted = pc.starts_with(encoded.dictionary, '"')
+    values = pc.utf8_trim(encoded.dictionary, '"')
+    if pc.all(quoted).as_py():
+        return pa.DictionaryArray.from_arrays(encoded.indices, values)
+    values = pa.array(
+        [
+            value if is_quoted else str(json.loads(value))
+            for value, is_quoted in zip(values.to_pylist(), quoted.to_pylist())
+        ],
+        pa.string(),
+    ).dictionary_encode()
+    # Two tokens may be the same value (e.g. 555.5 and 555.50)
+    return pa.DictionaryArray.from_arrays(
+        values.indices.take(encoded.indices), values.dictionary
+    )
+
+
+def string_column(values) -> pa.DictionaryArray:
+    """A dictionary-encoded string column"""
+    try:
+        array = pa.array(values, pa.string())
+    except (pa.ArrowInvalid, pa.ArrowTypeError):
+        array = None
+    if array is None or array.null_count > 0:
+        # Numbers (e.g. bus ids) are kept as their str(), as in the set of tuples
+        array = pa.array([str(value) for value in values], pa.string())
+    return array.dictionary_encode()
+
+
+def rows_to_batch(rows: List) -> pa.RecordBatch:
+    """Decode the DATA rows of a minute file into a typed record batch
+
+    Raises:
+        ValueError: a row has less than the 6 fields, or a field is not a number
+    """
+    columns = list(zip(*rows))
+    if len(columns) < len(COLUMNS):
+        raise ValueError(f"DATA rows have less than {len(COLUMNS)} fields")
+    arrays = [string_column(values) for values in columns[: len(STRING_COLUMNS)]]
+    arrays += [
+        pa.array(np.asarray(values, dtype=np.float64))
+        for values in columns[len(STRING_COLUMNS) : len(COLUMNS)]
+    ]
+    return pa.RecordBatch.from_arrays(arrays, names=COLUMNS)
+
+
+class ColumnarBatches(object):
+    """The rows of the minute files of a day, kept as columns: the strings as int32
+    codes into a dictionary of the day, the numbers as float64.
+
+    The dictionaries only hold the distinct values (times, buses and lines), so
+    a row costs 36 bytes, and to_frame drops the repeated rows by sorting them
+    (sort-unique), without hashing them into Python objects.
+    """
+
+    def __init__(self) -> None:
+        # value -> code, in the order the values were met
+        self.dictionaries = {column: dict() for column in STRING_COLUMNS}
+        self.chunks = {column: list() for column in COLUMNS}
+        self.rows = 0
+        return
+
+    def __len__(self) -> int:
+        return self.rows
+
+    def _mapping(self, column: str, values: List) -> np.ndarray:
+        """The codes of the day of values (e.g. a batch dictionary), added if new"""
+        dictionary = self.dictionaries[column]
+        codes = list(map(dictionary.get, values))
+        for i, code in enumerate(codes):
+            if code is None:
+                codes[i] = dictionary.setdefault(values[i], len(dictionary))
+        return np.asarray(codes, dtype=np.int32)
+
+    def add(self, rows: List) -> None:
+        """Add the DATA rows of a minute file (see rows_to_batch)"""
+        self.add_batch(rows_to_batch(rows))
+        return
+
+    def add_batch(self, batch: pa.RecordBatch) -> None:
+        for column in STRING_COLUMNS:
+            array = batch.column(column)
+            mapping = self._mapping(column, array.dictionary.to_pylist())
+            indices = array.indices.to_numpy(zero_copy_only=False)
+            self.chunks[column].append(mapping[indices])
+        for column in FLOAT_COLUMNS:
+            self.chunks[column].append(batch.column(column).to_numpy())
+        self.rows += batch.num_rows
+        return
+
+    def extend(self, other: "ColumnarBatches") -> None:
+        """Add the rows of other, e.g. decoded by another worker"""
+        for column in STRING_COLUMNS:
+            mapping = self._mapping(column, list(other.dictionaries[column]))
+            for codes in other.chunks[column]:
+                self.chunks[column].append(mapping[codes])
+        for column in FLOAT_COLUMNS:
+            self.chunks[column].extend(other.chunks[column])
+        self.rows += other.rows
+        return
+
+    def columns(self) -> Dict[str, np.ndarray]:
+        """Every column in a single array (codes for the strings)"""
+        return {
+            column: np.concatenate(chunks)
+            if chunks
+            else np.empty(0, np.int32 if column in STRING_COLUMNS else np.float64)
+            for column, chunks in self.chunks.items()
+        }
+
+    def clear(self) -> None:
+        """Drop the rows, the dictionaries of the day are kept"""
+        self.chunks = {column: list() for column in COLUMNS}
+        self.rows = 0
+        return
+
+    def frame(self, columns: Dict[str, np.ndarray]) -> pd.DataFrame:
+        """A DataFrame of columns (e.g. picked from columns()), the strings as
+        categoricals of the dictionaries of the day
+
+        The categoricals travel as Arrow dictionaries (see ArrowSerializer) and
+        Parquet dictionary pages, so every time, bus and line is held once.
+        """
+        frame = dict()
+        for column in COLUMNS:
+            if column in STRING_COLUMNS:
+                categories = list(self.dictionaries[column])
+                frame[column] = pd.Categorical.from_codes(
+                    columns[column], categories=categories
+                )
+            else:
+                frame[column] = columns[column]
+        return pd.DataFrame(frame)
+
+    def to_frame(self) -> pd.DataFrame:
+        """The unique rows, in the order they were first met (see frame)"""
+        columns = self.columns()
+        keep = unique_rows([columns[column] for column in COLUMNS])
+        return self.frame({column: columns.pop(column)[keep] for column in COLUMNS})
+
+
+def unique_rows(columns: List[np.ndarray]) -> np.ndarray:
+    """Positions of the first occurrence of every distinct row
+
+    The rows are hashed, and a repeated hash is checked against the row that first
+    had it, so a (64-bit) collision falls back to sorting the rows (sort-unique).
+
+    Args:
+        columns (List[np.ndarray]): the columns, of the same length
+
+    Returns:
+        np.ndarray: the positions, sorted
+    """
+    n = len(columns[0]) if columns else 0
+    if n == 0:
+        return np.empty(0, dtype=np.int64)
+    hashes = pd.util.hash_array(columns[0])
+    for column in columns[1:]:
+        hashes = hashes * np.uint64(1000003) ^ pd.util.hash_array(column)
+    # codes number the hashes in the order they were first met, so a code first
+    # appears where the running maximum grows
+    codes, _ = pd.factorize(hashes)
+    del hashes
+    first = np.flatnonzero(np.diff(np.maximum.accumulate(codes), prepend=-1) > 0)
+    if all(np.array_equal(column[first[codes]], column) for column in columns):
+        return first
+    # A stable sort, so the first occurrence leads every group of equal rows
+    order = np.lexsort(columns[::-1])
+    repeated = np.ones(n - 1, dtype=bool)
+    for column in columns:
+        values = column[order]
+        repeated &= values[1:] == values[:-1]
+    first = np.concatenate(([True], ~repeated))
+    return np.sort(order[first])
+
+
+def reset_peak_rss() -> bool:
+    """Reset the peak resident set size of this process to the current one, so that
+    peak_rss is the one of a task (e.g. a day read by a reused Parsl worker), see
+    clear_refs in proc(5)
+
+    Returns:
+        bool: False when the peak cannot be reset (not Linux), peak_rss is then the
+            one of the whole life of the process
+    """
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        return False
+    return True
+
+
+def peak_rss() -> int:
+    """Peak resident set size of this process since reset_peak_rss, in bytes"""
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes, except on macOS
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def new_errors() -> Dict[str, List]:
+    """The errors of an ingest, as written to the ERROR-PH1 parquet"""
+    return {"MOTIF": list(), "FILENAME": list(), "EXTRAINFO": list()}
+
+
+def add_error(errors: Dict[str, List], motif: str, file_name: str, extra: str) -> None:
+    errors["MOTIF"].append(motif)
+    errors["FILENAME"].append(str(file_name))
+    errors["EXTRAINFO"].append(str(extra))
+    return
+
+
+def zip_manifest(zip_file_name: str) -> pd.DataFrame:
+    """The members of a day zip with their size and CRC-32, read from the central
+    directory of the zip (nothing is decompressed)
+
+    Raises:
+        zipfile.BadZipFile: the zip is not readable
+    """
+    with zipfile.ZipFile(zip_file_name) as file_handler:
+        infos = [info for info in file_handler.infolist() if not info.is_dir()]
+    return pd.DataFrame(
+        {
+            "MEMBER": [info.filename for info in infos],
+            "SIZE": np.array([info.file_size for info in infos], dtype=np.int64),
+            "CRC": np.array([info.CRC for info in infos], dtype=np.int64),
+        }
+    )
+
+
+def save_manifest(zip_file_name: str, path: str) -> pd.DataFrame:
+    """Write the manifest of a day zip (see zip_manifest) to a parquet file
+
+    Returns:
+        pd.DataFrame: the manifest, None when the zip is not readable (nothing is written)
+    """
+    try:
+        manifest = zip_manifest(zip_file_name)
+    except Exception:  # BadZipFile, reported by read_day
+        return None
+    manifest.to_parquet(path)
+    return manifest
+
+
+def manifest_changes(
+    manifest: pd.DataFrame, previous: pd.DataFrame
+) -> Tuple[List[str], List[str], List[str]]:
+    """The members of a day zip that are new, changed or removed since previous
+
+    Args:
+        manifest (pd.DataFrame): the manifest of the day zip (see zip_manifest)
+        previous (pd.DataFrame): the manifest of the zip when the day was processed
+
+    Returns:
+        Tuple: the new members and the changed ones (in size or CRC), in the order
+            of the zip, and the members of previous that are no longer in it
+    """
+    merged = manifest.merge(
+        previous, on="MEMBER", how="left", suffixes=("", "_PREVIOUS")
+    )
+    new = merged["SIZE_PREVIOUS"].isna()
+    changed = ~new & (
+        (merged["SIZE"] != merged["SIZE_PREVIOUS"])
+        | (merged["CRC"] != merged["CRC_PREVIOUS"])
+    )
+    removed = ~previous["MEMBER"].isin(manifest["MEMBER"])
+    return (
+        list(merged.loc[new, "MEMBER"]),
+        list(merged.loc[changed, "MEMBER"]),
+        list(previous.loc[removed, "MEMBER"]),
+    )
+
+
+def incremental_members(manifest: pd.DataFrame, previous: pd.DataFrame) -> List[str]:
+    """The members to read to bring the outputs of a day up to date, its new members
+
+    The outputs do not tell which member a row came from, so the rows of a changed
+    or removed member cannot be taken out: the whole day is read again.
+
+    Args:
+        manifest (pd.DataFrame): the manifest of the day zip (see zip_manifest)
+        previous (pd.DataFrame): the manifest of the zip when the day was processed,
+            None when the day was not processed
+
+    Returns:
+        List[str]: the new members (empty when nothing changed), None for every
+            member
+    """
+    if previous is None:
+        return None
+    new, changed, removed = manifest_changes(manifest, previous)
+    if changed or removed:
+        return None
+    return new
+
+
+def read_members(
+    zip_file_name: str,
+    file_names: List[str],
+    engine: str = "columnar",
+    decoder: str = None,
+) -> Tuple[Any, int, Dict[str, List]]:
+    """Decode some minute files (members) of a day zip
+
+    The columnar engine decodes the plain files with decode_columns, the others
+    with the JSON decoder.
+
+    Args:
+        zip_file_name (str): the day zip
+        file_names (List[str]): the members to decode, e.g. a slice of namelist()
+        engine (str, optional): see read_day. Defaults to "columnar".
+        decoder (str, optional): the JSON decoder (see json_decoder). Defaults to None.
+
+    Returns:
+        Tuple: the entries (a ColumnarBatches, or a set of tuples), the rows read
+            and the errors
+    """
+    batches = ColumnarBatches()
+    unique_entries = set()
+    rows = 0
+    errors = new_errors()
+    meta_day = decode_meta_name(zip_file_name)[3:]  # format: G1-2017-07-12
+    loads = json_decoder(decoder)
+
+    with zipfile.ZipFile(zip_file_name) as file_handler:
+        for file_name in file_names:
+            h_tag = f"{meta_day}:{decode_meta_name(file_name)}"
+            try:
+                data = file_handler.read(file_name)
+                if engine == "columnar":
+                    try:
+                        batches.add_batch(decode_columns(data))
+                        continue
+                    except ValueError:
+                        pass
+                entries_in_minute_file = decode_entries(data, loads)
+                if not entries_in_minute_file or entries_in_minute_file == [[]]:
+                    add_error(errors, "DECODE FAIL", file_name, h_tag)
+                    continue
+                if engine == "columnar":
+                    batches.add(entries_in_minute_file)
+                    continue
+                for each_entry in entries_in_minute_file:
+                    unique_entries.add(
+                        (
+                            str(each_entry[0]),  # the GPS time
+                            str(each_entry[1]),  # the bus index
+                            str(each_entry[2]),  # the busline or service
+                            float(each_entry[3]),  # the latitude
+                            float(each_entry[4]),  # the longitude
+                            float(each_entry[5]),  # the velocity
+                        )
+                    )
+                    rows += 1
+            except Exception:  # zipfile.BadZipFile, a malformed row
+                add_error(errors, "FIELDERROR", file_name, h_tag)
+
+    if engine == "columnar":
+        return batches, len(batches), errors
+    return unique_entries, rows, errors
+
+
+def read_day(
+    zip_file_name: str,
+    engine: str = "columnar",
+    workers: int = 1,
+    executor: Executor = None,
+    decoder: str = None,
+    members: List[str] = None,
+) -> Tuple[Any, Dict[str, List], Dict[str, float]]:
+    """Read the unique entries of a day zip, a minute JSON file per member
+
+    With workers > 1 the members are split in as many consecutive slices, decoded
+    in parallel (see read_members) and merged in order, so the result is the same
+    as the one of a serial read.
+
+    Args:
+        zip_file_name (str): the day zip
+        engine (str, optional): "columnar" (a DataFrame, see ColumnarBatches) or
+            "python" (a set of tuples). Defaults to "columnar".
+        workers (int, optional): slices of the members decoded in parallel. Defaults to 1.
+        executor (Executor, optional): pool decoding the slices, e.g. a
+            ThreadPoolExecutor. Defaults to None (a pool of as many processes).
+        decoder (str, optional): the JSON decoder (see json_decoder). Defaults to None.
+        members (List[str], optional): read only these members, e.g. the new ones
+            (see incremental_members). Defaults to None, every member.
+
+    Returns:
+        Tuple: the unique entries, the errors (MOTIF, FILENAME and EXTRAINFO lists)
+            and the ingest statistics (ROWS read, UNIQUE_ROWS, ROWS_PER_S, PEAK_RSS
+            of this read, NaN where it cannot be told from the one of the process,
+            see reset_peak_rss)
+    """
+    if engine not in ENGINES:
+        raise ValueError(f"unknown ingest engine {engine}, expected one of {ENGINES}")
+    json_decoder(decoder)
+
+    start = time.time()
+    scoped_rss = reset_peak_rss()
+    errors = new_errors()
+    parts = list()
+
+    try:
+        with zipfile.ZipFile(zip_file_name) as file_handler:
+            file_names = file_handler.namelist()
+        if members is not None:
+            members = set(members)
+            file_names = [name for name in file_names if name in members]
+        if workers > 1 and len(file_names) > 1:
+            slices = np.array_split(np.arange(len(file_names)), workers)
+            pool = executor
+            if pool is None:
+                # spawn: the caller may be a (threaded) Parsl worker
+                pool = ProcessPoolExecutor(
+                    max_workers=workers,
+                    mp_context=multiprocessing.get_context("spawn"),
+                )
+            try:
+                futures = [
+                    pool.submit(
+                        read_members,
+                        zip_file_name,
+                        [file_names[i] for i in part],
+                        engine,
+                        decoder,
+                    )
+                    for part in slices
+                    if len(part) > 0
+                ]
+                parts = [future.result() for future in futures]
+            finally:
+                if executor is None:
+                    pool.shutdown()
+        else:
+            parts = [read_members(zip_file_name, file_names, engine, decoder)]
+    except Exception:  # BadZipFile
+        add_error(errors, "BADZIPFILE", zip_file_name, decode_meta_name(zip_file_name))
+
+    # Merge the slices in order, the first occurrence of a row is kept
+    unique_entries = ColumnarBatches() if engine == "columnar" else set()
+    rows = 0
+    while parts:
+        entries, part_rows, part_errors = parts.pop(0)
+        if engine == "columnar":
+            unique_entries.extend(entries)
+        else:
+            unique_entries.update(entries)
+        rows += part_rows
+        for field, values in part_errors.items():
+            errors[field].extend(values)
+    if engine == "columnar":
+        unique_entries = unique_entries.to_frame()
+
+    elapsed = time.time() - start
+    statistics = {
+        "ROWS": rows,
+        "UNIQUE_ROWS": len(unique_entries),
+        "ROWS_PER_S": rows / elapsed if elapsed > 0 else 0.0,
+        "PEAK_RSS": peak_rss() if scoped_rss else np.nan,
+    }
+    return unique_entries, errors, statistics
+
+
+def stream_day(
+    zip_file_name: str, batch_files: int = 60, window: int = 1, decoder: str = None
+) -> Iterator[Tuple[pd.DataFrame, int, Dict[str, List]]]:
+    """Read the unique entries of a day zip in bounded batches, e.g. an hour (60
+    minute files) at a time, so the day is never held whole
+
+    A minute file repeats the last reports of the buses: a row is dropped when it
+    repeats one of its batch or of the last window batches (the dedup window).
+
+    Args:
+        zip_file_name (str): the day zip
+        batch_files (int, optional): minute files (members) per batch. Defaults to 60.
+        window (int, optional): previous batches a row is checked against. Defaults to 1.
+        decoder (str, optional): the JSON decoder (see json_decoder). Defaults to None.
+
+    Yields:
+        Tuple: the new unique entries of a batch (a DataFrame, as read_day), the rows
+            read and the errors (see read_day)
+    """
+    try:
+        with zipfile.ZipFile(zip_file_name) as file_handler:
+            file_names = file_handler.namelist()
+    except Exception:  # BadZipFile
+        errors = new_errors()
+        add_error(errors, "BADZIPFILE", zip_file_name, decode_meta_name(zip_file_name))
+        yield ColumnarBatches().to_frame(), 0, errors
+        return
+
+    # The dictionaries of the day grow batch after batch, the codes stay comparable
+    batches = ColumnarBatches()
+    seen = list()
+    for first in range(0, len(file_names), batch_files):
+        part, rows, errors = read_members(
+            zip_file_name, file_names[first : first + batch_files], decoder=decoder
+        )
+        batches.extend(part)
+        columns = batches.columns()
+        batches.clear()
+
+        # the first occurrences that fall in this batch are its new rows
+        n_seen = sum(len(past[COLUMNS[0]]) for past in seen)
+        keep = unique_rows(
+            [
+                np.concatenate([past[column] for past in seen] + [columns[column]])
+                for column in COLUMNS
+            ]
+        )
+        keep = keep[keep >= n_seen] - n_seen
+        unique = {column: columns[column][keep] for column in COLUMNS}
+        seen = (seen + [unique])[-window:] if window > 0 else list()
+        yield batches.frame(unique), rows, errors
+    return
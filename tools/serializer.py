@@ -24,11 +24,234 @@ __maintainer__ = "Diego Carvalho"
 __email__ = "d.carvalho@ieee.org"
 __status__ = "Research"
 
+import collections
+import copy
+import io
+import json
 import pickle
+import struct
+import threading
+import time
 from abc import ABC, abstractmethod
+from concurrent.futures import Executor
 
 import blosc
 import cloudpickle
+import pandas as pd
+import pyarrow as pa
+
+
+class ViewReader(io.RawIOBase):
+    """Read-only file-like object over a buffer (bytes, memoryview, mmap) that
+    hands out its content without copying the whole buffer first.
+    """
+
+    def __init__(self, value) -> None:
+        self.view = memoryview(value).cast("B")
+        self.position = 0
+        return
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, b) -> int:
+        n = min(len(b), len(self.view) - self.position)
+        b[:n] = self.view[self.position : self.position + n]
+        self.position += n
+        return n
+
+
+_blosc_threads = [None]
+_blosc_threads_lock = threading.Lock()
+
+
+def set_blosc_threads(nthreads: int) -> None:
+    """Set the (process-wide) number of blosc threads, if it changed
+
+    blosc keeps a single thread count for the whole process, so it is set when a
+    serializer is configured, and never by the threads compressing the frames.
+    None leaves it as it is.
+    """
+    if nthreads is None:
+        return
+    with _blosc_threads_lock:
+        if _blosc_threads[0] != nthreads:
+            blosc.set_nthreads(nthreads)
+            _blosc_threads[0] = nthreads
+    return
+
+
+def blosc_raw_size(buffer) -> int:
+    """Uncompressed size recorded in the header of a blosc buffer"""
+    return struct.unpack_from("<I", buffer, 4)[0]
+
+
+class BloscCodec(object):
+    """A blosc configuration: codec, compression level, shuffle, typesize and threads.
+
+    With cname="auto" the codec and shuffle are picked, on the first buffer
+    compressed, by tune: every candidate compresses a sample of that buffer, and the
+    one minimizing compression time plus transfer time at the given bandwidth wins.
+    The threads are a setting of the whole process, applied by the serializer
+    configuring the codec (see set_blosc_threads), not by compress, which may run
+    in several worker threads at once.
+    """
+
+    candidates = ("lz4", "zstd", "blosclz")
+    shuffles = (blosc.NOSHUFFLE, blosc.SHUFFLE, blosc.BITSHUFFLE)
+
+    def __init__(
+        self,
+        cname: str = "blosclz",
+        clevel: int = 9,
+        shuffle: int = blosc.SHUFFLE,
+        typesize: int = 8,
+        nthreads: int = None,
+        sample_size: int = 262144,
+        bandwidth: float = 1e9,
+    ) -> None:
+        self.cname = cname
+        self.clevel = clevel
+        self.shuffle = shuffle
+        self.typesize = typesize
+        self.nthreads = nthreads
+        self.sample_size = sample_size
+        self.bandwidth = bandwidth
+        return
+
+    def __repr__(self) -> str:
+        return (
+            f"{self.__class__.__name__}({self.cname},{self.clevel},"
+            f"{self.shuffle},{self.typesize},{self.nthreads})"
+        )
+
+    def compress(self, buffer) -> bytes:
+        """Compress a buffer, tuning the codec first if it is still "auto" """
+        if self.cname == "auto":
+            self.tune(buffer)
+        return blosc.compress(
+            buffer,
+            typesize=self.typesize,
+            clevel=self.clevel,
+            shuffle=self.shuffle,
+            cname=self.cname,
+        )
+
+    def tune(self, buffer) -> None:
+        """Pick the codec and shuffle with the best time trade-off on a sample of buffer"""
+        with memoryview(buffer) as view:
+            sample = bytes(view[: self.sample_size])
+
+        best_cost = None
+        for cname in self.candidates:
+            for shuffle in self.shuffles:
+                start = time.perf_counter()
+                compressed = blosc.compress(
+                    sample,
+                    typesize=self.typesize,
+                    clevel=self.clevel,
+                    shuffle=shuffle,
+                    cname=cname,
+                )
+                cost = time.perf_counter() - start + len(compressed) / self.bandwidth
+                if best_cost is None or cost < best_cost:
+                    best_cost, self.cname, self.shuffle = cost, cname, shuffle
+        return
+
+
+class FrameWriter(io.RawIOBase):
+    """Compress everything written into independent blosc frames.
+
+    Every frame is a little-endian uint32 with the compressed size followed by the
+    blosc buffer, so a FrameReader can decompress the stream frame by frame. Given
+    an executor, the frames are compressed in parallel (blosc releasing the GIL)
+    and written in order as they are done.
+    """
+
+    header = struct.Struct("<I")
+    # Frames compressed ahead of the stream, bounding the memory held
+    max_pending = 16
+
+    def __init__(
+        self, stream, frame_size: int, codec: BloscCodec, executor: Executor = None
+    ) -> None:
+        self.stream = stream
+        self.frame_size = frame_size
+        self.codec = codec
+        self.executor = executor
+        self.buffer = bytearray()
+        # Frames being compressed, oldest first
+        self.pending = collections.deque()
+        if executor is not None:
+            blosc.set_releasegil(True)
+        return
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, b) -> int:
+        with memoryview(b) as view:
+            self.buffer += view
+            n = view.nbytes
+        while len(self.buffer) >= self.frame_size:
+            self._write_frame(self.frame_size)
+        return n
+
+    def _write_frame(self, n: int) -> None:
+        if self.executor is not None:
+            frame = bytes(self.buffer[:n])
+            del self.buffer[:n]
+            if self.codec.cname == "auto":
+                # Tuned once, before the workers share the codec
+                self.codec.tune(frame)
+            self.pending.append(self.executor.submit(self.codec.compress, frame))
+            while len(self.pending) > self.max_pending:
+                self._emit(self.pending.popleft().result())
+            return
+        with memoryview(self.buffer) as view:
+            frame = self.codec.compress(view[:n])
+        del self.buffer[:n]
+        self._emit(frame)
+        return
+
+    def _emit(self, frame: bytes) -> None:
+        self.stream.write(self.header.pack(len(frame)))
+        self.stream.write(frame)
+        return
+
+    def close(self) -> None:
+        """Write the last (partial) frame. The underlying stream is left open."""
+        if not self.closed:
+            if len(self.buffer) > 0:
+                self._write_frame(len(self.buffer))
+            while self.pending:
+                self._emit(self.pending.popleft().result())
+        super().close()
+        return
+
+
+class FrameReader(io.RawIOBase):
+    """Decompress, frame by frame, a stream written by FrameWriter"""
+
+    def __init__(self, stream) -> None:
+        self.stream = stream
+        self.frame = memoryview(b"")
+        return
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, b) -> int:
+        if len(self.frame) == 0:
+            header = self.stream.read(FrameWriter.header.size)
+            if len(header) < FrameWriter.header.size:
+                return 0
+            (frame_size,) = FrameWriter.header.unpack(header)
+            self.frame = memoryview(blosc.decompress(self.stream.read(frame_size)))
+        n = min(len(b), len(self.frame))
+        b[:n] = self.frame[:n]
+        self.frame = self.frame[n:]
+        return n
 
 
 class Serializer(ABC):
@@ -56,6 +279,36 @@ class Serializer(ABC):
             result = None
         return result
 
+    def with_options(self, **options):
+        """Return a copy of this serializer with some of its attributes replaced."""
+        clone = copy.copy(self)
+        for name, value in options.items():
+            if not hasattr(clone, name):
+                raise TypeError(f"{self.__class__.__name__} has no option {name}")
+            setattr(clone, name, value)
+        return clone
+
+    def decode_stream(self, stream):
+        """Decode a value read incrementally from a binary file-like object."""
+        try:
+            result = self.load(stream)
+        except:
+            result = None
+        return result
+
+    def dump(self, value, stream):
+        """Encode value into a binary file-like object."""
+        stream.write(self.serialize(value))
+        return
+
+    def load(self, stream):
+        """Decode a value from a binary file-like object (the default reads it all)."""
+        return self.deserialize(stream.read())
+
+    def raw_size(self, value) -> int:
+        """Size of an encoded value before compression (the encoded size if not compressed)."""
+        return memoryview(value).nbytes
+
     @abstractmethod
     def serialize(self, value):
         pass
@@ -72,7 +325,8 @@ class NoneSerializer(Serializer):
 
     def deserialize(self, value):
         """Decode Plain value to Python object."""
-        return value
+        # Values mapped from shared memory come as memoryviews
+        return bytes(value) if isinstance(value, memoryview) else value
 
 
 class PicklerSerializer(Serializer):
@@ -88,6 +342,15 @@ class PicklerSerializer(Serializer):
         """Decode pickled value to Python object."""
         return pickle.loads(value)
 
+    def dump(self, value, stream):
+        """Pickle value straight into a binary file-like object."""
+        pickle.dump(value, stream, protocol=self.protocol)
+        return
+
+    def load(self, stream):
+        """Unpickle a value while it is read from a binary file-like object."""
+        return pickle.load(stream)
+
 
 class CloudPicklerSerializer(Serializer):
     """The cloudpickle serializer."""
@@ -100,20 +363,225 @@ class CloudPicklerSerializer(Serializer):
         """Decode pickled value to Python object."""
         return pickle.loads(value)
 
+    def dump(self, value, stream):
+        """Pickle value straight into a binary file-like object."""
+        cloudpickle.dump(value, stream)
+        return
+
+    def load(self, stream):
+        """Unpickle a value while it is read from a binary file-like object."""
+        return pickle.load(stream)
+
 
 class CompactedPicklerSerializer(Serializer):
-    """The compacted pickle serializer."""
+    """The compacted pickle serializer.
 
-    def __init__(self, protocol: int = 5, cname: str = "blosclz"):
+    The pickle stream is compressed into independent blosc frames (see FrameWriter),
+    so values are encoded and decoded incrementally, and never hit the blosc limit
+    of 2 GB per buffer. Values stored as a single blosc buffer are still decoded.
+    """
+
+    magic = b"BLZF\x01"
+
+    def __init__(
+        self,
+        protocol: int = 5,
+        cname: str = "blosclz",
+        clevel: int = 9,
+        shuffle: int = blosc.SHUFFLE,
+        typesize: int = 8,
+        nthreads: int = None,
+        frame_size: int = 4194304,
+        bandwidth: float = 1e9,
+        executor: Executor = None,
+    ):
+        """CompactedPicklerSerializer Constructor
+
+        Args:
+            protocol (int, optional): pickle protocol. Defaults to 5.
+            cname (str, optional): blosc codec (lz4, zstd, blosclz, ...) or "auto". Defaults to "blosclz".
+            clevel (int, optional): compression level, from 0 to 9. Defaults to 9.
+            shuffle (int, optional): blosc.NOSHUFFLE, SHUFFLE or BITSHUFFLE. Defaults to blosc.SHUFFLE.
+            typesize (int, optional): element size used by the shuffle (8 for float64). Defaults to 8.
+            nthreads (int, optional): blosc threads, a setting of the whole process (see
+                set_blosc_threads). Defaults to None (left as it is).
+            frame_size (int, optional): bytes of pickle stream compressed per frame. Defaults to 4 MiB.
+            bandwidth (float, optional): bytes/s used to weight the size when cname is "auto". Defaults to 1e9.
+            executor (Executor, optional): compresses the frames in parallel (see FrameWriter). Defaults to None.
+        """
         self.protocol = protocol
         self.cname = cname
+        self.clevel = clevel
+        self.shuffle = shuffle
+        self.typesize = typesize
+        self.nthreads = nthreads
+        self.frame_size = frame_size
+        self.bandwidth = bandwidth
+        self.executor = executor
+        set_blosc_threads(nthreads)
+
+    def with_options(self, **options):
+        """Return a copy of this serializer with some of its options replaced (the
+        blosc threads given are set here, see set_blosc_threads)."""
+        clone = super().with_options(**options)
+        set_blosc_threads(options.get("nthreads"))
+        return clone
+
+    def codec(self) -> BloscCodec:
+        """Build the blosc configuration used to encode one value"""
+        return BloscCodec(
+            self.cname,
+            self.clevel,
+            self.shuffle,
+            self.typesize,
+            self.nthreads,
+            min(self.frame_size, 262144),
+            self.bandwidth,
+        )
 
     def serialize(self, value):
         """Encode value to pickle format."""
-        return blosc.compress(
-            pickle.dumps(value, protocol=self.protocol), cname=self.cname
-        )
+        stream = io.BytesIO()
+        self.dump(value, stream)
+        # The encoded frames are handed out without copying them again
+        return stream.getbuffer()
 
     def deserialize(self, value):
         """Decode pickled value to Python object."""
-        return pickle.loads(blosc.decompress(value))
+        return self.load(io.BufferedReader(ViewReader(value)))
+
+    def dump(self, value, stream):
+        """Pickle and compress value, frame by frame, into a binary file-like object."""
+        stream.write(self.magic)
+        writer = FrameWriter(stream, self.frame_size, self.codec(), self.executor)
+        pickle.dump(value, writer, protocol=self.protocol)
+        writer.close()
+        return
+
+    def load(self, stream):
+        """Decompress and unpickle a value while it is read from a binary file-like object."""
+        magic = stream.read(len(self.magic))
+        if magic != self.magic:
+            # A single blosc buffer, as written before the frames were introduced
+            return pickle.loads(blosc.decompress(magic + stream.read()))
+        return pickle.load(io.BufferedReader(FrameReader(stream), self.frame_size))
+
+    def raw_size(self, value) -> int:
+        """Size of the pickle stream, read from the headers of the blosc frames."""
+        with memoryview(value) as view:
+            if bytes(view[: len(self.magic)]) != self.magic:
+                return blosc_raw_size(view)
+            size, offset = 0, len(self.magic)
+            while offset < view.nbytes:
+                (frame_size,) = FrameWriter.header.unpack(
+                    view[offset : offset + FrameWriter.header.size]
+                )
+                offset += FrameWriter.header.size
+                size += blosc_raw_size(view[offset : offset + frame_size])
+                offset += frame_size
+        return size
+
+
+class ArrowSerializer(Serializer):
+    """The Arrow IPC serializer for pandas and GeoPandas data frames.
+
+    The frame is written as a single Arrow IPC stream. GeoDataFrame geometry
+    columns travel as WKB and are rebuilt (with their CRS) on decode.
+    """
+
+    metadata_key = b"gear.geo"
+
+    def serialize(self, value):
+        """Encode a data frame to an Arrow IPC stream."""
+        geo = None
+        geometry_name = getattr(value, "_geometry_column_name", None)
+        if geometry_name is not None:
+            geo = {
+                "geometry": geometry_name,
+                "columns": [
+                    c for c in value.columns if str(value[c].dtype) == "geometry"
+                ],
+                "crs": value.crs.to_wkt() if value.crs is not None else None,
+            }
+            value = value.to_wkb()
+
+        table = pa.Table.from_pandas(value, preserve_index=True)
+        if geo is not None:
+            metadata = dict(table.schema.metadata or {})
+            metadata[self.metadata_key] = json.dumps(geo).encode()
+            table = table.replace_schema_metadata(metadata)
+
+        sink = pa.BufferOutputStream()
+        with pa.ipc.new_stream(sink, table.schema) as writer:
+            writer.write_table(table)
+        # The returned pa.Buffer exposes the buffer protocol, so the storage
+        # layer can slice it into chunks without a copy
+        return sink.getvalue()
+
+    def deserialize(self, value):
+        """Decode an Arrow IPC stream into a data frame, referencing value's memory.
+
+        Columns that Arrow can hand over without a copy stay as read-only views
+        over value, so callers must assign new columns instead of writing in place.
+        """
+        return self._to_frame(pa.py_buffer(value))
+
+    def load(self, stream):
+        """Decode an Arrow IPC stream read batch by batch from a binary file-like object."""
+        return self._to_frame(stream)
+
+    @staticmethod
+    def _dictionary_codes(table: pa.Table):
+        """Replace the dictionary columns of a table by their codes
+
+        pyarrow rebuilds the categories of a dictionary column through Python
+        objects, tens of ms for the times of a day (see ColumnarBatches.frame), so
+        the categoricals are built from the codes and the categories instead.
+
+        Returns:
+            Tuple: the table and the CategoricalDtype of every column replaced
+        """
+        pandas_metadata = table.schema.pandas_metadata or {}
+        columns = set(
+            column["name"]
+            for column in pandas_metadata.get("columns", [])
+            if column["name"] == column["field_name"]
+        )
+        index = pandas_metadata.get("index_columns", [])
+        columns.difference_update(name for name in index if isinstance(name, str))
+        table = table.unify_dictionaries()
+        categories = dict()
+        for i, field in enumerate(table.schema):
+            column = table.column(i)
+            if (
+                not pa.types.is_dictionary(field.type)
+                or field.name not in columns
+                or column.num_chunks == 0
+            ):
+                continue
+            categories[field.name] = pd.CategoricalDtype(
+                column.chunk(0).dictionary.to_pandas(), ordered=field.type.ordered
+            )
+            codes = pa.chunked_array([chunk.indices for chunk in column.chunks])
+            table = table.set_column(i, field.name, codes.fill_null(-1))
+        return table, categories
+
+    def _to_frame(self, source):
+        with pa.ipc.open_stream(source) as reader:
+            table = reader.read_all()
+
+        metadata = table.schema.metadata or {}
+        table, categories = self._dictionary_codes(table)
+        frame = table.to_pandas(split_blocks=True, self_destruct=True)
+        del table
+        for name, dtype in categories.items():
+            frame[name] = pd.Categorical.from_codes(frame[name], dtype=dtype)
+
+        if self.metadata_key in metadata:
+            import geopandas as gpd
+
+            geo = json.loads(metadata[self.metadata_key])
+            for column in geo["columns"]:
+                frame[column] = gpd.GeoSeries.from_wkb(frame[column], crs=geo["crs"])
+            frame = gpd.GeoDataFrame(frame, geometry=geo["geometry"], crs=geo["crs"])
+        return frame
@@ -19,6 +19,8 @@ from applications import (
     filter_entries_pipeline,
     read_unique_entries_from_file,
     calculate_dayly_statistics,
+    stream_day_pipeline,
+    incremental_day_pipeline,
     dump_statistics,
 )
 
@@ -48,21 +50,44 @@ def main():
     metadata_dir = "../processed/metadata"
     statistics_dir = "../processed/statdata"
 
+    # stream: a day goes through the pipeline an hour of minute files at a time
+    # incremental: only the minute files new since the last run are read
+    mode = os.environ.get("PIPELINE_MODE", "day")
+
     for ch_id, chunk_list in enumerate(chunk(worklist, 50)):
         stat_queue = f"Q{ch_id}"
         result = list()
         for zip_file_name in chunk_list:
-            f0 = read_unique_entries_from_file(
-                f"busdata/{zip_file_name}.zip",
-                pool.next(),
-                database_dir,
-                metadata_dir,
-                stat_queue,
-            )
-            f0 = filter_entries_pipeline(f0, stat_queue)
-            f0 = dump_entries_into_database(f0, database_dir, stat_queue)
-            f0 = calculate_dayly_statistics(f0, statistics_dir, stat_queue)
-            f0 = release_shared_memory(f0, stat_queue)
+            if mode == "incremental":
+                f0 = incremental_day_pipeline(
+                    f"busdata/{zip_file_name}.zip",
+                    pool.next(),
+                    database_dir,
+                    metadata_dir,
+                    statistics_dir,
+                    stat_queue,
+                )
+            elif mode == "stream":
+                f0 = stream_day_pipeline(
+                    f"busdata/{zip_file_name}.zip",
+                    pool.next(),
+                    database_dir,
+                    metadata_dir,
+                    statistics_dir,
+                    stat_queue,
+                )
+            else:
+                f0 = read_unique_entries_from_file(
+                    f"busdata/{zip_file_name}.zip",
+                    pool.next(),
+                    database_dir,
+                    metadata_dir,
+                    stat_queue,
+                )
+                f0 = filter_entries_pipeline(f0, stat_queue)
+                f0 = dump_entries_into_database(f0, database_dir, stat_queue)
+                f0 = calculate_dayly_statistics(f0, statistics_dir, stat_queue)
+                f0 = release_shared_memory(f0, stat_queue)
 
             pool.current(f0)
             result.append(f0)